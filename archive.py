@@ -0,0 +1,313 @@
+"""Retención de Events: archivo en disco de los eventos fríos.
+
+Los eventos con fecha_hora anterior a la ventana caliente (EVENTS_HOT_DAYS) se mueven de la
+tabla a segmentos comprimidos en ARCHIVE_DIR, así que Events solo contiene los últimos días
+y sus consultas no se degradan con los meses de datos guardados. Historial, export y
+/api/events leen del archivo cuando el rango llega más allá de la ventana caliente.
+
+Cada segmento es un JSON gzip columnar (una lista por columna, filas ordenadas por
+(id_dispositivo, fecha_hora, id_evento); id_evento y fecha_hora en microsegundos se guardan
+como diferencias). manifest.json describe los segmentos: rango de fechas e ids y, por
+dispositivo, el tramo de filas que le corresponde, así que leer un dispositivo solo
+descomprime los segmentos donde aparece.
+
+El archivado toma las filas más antiguas en orden (fecha_hora, id_evento): el archivo es
+siempre un prefijo de la historia y la tabla el resto. Orden de escritura: segmento
+(fsync + rename), manifest con purged=false, DELETE de la tabla, purged=true. Si el proceso
+cae entre medias, la siguiente ejecución completa el borrado; los lectores descartan
+duplicados por id_evento.
+
+Particionado en MySQL (opcional, EVENTS_PARTITIONED=True): con Events particionada por mes
+las consultas calientes descartan particiones enteras y, tras archivar, el job elimina las
+particiones ya vacías con DROP PARTITION y crea las de los meses siguientes. MySQL no admite
+claves foráneas en tablas particionadas y exige que la columna de partición forme parte de
+la clave primaria, así que la migración quita las FKs de Events y cambia la PK a
+(id_evento, fecha_hora). Para ver las sentencias:
+
+    python -m app.archive ddl        # migración inicial
+    python -m app.archive run        # una pasada de archivado (lo mismo que hace la API)
+"""
+import fcntl
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import accumulate
+from sqlalchemy import delete, func, select, text
+from .event_history import EventRecord
+from .models import Events
+
+MANIFEST = "manifest.json"
+_EPOCH = datetime(1970, 1, 1)
+# ids por sentencia DELETE
+_DELETE_CHUNK = 1000
+
+
+def _to_us(fecha_hora: datetime) -> int:
+    return (fecha_hora - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_us(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=us)
+
+
+def _deltas(values: list[int]) -> list[int]:
+    return [b - a for a, b in zip([0] + values, values)]
+
+
+class EventArchive:
+    """Segmentos archivados de Events en `directory` (ver docstring del módulo)."""
+
+    def __init__(self, directory: str, cache_rows: int = 100000):
+        self.directory = directory
+        self._manifest_path = os.path.join(directory, MANIFEST)
+        self._entries: list[dict] = []
+        self._mtime = None
+        self._lock = threading.Lock()
+        # (segmento, inicio, fin) -> filas de un dispositivo ya descomprimidas (LRU), con como
+        # mucho `cache_rows` filas en total
+        self.cache_rows = cache_rows
+        self._cache: OrderedDict[tuple, tuple[EventRecord, ...]] = OrderedDict()
+        self._cached_rows = 0
+
+    def _refresh(self):
+        """Relee el manifest si otro proceso (u otro worker) lo cambió."""
+        try:
+            mtime = os.stat(self._manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._mtime:
+            with open(self._manifest_path) as f:
+                entries = json.load(f)["segmentos"]
+            with self._lock:
+                self._entries, self._mtime = entries, mtime
+
+    def entries(self) -> list[dict]:
+        self._refresh()
+        with self._lock:
+            return list(self._entries)
+
+    def _save(self, entries: list[dict]):
+        tmp = self._manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segmentos": entries}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._manifest_path)
+        with self._lock:
+            self._entries, self._mtime = entries, os.stat(self._manifest_path).st_mtime_ns
+
+    @contextmanager
+    def exclusive(self):
+        """Lock entre procesos para modificar el archivo (un solo job de archivado a la vez).
+        Devuelve False si otro proceso lo tiene.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "w") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def write(self, records: list[EventRecord]) -> dict:
+        """Escribe un segmento con `records` y lo añade al manifest (purged=false)."""
+        records = sorted(records, key=lambda r: (r.id_dispositivo, r.fecha_hora, r.id_evento))
+        columns = {field: [getattr(r, field) for r in records] for field in EventRecord._fields}
+        columns["id_evento"] = _deltas(columns["id_evento"])
+        columns["fecha_hora"] = _deltas([_to_us(f) for f in columns["fecha_hora"]])
+        devices: dict[str, list[int]] = {}
+        for i, r in enumerate(records):
+            devices.setdefault(str(r.id_dispositivo), [i, i])[1] = i + 1
+        desde = min(r.fecha_hora for r in records)
+        name = f"eventos_{desde:%Y%m%d%H%M%S}_{min(r.id_evento for r in records)}.json.gz"
+        path = os.path.join(self.directory, name)
+        with gzip.open(path + ".tmp", "wt") as f:
+            json.dump(columns, f, separators=(",", ":"))
+        with open(path + ".tmp", "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        entry = {
+            "archivo": name,
+            "filas": len(records),
+            "desde": desde.isoformat(),
+            "hasta": max(r.fecha_hora for r in records).isoformat(),
+            "min_id": min(r.id_evento for r in records),
+            "max_id": max(r.id_evento for r in records),
+            "dispositivos": devices,
+            "purged": False,
+        }
+        self._refresh()
+        self._save(self.entries() + [entry])
+        return entry
+
+    def mark_purged(self, name: str):
+        self._refresh()
+        self._save([{**e, "purged": True} if e["archivo"] == name else e for e in self.entries()])
+
+    def ids(self, name: str) -> list[int]:
+        with gzip.open(os.path.join(self.directory, name), "rt") as f:
+            return list(accumulate(json.load(f)["id_evento"]))
+
+    def _device_rows(self, name: str, start: int, end: int, cache: bool = True) -> tuple[EventRecord, ...]:
+        key = (name, start, end)
+        with self._lock:
+            rows = self._cache.get(key)
+            if rows is not None:
+                self._cache.move_to_end(key)
+                return rows
+        with gzip.open(os.path.join(self.directory, name), "rt") as f:
+            columns = json.load(f)
+        columns["id_evento"] = list(accumulate(columns["id_evento"]))
+        columns["fecha_hora"] = [_from_us(us) for us in accumulate(columns["fecha_hora"])]
+        rows = tuple(EventRecord(*(columns[field][i] for field in EventRecord._fields)) for i in range(start, end))
+        if cache and len(rows) <= self.cache_rows:
+            with self._lock:
+                if key not in self._cache:
+                    self._cache[key] = rows
+                    self._cached_rows += len(rows)
+                while self._cached_rows > self.cache_rows:
+                    self._cached_rows -= len(self._cache.popitem(last=False)[1])
+        return rows
+
+    def has_device(self, id_dispositivo: int) -> bool:
+        return any(str(id_dispositivo) in e["dispositivos"] for e in self.entries())
+
+    def events(self, id_dispositivo: int, desde: datetime | None = None, hasta: datetime | None = None,
+               reverse: bool = False, cache: bool = True):
+        """Eventos archivados del dispositivo en [desde, hasta], en orden (fecha_hora, id_evento)
+        ascendente o descendente. Solo descomprime los segmentos que se recorren; sin `cache`
+        (recorridos completos como el export) no los guarda en la caché de filas.
+        """
+        key = str(id_dispositivo)
+        entries = [e for e in self.entries() if key in e["dispositivos"]
+                   and (desde is None or datetime.fromisoformat(e["hasta"]) >= desde)
+                   and (hasta is None or datetime.fromisoformat(e["desde"]) <= hasta)]
+        for entry in (reversed(entries) if reverse else entries):
+            rows = self._device_rows(entry["archivo"], *entry["dispositivos"][key], cache=cache)
+            for record in (reversed(rows) if reverse else rows):
+                if (desde is None or record.fecha_hora >= desde) and (hasta is None or record.fecha_hora <= hasta):
+                    yield record
+
+    def find(self, id_dispositivo: int, id_evento: int) -> EventRecord | None:
+        key = str(id_dispositivo)
+        for entry in self.entries():
+            if key in entry["dispositivos"] and entry["min_id"] <= id_evento <= entry["max_id"]:
+                for record in self._device_rows(entry["archivo"], *entry["dispositivos"][key]):
+                    if record.id_evento == id_evento:
+                        return record
+        return None
+
+
+def _purge(session_factory, ids: list[int]):
+    session = session_factory()
+    try:
+        for i in range(0, len(ids), _DELETE_CHUNK):
+            session.execute(delete(Events).where(Events.id_evento.in_(ids[i:i + _DELETE_CHUNK])))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def archive_cold_events(session_factory, archive: EventArchive, cutoff: datetime, file_rows: int) -> int:
+    """Mueve al archivo los eventos con fecha_hora < cutoff, en segmentos de hasta `file_rows`
+    filas. Devuelve las filas archivadas (0 si otro proceso está archivando).
+    """
+    total = 0
+    with archive.exclusive() as acquired:
+        if not acquired:
+            return 0
+        # completar borrados interrumpidos
+        for entry in archive.entries():
+            if not entry["purged"]:
+                _purge(session_factory, archive.ids(entry["archivo"]))
+                archive.mark_purged(entry["archivo"])
+        columns = [getattr(Events, field) for field in EventRecord._fields]
+        # la fila con el id_evento más alto nunca se archiva: con la tabla vacía SQLite (y MySQL
+        # < 8.0 al reiniciar) volverían a asignar ids ya archivados
+        newest = select(func.max(Events.id_evento)).scalar_subquery()
+        stmt = select(*columns).where(Events.fecha_hora < cutoff, Events.id_evento < newest) \
+            .order_by(Events.fecha_hora, Events.id_evento).limit(file_rows)
+        while True:
+            session = session_factory()
+            try:
+                records = [EventRecord(*row) for row in session.execute(stmt)]
+            finally:
+                session.close()
+            if not records:
+                return total
+            entry = archive.write(records)
+            _purge(session_factory, [r.id_evento for r in records])
+            archive.mark_purged(entry["archivo"])
+            total += len(records)
+
+
+def _month(fecha: datetime, offset: int = 0) -> datetime:
+    index = fecha.year * 12 + fecha.month - 1 + offset
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _partition(inicio: datetime) -> str:
+    fin = _month(inicio, 1)
+    return f"PARTITION p{inicio:%Y%m} VALUES LESS THAN ('{fin:%Y-%m-%d}')"
+
+
+def partition_ddl(desde: datetime, months: int) -> list[str]:
+    """Migración de Events a particiones mensuales desde el mes de `desde` y `months` meses más."""
+    inicio = _month(desde)
+    partitions = [_partition(_month(inicio, i)) for i in range(months + 1)]
+    return [
+        "-- quitar antes las FKs de Events (nombres en SHOW CREATE TABLE Events):",
+        "-- ALTER TABLE Events DROP FOREIGN KEY <fk>;",
+        "ALTER TABLE Events MODIFY fecha_hora DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+        "DROP PRIMARY KEY, ADD PRIMARY KEY (id_evento, fecha_hora);",
+        "ALTER TABLE Events PARTITION BY RANGE COLUMNS(fecha_hora) (" + ", ".join(
+            partitions + ["PARTITION pmax VALUES LESS THAN (MAXVALUE)"]) + ");",
+    ]
+
+
+def maintain_partitions(engine, cutoff: datetime, months_ahead: int = 2):
+    """Con Events particionada por mes (MySQL): elimina las particiones enteramente anteriores
+    a `cutoff` que ya estén vacías (archivadas) y crea las de los próximos meses.
+    """
+    with engine.begin() as conn:
+        rows = conn.execute(text(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Events' AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY PARTITION_ORDINAL_POSITION")).all()
+        if not rows:
+            return
+        bounds = {name: datetime.fromisoformat(bound.strip("'")) for name, bound in rows if name != "pmax"}
+        for name, bound in bounds.items():
+            if bound <= cutoff and conn.execute(text(f"SELECT 1 FROM Events PARTITION ({name}) LIMIT 1")).first() is None:
+                conn.execute(text(f"ALTER TABLE Events DROP PARTITION {name}"))
+        # solo se pueden añadir meses posteriores a la última partición (se parte pmax)
+        last = max(bounds.values(), default=None)
+        upcoming = [_month(datetime.utcnow(), i) for i in range(months_ahead + 1)]
+        missing = [_partition(inicio) for inicio in upcoming if last is None or inicio >= last]
+        if missing and any(name == "pmax" for name, _ in rows):
+            conn.execute(text("ALTER TABLE Events REORGANIZE PARTITION pmax INTO (" + ", ".join(
+                missing + ["PARTITION pmax VALUES LESS THAN (MAXVALUE)"]) + ")"))
+
+
+if __name__ == "__main__":
+    import sys
+    from . import crud
+
+    command = sys.argv[1:]
+    if command == ["ddl"]:
+        print("\n".join(partition_ddl(datetime.utcnow() - timedelta(days=crud.settings.EVENTS_HOT_DAYS), 12)))
+    elif command == ["run"]:
+        print(f"{crud.archive_cold_events()} eventos archivados")
+    else:
+        sys.exit("uso: python -m app.archive ddl|run")
@@ -0,0 +1,85 @@
+"""Utilidades compartidas por los benchmarks (pip install -r bench/requirements.txt): base SQLite local y servidor uvicorn en un subproceso."""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def package_dir() -> str:
+    """Directorio temporal con un enlace `app` -> repositorio, para importar `app.main`."""
+    path = tempfile.mkdtemp(prefix="carro-iot-bench-")
+    os.symlink(REPO_DIR, os.path.join(path, "app"))
+    return path
+
+
+def create_database(path: str, pkg_dir: str, rows: int = 0, devices: int = 1):
+    """Crea una base SQLite con el esquema, los catálogos (`devices` carros y un cliente) y `rows` eventos repartidos entre ellos."""
+    if os.path.exists(path):
+        os.remove(path)
+    sys.path.insert(0, pkg_dir)
+    from sqlalchemy import create_engine, insert, text
+    from app import models
+
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO Operations (id_operation, status_texto) VALUES (1,'Adelante'),(2,'Atras'),(3,'Detener'),(4,'Izquierda'),(5,'Derecha')"))
+        conn.execute(text("INSERT INTO Obstaculos (id_obstaculo, status_texto) VALUES (1,'Adelante'),(2,'Atras')"))
+        conn.execute(insert(models.Dispositivos), [{"id_dispositivo": d, "nombre_dispositivo": f"carro-{d}"}
+                                                   for d in range(1, devices + 1)])
+        conn.execute(text("INSERT INTO ClientesIoT (id_cliente, ip, pais, ciudad, longitud, latitud) VALUES (1,'127.0.0.1','MX','CDMX',0,0)"))
+        conn.execute(text("INSERT INTO Velocidades (id_velocidad, nivel_velocidad, descripcion, valor_pwm, activo) VALUES (1,1,'Lenta',100,1),(2,2,'Media',180,1),(3,3,'Rapida',255,1)"))
+        start = datetime(2025, 1, 1)
+        batch = []
+        for i in range(rows):
+            batch.append({"id_dispositivo": i % devices + 1, "id_cliente": 1, "id_operacion": i % 5 + 1,
+                          "id_obstaculo": 1 if i % 50 == 0 else None, "id_velocidad": i % 3 + 1 if i % 20 == 0 else None,
+                          "fecha_hora": start + timedelta(seconds=i)})
+            if len(batch) == 10000:
+                conn.execute(insert(models.Events), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(models.Events), batch)
+    engine.dispose()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(pkg_dir: str, db_path: str, port: int, extra_env: dict | None = None) -> subprocess.Popen:
+    env = dict(os.environ, DB_USER="bench", DB_PASSWORD="bench", DB_HOST="localhost", DB_NAME="bench",
+               DB_URL=f"sqlite:///{db_path}", **(extra_env or {}))
+    args = [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"]
+    # la CLI de uvicorn no lee WS_PING_*: el ping del protocolo se le pasa aparte
+    for var, flag in (("WS_PING_INTERVAL_S", "--ws-ping-interval"), ("WS_PING_TIMEOUT_S", "--ws-ping-timeout")):
+        if env.get(var):
+            args += [flag, env[var]]
+    proc = subprocess.Popen(args, cwd=pkg_dir, env=env)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                return proc
+        except httpx.TransportError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("el servidor no arrancó")
+
+
+def rss_kb(pid: int) -> int:
+    """RSS actual del proceso en KiB (Linux)."""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
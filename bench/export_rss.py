@@ -0,0 +1,72 @@
+"""Mide el RSS del servidor mientras exporta una tabla Events grande por /api/events/{id}/export.
+
+    python bench/export_rss.py --rows 1000000 --formato ndjson
+
+Imprime un JSON con filas, bytes, duración y RSS (inicio, pico, fin) del proceso servidor.
+Requiere httpx (pip install -r bench/requirements.txt).
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+import httpx
+
+from _common import create_database, free_port, package_dir, rss_kb, start_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--formato", choices=("ndjson", "csv"), default="ndjson")
+    parser.add_argument("--interval", type=float, default=0.1, help="segundos entre muestras de RSS")
+    args = parser.parse_args()
+
+    pkg_dir = package_dir()
+    db_path = os.path.join(pkg_dir, "bench.db")
+    create_database(db_path, pkg_dir, rows=args.rows)
+    port = free_port()
+    server = start_server(pkg_dir, db_path, port)
+    samples = []
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            samples.append(rss_kb(server.pid))
+            time.sleep(args.interval)
+
+    try:
+        rss_start = rss_kb(server.pid)
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        received = lines = 0
+        t0 = time.perf_counter()
+        with httpx.stream("GET", f"http://127.0.0.1:{port}/api/events/1/export", params={"formato": args.formato}, timeout=None) as r:
+            r.raise_for_status()
+            for chunk in r.iter_bytes():
+                received += len(chunk)
+                lines += chunk.count(b"\n")
+        elapsed = time.perf_counter() - t0
+        done.set()
+        sampler.join()
+        rss_end = rss_kb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(json.dumps({
+        "benchmark": "export_rss",
+        "formato": args.formato,
+        "rows": args.rows,
+        "lines": lines,
+        "bytes": received,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(args.rows / elapsed) if elapsed else None,
+        "rss_kb": {"start": rss_start, "peak": max(samples or [rss_end]), "end": rss_end},
+        "rss_samples_kb": samples,
+    }))
+
+
+if __name__ == "__main__":
+    main()
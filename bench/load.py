@@ -0,0 +1,284 @@
+"""Benchmark de carga y latencia de la API.
+
+Arranca la app (uvicorn en un subproceso) contra una base SQLite local, envía comandos a un
+ritmo fijo repartidos entre muchos dispositivos, conecta N monitores a /ws/monitor (algunos
+deliberadamente lentos) y mide:
+
+- latencia de los comandos HTTP (p50/p90/p99/max) por tipo y throughput logrado
+- retardo extremo a extremo del broadcast (envío del comando -> frame recibido por el monitor)
+- RSS del servidor (inicio, pico, fin)
+
+Con --db-stall la base se bloquea periódicamente (un lock exclusivo de SQLite retenido desde el
+benchmark) para simular una BD lenta o caída; --obstacle-target-ms comprueba que la latencia de
+los obstáculos (respuesta HTTP y llegada del Detener a los monitores) sigue por debajo del objetivo.
+
+Con --tick-monitors parte de los monitores rápidos usa /ws/monitor?modo=tick (un frame agrupado
+por tick); el informe separa sus frames y su retardo para compararlos con los de un frame por evento.
+
+El resultado se imprime (y opcionalmente se guarda) como JSON para comparar ejecuciones:
+
+    python bench/load.py --rate 500 --duration 20 --devices 50 --monitors 200 --slow-monitors 20 --output run.json
+    python bench/load.py --server-env EVENTS_DURABILITY=buffered --server-env WS_OVERFLOW_POLICY=coalesce
+    python bench/load.py --obstacle-ratio 0.3 --db-stall 2 --db-stall-every 4 --obstacle-target-ms 50
+    python bench/load.py --rate 1000 --monitors 100 --slow-monitors 0 --tick-monitors 50
+
+Requiere httpx y websockets, además de las dependencias de la app:
+
+    pip install -r bench/requirements.txt
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import httpx
+import websockets
+
+from _common import create_database, free_port, package_dir, rss_kb, start_server
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"n": 0}
+    values = sorted(values)
+
+    def pct(p):
+        return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 3)
+
+    return {"n": len(values), "p50_ms": pct(50), "p90_ms": pct(90), "p99_ms": pct(99), "max_ms": round(values[-1] * 1000, 3)}
+
+
+class Monitor:
+    """Cliente de /ws/monitor que anota cuándo recibe cada id_evento (o id_provisional)."""
+
+    def __init__(self, url: str, delay: float):
+        self.url = url
+        self.delay = delay
+        self.received: dict[int | str, float] = {}
+        self.frames = 0
+
+    async def run(self, stop: asyncio.Event):
+        async with websockets.connect(self.url, max_queue=None) as ws:
+            while not stop.is_set():
+                try:
+                    raw = await asyncio.wait_for(ws.recv(), 0.5)
+                except asyncio.TimeoutError:
+                    continue
+                now = time.perf_counter()
+                self.frames += 1
+                message = json.loads(raw)
+                if message.get("tipo") == "ping":
+                    # latido del servidor: sin respuesta cierra la conexión
+                    await ws.send('{"tipo":"pong"}')
+                    continue
+                for item in _items(message):
+                    evento = item.get("evento") or {}
+                    # los obstáculos llegan primero con id provisional
+                    key = evento.get("id_evento") if evento.get("id_evento") is not None else evento.get("id_provisional")
+                    if key is not None:
+                        self.received.setdefault(key, now)
+                if self.delay:
+                    # consumidor lento: deja de leer un rato
+                    await asyncio.sleep(self.delay)
+
+
+def _items(message: dict):
+    """Mensajes con evento dentro de un frame (lotes, ticks y reanudaciones los agrupan)."""
+    if "mensajes" in message:
+        for inner in message["mensajes"]:
+            yield from _items(inner)
+    elif "eventos" in message:
+        yield from message["eventos"]
+    else:
+        yield message
+
+
+async def drive(base_url: str, args, sent: dict, latencies: dict, errors: list):
+    kinds = ["obstaculo"] * int(args.obstacle_ratio * 100) + ["velocidad"] * int(args.speed_ratio * 100)
+    kinds += ["movimiento"] * (100 - len(kinds))
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    # los obstáculos van por su propio cliente (como el carro que los reporta), para no medir
+    # la espera tras comandos atascados en el pool del benchmark
+    semaphores = {"comandos": asyncio.Semaphore(args.concurrency), "obstaculo": asyncio.Semaphore(args.concurrency)}
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as commands, \
+            httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as obstacles:
+
+        async def one(kind: str, device: int):
+            lane = "obstaculo" if kind == "obstaculo" else "comandos"
+            client = obstacles if kind == "obstaculo" else commands
+            async with semaphores[lane]:
+                if kind == "movimiento":
+                    path, body = "/api/move", {"id_dispositivo": device, "id_cliente": 1, "id_operacion": random.randint(1, 5)}
+                elif kind == "velocidad":
+                    path, body = "/api/speed", {"id_dispositivo": device, "id_cliente": 1, "id_velocidad": random.randint(1, 3)}
+                else:
+                    path, body = "/api/obstaculo", {"id_dispositivo": device, "id_cliente": 1, "id_obstaculo": 1}
+                start = time.perf_counter()
+                try:
+                    r = await client.post(path, json=body)
+                    elapsed = time.perf_counter() - start
+                    if r.status_code >= 400:
+                        errors.append(r.status_code)
+                        return
+                    latencies[kind].append(elapsed)
+                    body = r.json()
+                    key = body.get("id_evento", body.get("id_provisional"))
+                    if key is not None:
+                        sent[key] = (start, kind)
+                except httpx.HTTPError as e:
+                    errors.append(type(e).__name__)
+
+        tasks = []
+        interval = 1 / args.rate
+        t0 = time.perf_counter()
+        for i in range(int(args.rate * args.duration)):
+            # lazo abierto: se programa cada comando a su hora aunque los anteriores no hayan terminado
+            delay = t0 + i * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(one(random.choice(kinds), random.randint(1, args.devices))))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - t0
+
+
+async def run(args, base_url: str, ws_url: str):
+    monitors = [Monitor(ws_url, args.slow_delay if i < args.slow_monitors else 0) for i in range(args.monitors)]
+    for m in [m for m in monitors if not m.delay][:args.tick_monitors]:
+        m.url += "?modo=tick"
+    stop = asyncio.Event()
+    monitor_tasks = [asyncio.create_task(m.run(stop)) for m in monitors]
+    await asyncio.sleep(1)
+    sent: dict[int | str, tuple[float, str]] = {}
+    latencies = {"movimiento": [], "velocidad": [], "obstaculo": []}
+    errors: list = []
+    elapsed = await drive(base_url, args, sent, latencies, errors)
+    # dar tiempo a que terminen de llegar los broadcasts
+    await asyncio.sleep(args.drain)
+    stop.set()
+    await asyncio.gather(*monitor_tasks, return_exceptions=True)
+
+    def delays(group, kind=None):
+        values = []
+        for m in group:
+            values.extend(m.received[i] - sent[i][0] for i in m.received if i in sent and kind in (None, sent[i][1]))
+        return values
+
+    tick = [m for m in monitors if m.url.endswith("modo=tick")]
+    fast = [m for m in monitors if not m.delay and m not in tick]
+    slow = [m for m in monitors if m.delay]
+    completed = sum(len(v) for v in latencies.values())
+    return {
+        "commands": {
+            "requested": int(args.rate * args.duration),
+            "completed": completed,
+            "errors": len(errors),
+            "throughput_per_s": round(completed / elapsed, 1) if elapsed else None,
+            "latency": percentiles([x for v in latencies.values() for x in v]),
+            "latency_by_tipo": {k: percentiles(v) for k, v in latencies.items()},
+        },
+        "broadcast": {
+            "fast_monitors": len(fast),
+            "slow_monitors": len(slow),
+            "delay_fast": percentiles(delays(fast)),
+            "delay_slow": percentiles(delays(slow)),
+            "delay_fast_by_tipo": {k: percentiles(delays(fast, k)) for k in latencies},
+            "frames_fast": sum(m.frames for m in fast),
+            "frames_slow": sum(m.frames for m in slow),
+            "tick_monitors": len(tick),
+            "delay_tick": percentiles(delays(tick)),
+            "frames_tick": sum(m.frames for m in tick),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=200, help="comandos por segundo (total)")
+    parser.add_argument("--duration", type=float, default=10, help="segundos de carga")
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--monitors", type=int, default=50)
+    parser.add_argument("--slow-monitors", type=int, default=5, help="cuántos de los monitores son lentos")
+    parser.add_argument("--tick-monitors", type=int, default=0, help="cuántos de los monitores rápidos usan modo tick")
+    parser.add_argument("--slow-delay", type=float, default=0.2, help="pausa (s) de un monitor lento tras cada frame")
+    parser.add_argument("--speed-ratio", type=float, default=0.2)
+    parser.add_argument("--obstacle-ratio", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=100, help="peticiones HTTP simultáneas como máximo")
+    parser.add_argument("--drain", type=float, default=2, help="segundos de espera final para los broadcasts")
+    parser.add_argument("--db-stall", type=float, default=0, help="segundos que se bloquea la BD en cada parada (0 = nunca)")
+    parser.add_argument("--db-stall-every", type=float, default=5, help="segundos entre el inicio de dos paradas de la BD")
+    parser.add_argument("--obstacle-target-ms", type=float, help="objetivo de p99 para los obstáculos (respuesta y broadcast)")
+    parser.add_argument("--server-env", action="append", default=[], metavar="CLAVE=VALOR",
+                        help="variables de entorno para el servidor (p.ej. EVENTS_DURABILITY=buffered)")
+    parser.add_argument("--url", help="usar un servidor ya levantado (no mide RSS ni admite --db-stall)")
+    parser.add_argument("--output", help="archivo donde guardar el JSON")
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        pkg_dir = package_dir()
+        db_path = os.path.join(pkg_dir, "bench.db")
+        create_database(db_path, pkg_dir, devices=args.devices)
+        port = free_port()
+        extra_env = dict(item.split("=", 1) for item in args.server_env)
+        server = start_server(pkg_dir, db_path, port, extra_env)
+        base_url = f"http://127.0.0.1:{port}"
+    ws_url = base_url.replace("http", "ws", 1) + "/ws/monitor"
+
+    samples = []
+    done = threading.Event()
+
+    def stall_db():
+        # BEGIN EXCLUSIVE: nadie más puede leer ni escribir hasta el commit
+        conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        while not done.wait(max(0.0, args.db_stall_every - args.db_stall)):
+            conn.execute("BEGIN EXCLUSIVE")
+            done.wait(args.db_stall)
+            conn.execute("COMMIT")
+        conn.close()
+
+    def sample():
+        while not done.is_set():
+            samples.append(rss_kb(server.pid))
+            time.sleep(0.2)
+
+    try:
+        if server is not None:
+            rss_start = rss_kb(server.pid)
+            threading.Thread(target=sample, daemon=True).start()
+            if args.db_stall:
+                threading.Thread(target=stall_db, daemon=True).start()
+        result = asyncio.run(run(args, base_url, ws_url))
+        done.set()
+        if server is not None:
+            result["server_rss_kb"] = {"start": rss_start, "peak": max(samples or [0]), "end": rss_kb(server.pid)}
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.obstacle_target_ms is not None:
+        target = args.obstacle_target_ms
+        response_p99 = result["commands"]["latency_by_tipo"]["obstaculo"].get("p99_ms")
+        broadcast_p99 = result["broadcast"]["delay_fast_by_tipo"]["obstaculo"].get("p99_ms")
+        result["obstacle_target"] = {
+            "target_ms": target,
+            "response_p99_ms": response_p99,
+            "broadcast_p99_ms": broadcast_p99,
+            "ok": response_p99 is not None and broadcast_p99 is not None and max(response_p99, broadcast_p99) <= target,
+        }
+    result = {"benchmark": "load", "config": {k: v for k, v in vars(args).items() if k != "output"}, **result}
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
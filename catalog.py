@@ -0,0 +1,81 @@
+import threading
+import time
+from typing import NamedTuple
+from .models import ClientesIoT, Dispositivos, Operations, Obstaculos, Velocidades
+
+
+class Velocidad(NamedTuple):
+    id_velocidad: int
+    nivel_velocidad: int
+    descripcion: str
+    valor_pwm: int
+    activo: bool
+
+
+class Catalog:
+    """Caché en memoria de las tablas de catálogo (Operations, Obstaculos, Velocidades) y de los
+    ids de Dispositivos y ClientesIoT (para validar sin la BD lo que no se escribe de inmediato).
+
+    Se recarga completa cuando pasan `ttl` segundos desde la última carga (0 = nunca
+    expira) o al llamar a reload(). Las lecturas son búsquedas en diccionarios.
+    """
+
+    def __init__(self, session_factory, ttl: float):
+        self._session_factory = session_factory
+        self.ttl = ttl
+        self.operaciones: dict[int, str] = {}
+        self.obstaculos: dict[int, str] = {}
+        self.velocidades: dict[int, Velocidad] = {}
+        self.dispositivos: set[int] = set()
+        self.clientes: set[int] = set()
+        self.loaded_at: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def stale(self) -> bool:
+        if self.loaded_at is None:
+            return True
+        return self.ttl > 0 and time.monotonic() - self.loaded_at > self.ttl
+
+    def reload(self):
+        """Lee los catálogos de la BD y reemplaza la caché."""
+        session = self._session_factory()
+        try:
+            operaciones = {o.id_operation: o.status_texto for o in session.query(Operations)}
+            obstaculos = {o.id_obstaculo: o.status_texto for o in session.query(Obstaculos)}
+            velocidades = {v.id_velocidad: Velocidad(v.id_velocidad, v.nivel_velocidad, v.descripcion, v.valor_pwm, bool(v.activo))
+                           for v in session.query(Velocidades)}
+            dispositivos = {i for (i,) in session.query(Dispositivos.id_dispositivo)}
+            clientes = {i for (i,) in session.query(ClientesIoT.id_cliente)}
+        finally:
+            session.close()
+        with self._lock:
+            self.operaciones, self.obstaculos, self.velocidades = operaciones, obstaculos, velocidades
+            self.dispositivos, self.clientes = dispositivos, clientes
+            self.loaded_at = time.monotonic()
+
+    def ensure(self):
+        """Recarga sólo si la caché está vacía o expirada."""
+        if self.stale:
+            self.reload()
+
+    def velocidad(self, id_velocidad: int | None) -> Velocidad | None:
+        return self.velocidades.get(id_velocidad)
+
+    def unknown_ids(self, id_dispositivo: int, id_cliente: int, id_obstaculo: int | None = None) -> list[str]:
+        """Campos de un evento cuyos ids no están en la caché (lista vacía = todos válidos)."""
+        unknown = []
+        if id_dispositivo not in self.dispositivos:
+            unknown.append("id_dispositivo")
+        if id_cliente not in self.clientes:
+            unknown.append("id_cliente")
+        if id_obstaculo is not None and id_obstaculo not in self.obstaculos:
+            unknown.append("id_obstaculo")
+        return unknown
+
+    def resolve(self, id_operacion: int | None, id_obstaculo: int | None, id_velocidad: int | None):
+        """Textos (operacion, obstaculo, velocidad) para los ids de un evento."""
+        velocidad = self.velocidades.get(id_velocidad)
+        return (self.operaciones.get(id_operacion),
+                self.obstaculos.get(id_obstaculo),
+                velocidad.descripcion if velocidad else None)
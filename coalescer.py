@@ -0,0 +1,206 @@
+"""Límite de escrituras por carro para los comandos de movimiento y velocidad.
+
+Cada carro tiene un token bucket (COMMAND_RATE_PER_S escrituras por segundo, ráfagas de hasta
+COMMAND_BURST) y cada tipo de comando (movimiento, velocidad) una ventana de fusión de
+COMMAND_COALESCE_MS: el primer comando se escribe en cuanto hay token; los que llegan antes de
+que acabe la ventana (o de que haya token) se fusionan en un único comando pendiente en el que
+gana el último, que se escribe y difunde una sola vez al cerrarse. Todas las peticiones
+fusionadas reciben el evento que se escribió de verdad.
+
+Sin ventana (COMMAND_COALESCE_MS=0) no se fusiona nada y los comandos que no encuentran token
+se rechazan (RateLimited). Los lotes de /api/events/batch no se fusionan, pero gastan los tokens
+de sus carros (take). Los obstáculos y los Detener no pasan por aquí: antes de escribirlos se
+descartan los comandos pendientes del carro (supersede, y main cancela su secuencia) para que un
+Adelante fusionado no lo arranque después del Detener.
+"""
+import asyncio
+from .config import settings
+from . import metrics
+
+# tipos de comando que se limitan y fusionan (cada uno con su propia ventana)
+TIPOS = ("movimiento", "velocidad")
+
+
+class RateLimited(Exception):
+    """El carro superó su límite de comandos; `retry_after` en segundos."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"límite de comandos superado; reintentar en {retry_after:.2f} s")
+        self.retry_after = retry_after
+
+
+class CommandSuperseded(Exception):
+    """El comando pendiente se descartó por un Detener (obstáculo o manual) en el mismo carro."""
+
+    def __init__(self, motivo: str):
+        super().__init__(f"Comando descartado: {motivo}")
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class _Pending:
+    __slots__ = ("value", "write", "future", "task")
+
+    def __init__(self, value, write, future: asyncio.Future):
+        self.value = value
+        self.write = write
+        self.future = future
+        self.task = None
+
+
+class CommandCoalescer:
+    def __init__(self, window_ms: int, rate: float, burst: int):
+        self.window = window_ms / 1000
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._buckets: dict[int, _Bucket] = {}
+        # (id_dispositivo, tipo) -> comando esperando a escribirse
+        self._pending: dict[tuple[int, str], _Pending] = {}
+        # (id_dispositivo, tipo) -> escritura en curso (las siguientes esperan a que termine)
+        self._writing: dict[tuple[int, str], asyncio.Future] = {}
+        # (id_dispositivo, tipo) -> instante en que empezó la última escritura (abre la ventana)
+        self._last_write: dict[tuple[int, str], float] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 or self.rate > 0
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def _bucket(self, id_dispositivo: int, now: float) -> _Bucket:
+        """Bucket del carro con los tokens acumulados hasta `now`."""
+        bucket = self._buckets.get(id_dispositivo)
+        if bucket is None:
+            bucket = self._buckets[id_dispositivo] = _Bucket(self.burst, now)
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        return bucket
+
+    def _reserve(self, id_dispositivo: int, now: float) -> float:
+        """Toma un token del carro. Devuelve cuántos segundos faltan para que exista (0 = ya)."""
+        if self.rate <= 0:
+            return 0.0
+        bucket = self._bucket(id_dispositivo, now)
+        bucket.tokens -= 1
+        return 0.0 if bucket.tokens >= 0 else -bucket.tokens / self.rate
+
+    def take(self, comandos: dict[int, int]):
+        """Toma de una vez los tokens de comandos que se escriben sin ventana (los de un lote):
+        `comandos` = id_dispositivo -> número de comandos. Si a algún carro no le alcanzan no toma
+        ninguno y lanza RateLimited; ValueError si un carro pide más que una ráfaga completa.
+        """
+        if self.rate <= 0:
+            return
+        over = [id_dispositivo for id_dispositivo, n in comandos.items() if n > self.burst]
+        if over:
+            raise ValueError(f"máximo {self.burst} comandos de movimiento/velocidad por carro (dispositivos {over})")
+        now = asyncio.get_running_loop().time()
+        buckets = {id_dispositivo: self._bucket(id_dispositivo, now) for id_dispositivo in comandos}
+        wait = max((n - buckets[id_dispositivo].tokens) / self.rate for id_dispositivo, n in comandos.items()) if comandos else 0.0
+        if wait > 0:
+            metrics.commands_rejected.inc("lote")
+            raise RateLimited(wait)
+        for id_dispositivo, n in comandos.items():
+            buckets[id_dispositivo].tokens -= n
+
+    def _refund(self, id_dispositivo: int):
+        bucket = self._buckets.get(id_dispositivo)
+        if bucket is not None:
+            bucket.tokens += 1
+
+    async def submit(self, id_dispositivo: int, tipo: str, value, write):
+        """Escribe el comando con `await write(value)` respetando el límite del carro y devuelve
+        su resultado (el del comando que se escribió si este se fusionó con otros).
+        """
+        if not self.enabled:
+            return await write(value)
+        key = (id_dispositivo, tipo)
+        pending = self._pending.get(key)
+        if pending is not None:
+            # gana el último: el comando pendiente pasa a ser este
+            pending.value, pending.write = value, write
+            metrics.commands_coalesced.inc(tipo)
+            return await asyncio.shield(pending.future)
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        wait = self._reserve(id_dispositivo, now)
+        if self.window <= 0:
+            if wait > 0:
+                self._refund(id_dispositivo)
+                metrics.commands_rejected.inc(tipo)
+                raise RateLimited(wait)
+            return await self._write(key, value, write)
+        last = self._last_write.get(key)
+        delay = max(wait, 0.0 if last is None else last + self.window - now)
+        if delay <= 0 and key not in self._writing:
+            return await self._write(key, value, write)
+        pending = self._pending[key] = _Pending(value, write, loop.create_future())
+        pending.task = asyncio.create_task(self._flush_later(key, pending, delay))
+        # shield: si la petición se cancela el comando se escribe igualmente
+        return await asyncio.shield(pending.future)
+
+    async def _write(self, key, value, write):
+        previous = self._writing.get(key)
+        if previous is not None:
+            # una escritura anterior del mismo tipo sigue en curso: conservar el orden
+            await asyncio.wait([previous])
+        done = self._writing[key] = asyncio.get_running_loop().create_future()
+        self._last_write[key] = asyncio.get_running_loop().time()
+        try:
+            return await write(value)
+        finally:
+            done.set_result(None)
+            if self._writing.get(key) is done:
+                del self._writing[key]
+
+    async def _flush_later(self, key, pending: _Pending, delay: float):
+        await asyncio.sleep(delay)
+        if self._pending.get(key) is not pending:
+            return
+        try:
+            # los comandos que lleguen durante la escritura abren una nueva ventana
+            result = await self._write_pending(key, pending)
+        except Exception as e:
+            if not pending.future.done():
+                pending.future.set_exception(e)
+                # evita el aviso "exception was never retrieved" si la petición ya no espera
+                pending.future.exception()
+        else:
+            pending.future.set_result(result)
+
+    async def _write_pending(self, key, pending: _Pending):
+        previous = self._writing.get(key)
+        if previous is not None:
+            await asyncio.wait([previous])
+        if self._pending.get(key) is not pending:
+            # supersede() ya respondió a sus peticiones con el motivo
+            raise CommandSuperseded("descartado mientras esperaba su turno")
+        del self._pending[key]
+        return await self._write(key, pending.value, pending.write)
+
+    def supersede(self, id_dispositivo: int, motivo: str = "se detectó un obstáculo en el carro"):
+        """Descarta los comandos pendientes del carro (obstáculo o Detener): sus peticiones reciben
+        CommandSuperseded con `motivo`."""
+        for tipo in TIPOS:
+            pending = self._pending.pop((id_dispositivo, tipo), None)
+            if pending is None:
+                continue
+            if pending.task is not None:
+                pending.task.cancel()
+            self._refund(id_dispositivo)
+            pending.future.set_exception(CommandSuperseded(motivo))
+            pending.future.exception()
+            metrics.commands_superseded.inc(tipo)
+
+
+coalescer = CommandCoalescer(settings.COMMAND_COALESCE_MS, settings.COMMAND_RATE_PER_S, settings.COMMAND_BURST)
+
+metrics.registry.register(metrics.Gauge("commands_pending", "Comandos de movimiento/velocidad esperando su ventana",
+                                        func=coalescer.pending))
@@ -1,4 +1,5 @@
 import os
+from pydantic import model_validator
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
@@ -7,10 +8,96 @@ class Settings(BaseSettings):
     DB_HOST: str
     DB_PORT: str = "3306"
     DB_NAME: str
+    # URL completa opcional (p.ej. sqlite:///./local.db para pruebas); si se define tiene prioridad
+    DB_URL: str | None = None
+    # hilos dedicados a la BD; también fija el tamaño del pool de conexiones
+    DB_POOL_SIZE: int = 10
+    # Escritura de Events: "sync" (un commit por evento) o "buffered" (write-behind por lotes; sólo
+    # con un proceso, EVENT_BUS=memory)
+    EVENTS_DURABILITY: str = "sync"
+    EVENTS_FLUSH_SIZE: int = 500
+    EVENTS_FLUSH_INTERVAL_MS: int = 200
+    # buffered: máximo de eventos sin escribir (con la BD caída, los nuevos reciben 503; 0 = sin
+    # límite) y fichero ndjson al que van las filas que la BD rechaza (FK, tipos)
+    EVENTS_BUFFER_MAX: int = 100000
+    EVENTS_DEAD_LETTER: str = "./events-dead-letter.ndjson"
+    # segundos que se conservan en memoria los catálogos (0 = hasta POST /api/catalog/reload)
+    CATALOG_TTL_S: int = 300
+    # historial en memoria para /api/events: eventos por dispositivo y máximo de dispositivos
+    EVENTS_HISTORY_DEPTH: int = 50
+    EVENTS_HISTORY_MAX_DEVICES: int = 1000
+    # tamaño máximo de página de /api/events/{id}/history
+    HISTORY_PAGE_MAX: int = 200
+    # filas leídas por lote en /api/events/{id}/export
+    EXPORT_CHUNK_SIZE: int = 1000
+    # exports simultáneos: cada uno retiene una conexión del pool mientras dura, así que se
+    # limitan a menos de DB_POOL_SIZE (los que no caben reciben 503)
+    EXPORT_MAX_CONCURRENT: int = 2
+    # máximo de comandos por petición en /api/events/batch
+    BATCH_MAX_COMMANDS: int = 1000
+    # cada cuántos segundos se escriben en EstadisticasDispositivo los rollups acumulados
+    STATS_FLUSH_INTERVAL_S: int = 60
+    # retención de Events: días que se conservan en la tabla (0 = no se archiva nada); las filas
+    # más antiguas se mueven cada ARCHIVE_INTERVAL_S a segmentos comprimidos en ARCHIVE_DIR
+    EVENTS_HOT_DAYS: int = 0
+    ARCHIVE_DIR: str = "./archive"
+    ARCHIVE_INTERVAL_S: int = 3600
+    ARCHIVE_FILE_ROWS: int = 100000
+    # filas archivadas ya descomprimidas que se guardan en memoria para historial y paginación
+    # (el export no pasa por esta caché)
+    ARCHIVE_CACHE_ROWS: int = 100000
+    # Events particionada por mes en MySQL (ver archive.py): el archivado mantiene las particiones
+    EVENTS_PARTITIONED: bool = False
+    # duración por defecto de cada paso de una secuencia (los pasos pueden fijar su propio "ms")
+    SEQUENCE_STEP_MS: int = 1000
+    # obstáculos: journal en disco de los pendientes de escribir y espera máxima entre reintentos
+    OBSTACLE_JOURNAL_DIR: str = "./obstacle-journal"
+    OBSTACLE_RETRY_MAX_S: float = 30.0
+    # idempotencia de move/speed/obstaculo: claves recordadas como máximo y segundos que se recuerdan
+    IDEMPOTENCY_MAX_KEYS: int = 100000
+    IDEMPOTENCY_TTL_S: float = 300.0
+    # comandos de move/speed por carro (ver coalescer.py): ventana en la que se fusionan (gana el
+    # último) y token bucket de escrituras; 0 desactiva cada mecanismo. Sin ventana, los comandos
+    # que superan el límite se rechazan con 429
+    COMMAND_COALESCE_MS: int = 100
+    COMMAND_RATE_PER_S: float = 10.0
+    COMMAND_BURST: int = 20
+    # WebSocket: tamaño máximo de la cola de salida por cliente y qué hacer al llenarse
+    # (drop_oldest | coalesce | disconnect)
+    WS_QUEUE_SIZE: int = 100
+    WS_OVERFLOW_POLICY: str = "drop_oldest"
+    # latidos WebSocket: a una conexión de la que no se recibe nada en WS_PING_INTERVAL_S se le envía
+    # un ping de aplicación que debe responder; se cierra tras WS_PING_INTERVAL_S + WS_PING_TIMEOUT_S
+    # sin recibir nada (0 = sin latidos / sin cierre). El ping del protocolo lo hace uvicorn: con su
+    # CLI estos valores no se aplican solos, hay que pasar --ws-ping-interval y --ws-ping-timeout
+    WS_PING_INTERVAL_S: float = 20.0
+    WS_PING_TIMEOUT_S: float = 20.0
+    # monitores en modo tick (/ws/monitor?modo=tick): cada cuántos ms reciben un frame agrupado
+    WS_TICK_MS: int = 50
+    # reanudación de /ws/monitor (?since=id_evento): frames recientes que se guardan en memoria y
+    # máximo de eventos que se leen de la BD cuando el hueco es más antiguo (si hay más, snapshot)
+    WS_REPLAY_SIZE: int = 10000
+    WS_REPLAY_DB_MAX: int = 1000
+    # reparto de broadcasts entre procesos: memory (un proceso) | unix (varios workers, misma
+    # máquina) | redis (varios nodos)
+    EVENT_BUS: str = "memory"
+    EVENT_BUS_PATH: str = "/tmp/carro-iot-bus"
+    EVENT_BUS_REDIS_URL: str = "redis://localhost:6379/0"
+    EVENT_BUS_CHANNEL: str = "carro-iot:eventos"
+    # métricas Prometheus en /metrics
+    METRICS_ENABLED: bool = True
     APP_HOST: str = "0.0.0.0"
     APP_PORT: int = 5500
     # SECRET_API_KEY removed — API key authentication disabled for this demo
 
+    @model_validator(mode="after")
+    def _check_durability(self):
+        # el write-behind numera los eventos en memoria a partir de MAX(id_evento): dos procesos
+        # repartirían los mismos ids
+        if self.EVENTS_DURABILITY == "buffered" and self.EVENT_BUS != "memory":
+            raise ValueError(f"EVENTS_DURABILITY=buffered requiere un solo proceso (EVENT_BUS=memory, no {self.EVENT_BUS})")
+        return self
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
@@ -1,18 +1,181 @@
-from sqlalchemy import create_engine, text
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import and_, create_engine, insert, or_, select, text
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import DataError, IntegrityError, SQLAlchemyError
 from .models import Base, Events, Dispositivos, ClientesIoT, Operations, Obstaculos, Velocidades
 from .config import settings
-from datetime import datetime
+from . import metrics
+from .event_buffer import EventBuffer, EventBufferFull
+from .catalog import Catalog
+from .device_state import DeviceStateStore
+from .event_history import EventHistory
+from .stats import StatsAggregator
+from .sequences import SequenceStore
+from .obstacle_lane import ObstacleLane
+from .archive import EventArchive, archive_cold_events as _archive_cold_events, maintain_partitions
+from datetime import datetime, timedelta
+from itertools import islice
 
-DB_URL = f"mysql+pymysql://{settings.DB_USER}:{settings.DB_PASSWORD}@{settings.DB_HOST}:{settings.DB_PORT}/{settings.DB_NAME}"
-engine = create_engine(DB_URL, pool_pre_ping=True)
+logger = logging.getLogger(__name__)
+
+DB_URL = settings.DB_URL or f"mysql+pymysql://{settings.DB_USER}:{settings.DB_PASSWORD}@{settings.DB_HOST}:{settings.DB_PORT}/{settings.DB_NAME}"
+if DB_URL.startswith("sqlite"):
+    # SQLite local (pruebas): las sesiones se usan desde los hilos del executor
+    engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
+else:
+    engine = create_engine(DB_URL, pool_pre_ping=True, pool_size=settings.DB_POOL_SIZE, max_overflow=0)
 SessionLocal = sessionmaker(bind=engine)
 
 # (opcional) crear tablas si no existen
 # Base.metadata.create_all(bind=engine)
 
+# catálogos (Operations, Obstaculos, Velocidades) en memoria
+catalog = Catalog(SessionLocal, settings.CATALOG_TTL_S)
+_EVENT_COLUMNS = ("id_evento", "id_dispositivo", "id_cliente", "id_operacion", "id_obstaculo", "id_velocidad", "fecha_hora")
+
+# último estado por dispositivo, alimentado por todas las escrituras de Events
+device_state = DeviceStateStore()
+
+# últimos eventos por dispositivo para /api/events
+event_history = EventHistory(settings.EVENTS_HISTORY_DEPTH, settings.EVENTS_HISTORY_MAX_DEVICES)
+
+# rollups por dispositivo y hora/día para /api/stats (ver stats.py)
+stats = StatsAggregator(SessionLocal)
+
+# eventos fuera de la ventana caliente (ver archive.py); se lee siempre, aunque el archivado
+# esté desactivado, para no perder lo ya archivado
+event_archive = EventArchive(settings.ARCHIVE_DIR, settings.ARCHIVE_CACHE_ROWS)
+
+# definiciones de secuencias (deduplicadas por contenido) en memoria
+sequences = SequenceStore(SessionLocal)
+
+# write-behind opcional para Events (ver EventBuffer); None = escritura síncrona
+event_buffer = None
+if settings.EVENTS_DURABILITY == "buffered":
+    # (las filas que la BD rechaza por FK o tipo no se reintentan: van a EVENTS_DEAD_LETTER)
+    event_buffer = EventBuffer(SessionLocal, settings.EVENTS_FLUSH_SIZE, settings.EVENTS_FLUSH_INTERVAL_MS / 1000,
+                               max_pending=settings.EVENTS_BUFFER_MAX, permanent_errors=(IntegrityError, DataError),
+                               dead_letter=settings.EVENTS_DEAD_LETTER, on_discard=metrics.events_dead_letters.inc)
+elif settings.EVENTS_DURABILITY != "sync":
+    raise ValueError(f"EVENTS_DURABILITY inválido: {settings.EVENTS_DURABILITY}")
+
+# obstáculos difundidos y aún no escritos en Events (ver obstacle_lane)
+# (las filas que la BD rechaza por FK o tipo no se reintentan: van a su dead-letter)
+obstacle_lane = ObstacleLane(settings.OBSTACLE_JOURNAL_DIR, settings.OBSTACLE_RETRY_MAX_S,
+                             permanent_errors=(IntegrityError, DataError))
+
+metrics.registry.register(metrics.Gauge("db_pool_checked_out", "Conexiones del pool en uso", func=lambda: engine.pool.checkedout() if hasattr(engine.pool, "checkedout") else 0))
+metrics.registry.register(metrics.Gauge("events_buffer_pending", "Eventos en el buffer write-behind pendientes de escribir",
+                                        func=lambda: event_buffer.pending() if event_buffer is not None else 0))
+metrics.registry.register(metrics.Gauge("obstacle_pending", "Obstáculos difundidos pendientes de escribir en la BD",
+                                        func=obstacle_lane.pending))
+
+# Las funciones de este módulo son síncronas (SQLAlchemy + PyMySQL). Los endpoints async
+# no deben llamarlas directamente: usan run_in_db, que las ejecuta en un pool de hilos
+# acotado al tamaño del pool de conexiones para no bloquear el event loop.
+_db_executor = ThreadPoolExecutor(max_workers=settings.DB_POOL_SIZE, thread_name_prefix="db")
+
+
+async def run_in_db(func, *args, **kwargs):
+    """Run a blocking crud function in the DB executor and await its result."""
+    loop = asyncio.get_running_loop()
+    if not metrics.registry.enabled:
+        return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+    name = getattr(func, "__qualname__", "desconocida")
+    submitted = time.perf_counter()
+
+    def timed():
+        started = time.perf_counter()
+        metrics.db_executor_wait_seconds.observe(started - submitted)
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            metrics.db_call_errors.inc(name)
+            raise
+        finally:
+            metrics.db_call_seconds.observe(time.perf_counter() - started, name)
+
+    return await loop.run_in_executor(_db_executor, timed)
+
+
+# callbacks(evento) for every event written by this process (main shares them with the other
+# workers through the event bus)
+record_listeners: list = []
+
+
+def _record(evento: dict):
+    """Propagate a persisted (or buffered) event to the in-memory read models."""
+    device_state.update(evento)
+    event_history.append(evento)
+    stats.record(evento)
+    for listener in record_listeners:
+        listener(evento)
+
+
+def record_remote(eventos: list[dict]):
+    """Apply events written by another worker/node to the in-memory read models. Their counts
+    go to the stats table from the worker that wrote them; here a speed change only hands the
+    time-at-speed accounting of that device over to it.
+    """
+    for evento in eventos:
+        device_state.update(evento)
+        event_history.append(evento)
+        stats.release_speed(evento)
+
+
+def warm_device_state(own_speeds: bool = True):
+    """Load the latest state of every device. With `own_speeds` this process also accounts the
+    time at the current speed of every device from now on (only one worker may do so).
+    """
+    device_state.warm(SessionLocal, event_data)
+    if not own_speeds:
+        return
+    # la velocidad vigente de cada carro cuenta para las estadísticas desde el arranque
+    velocidades = {}
+    for id_dispositivo in device_state.devices():
+        velocidad = device_state.get(id_dispositivo)["velocidad"]
+        if velocidad is not None:
+            velocidades[id_dispositivo] = velocidad["id_velocidad"]
+    stats.warm(velocidades, datetime.utcnow())
+
+
+def archive_cold_events() -> int:
+    """Move events older than EVENTS_HOT_DAYS to the archive (and maintain MySQL partitions)."""
+    if settings.EVENTS_HOT_DAYS <= 0:
+        return 0
+    cutoff = datetime.utcnow() - timedelta(days=settings.EVENTS_HOT_DAYS)
+    archived = _archive_cold_events(SessionLocal, event_archive, cutoff, settings.ARCHIVE_FILE_ROWS)
+    if settings.EVENTS_PARTITIONED and engine.dialect.name == "mysql":
+        maintain_partitions(engine, cutoff)
+    return archived
+
+
+def shutdown_db():
+    """Wait for pending DB work, flush buffered events and release pooled connections."""
+    _db_executor.shutdown(wait=True)
+    try:
+        if event_buffer is not None:
+            event_buffer.flush()
+    except Exception:
+        # BD caída al cerrar: lo que quede en el buffer se pierde, pero el resto se cierra igual
+        logger.exception("Se pierden %d eventos del buffer sin escribir", event_buffer.pending())
+    try:
+        stats.flush()
+    finally:
+        engine.dispose()
+
 def add_movement(id_dispositivo:int, id_cliente:int, id_operacion:int, id_obstaculo:int|None=None):
+    if event_buffer is not None:
+        # modo buffered: el evento (no adjunto a ninguna sesión) se escribe en el próximo lote
+        row = event_buffer.append(id_dispositivo=id_dispositivo, id_cliente=id_cliente,
+                                  id_operacion=id_operacion, id_obstaculo=id_obstaculo)
+        _record(event_data(row))
+        return Events(**row)
     session = SessionLocal()
     try:
         evento = Events(
@@ -25,6 +188,7 @@ def add_movement(id_dispositivo:int, id_cliente:int, id_operacion:int, id_obstac
         session.add(evento)
         session.commit()
         session.refresh(evento)
+        _record(event_data(evento))
         return evento
     except SQLAlchemyError as e:
         session.rollback()
@@ -35,76 +199,239 @@ def add_movement(id_dispositivo:int, id_cliente:int, id_operacion:int, id_obstac
 def get_last_event(id_dispositivo:int):
     session = SessionLocal()
     try:
-        return session.query(Events).filter(Events.id_dispositivo == id_dispositivo).order_by(Events.fecha_hora.desc()).first()
+        return session.query(Events).filter(Events.id_dispositivo == id_dispositivo).order_by(Events.fecha_hora.desc(), Events.id_evento.desc()).first()
     finally:
         session.close()
 
 def get_last_n_events(id_dispositivo:int, n:int=10):
     session = SessionLocal()
     try:
-        return session.query(Events).filter(Events.id_dispositivo == id_dispositivo).order_by(Events.fecha_hora.desc()).limit(n).all()
+        return session.query(Events).filter(Events.id_dispositivo == id_dispositivo).order_by(Events.fecha_hora.desc(), Events.id_evento.desc()).limit(n).all()
     finally:
         session.close()
 
 
+def event_data(evento) -> dict:
+    """Event as dict with catalog texts resolved in memory. Accepts an Events object or a row dict."""
+    if isinstance(evento, dict):
+        values = evento
+    else:
+        values = {c: getattr(evento, c) for c in _EVENT_COLUMNS}
+    catalog.ensure()
+    operacion_texto, obstaculo_texto, velocidad_texto = catalog.resolve(values.get("id_operacion"), values.get("id_obstaculo"), values.get("id_velocidad"))
+    return {
+        "id_evento": values.get("id_evento"),
+        "id_dispositivo": values.get("id_dispositivo"),
+        "id_cliente": values.get("id_cliente"),
+        "id_operacion": values.get("id_operacion"),
+        "operacion_texto": operacion_texto,
+        "id_obstaculo": values.get("id_obstaculo"),
+        "obstaculo_texto": obstaculo_texto,
+        "id_velocidad": values.get("id_velocidad"),
+        "velocidad_texto": velocidad_texto,
+        "fecha_hora": values.get("fecha_hora")
+    }
+
+
 def get_last_event_data(id_dispositivo:int):
     session = SessionLocal()
     try:
-        row = session.query(Events, Operations, Obstaculos, Velocidades).outerjoin(Obstaculos, Events.id_obstaculo == Obstaculos.id_obstaculo).outerjoin(Velocidades, Events.__table__.c.get('id_velocidad') == Velocidades.id_velocidad).join(Operations, Events.id_operacion == Operations.id_operation).filter(Events.id_dispositivo == id_dispositivo).order_by(Events.fecha_hora.desc()).first()
-        if not row:
-            return None
-        evento, operacion, obstaculo, velocidad = row
-        return {
-            "id_evento": evento.id_evento,
-            "id_dispositivo": evento.id_dispositivo,
-            "id_cliente": evento.id_cliente,
-            "id_operacion": evento.id_operacion,
-            "operacion_texto": operacion.status_texto if operacion else None,
-            "id_obstaculo": evento.id_obstaculo,
-            "obstaculo_texto": obstaculo.status_texto if obstaculo else None,
-            "id_velocidad": velocidad.id_velocidad if velocidad else None,
-            "velocidad_texto": velocidad.descripcion if velocidad else None,
-            "fecha_hora": evento.fecha_hora
-        }
+        evento = session.query(Events).filter(Events.id_dispositivo == id_dispositivo).order_by(Events.fecha_hora.desc(), Events.id_evento.desc()).first()
+        return event_data(evento) if evento else None
     finally:
         session.close()
 
 
 def get_last_n_events_data(id_dispositivo:int, n:int=10):
+    """Last `n` events of the device, from the in-memory ring buffer when it holds enough
+    history; otherwise from the DB (which also refills the buffer).
+    """
+    records = event_history.latest(id_dispositivo, n)
+    if records is not None:
+        return [event_data(record) for record in records]
+    limit = max(n, event_history.depth)
     session = SessionLocal()
     try:
-        rows = session.query(Events, Operations, Obstaculos, Velocidades).outerjoin(Obstaculos, Events.id_obstaculo == Obstaculos.id_obstaculo).outerjoin(Velocidades, Events.__table__.c.get('id_velocidad') == Velocidades.id_velocidad).join(Operations, Events.id_operacion == Operations.id_operation).filter(Events.id_dispositivo == id_dispositivo).order_by(Events.fecha_hora.desc()).limit(n).all()
-        results = []
-        for row in rows:
-            evento, operacion, obstaculo, velocidad = row
-            results.append({
-                "id_evento": evento.id_evento,
-                "id_dispositivo": evento.id_dispositivo,
-                "id_cliente": evento.id_cliente,
-                "id_operacion": evento.id_operacion,
-                "operacion_texto": operacion.status_texto if operacion else None,
-                "id_obstaculo": evento.id_obstaculo,
-                "obstaculo_texto": obstaculo.status_texto if obstaculo else None,
-                "id_velocidad": velocidad.id_velocidad if velocidad else None,
-                "velocidad_texto": velocidad.descripcion if velocidad else None,
-                "fecha_hora": evento.fecha_hora
-            })
-        return results
+        eventos = session.query(Events).filter(Events.id_dispositivo == id_dispositivo).order_by(Events.fecha_hora.desc(), Events.id_evento.desc()).limit(limit).all()
     finally:
         session.close()
+    if len(eventos) < limit:
+        # el resto de la historia, si existe, está archivado
+        eventos += islice(event_archive.events(id_dispositivo, reverse=True), limit - len(eventos))
+    records = event_history.load(id_dispositivo, eventos, complete=len(eventos) < limit)
+    return [event_data(record) for record in records[:n]]
+
+
+def get_events_since(since:int, dispositivos:list[int]|None=None, limit:int=1000):
+    """Events with id_evento greater than `since` (oldest first, primary key order), optionally
+    restricted to some devices. Used to resume monitors whose gap is older than the replay log.
+    """
+    session = SessionLocal()
+    try:
+        query = session.query(Events).filter(Events.id_evento > since)
+        if dispositivos:
+            query = query.filter(Events.id_dispositivo.in_(dispositivos))
+        eventos = query.order_by(Events.id_evento.asc()).limit(limit).all()
+    finally:
+        session.close()
+    return [event_data(evento) for evento in eventos]
+
+
+def get_events_page(id_dispositivo:int, before_id:int|None=None, after_id:int|None=None,
+                    desde:datetime|None=None, hasta:datetime|None=None, limit:int=50):
+    """Keyset-paginated history ordered by (fecha_hora, id_evento) descending.
+    `before_id` pages towards older events and `after_id` towards newer ones; the cursor
+    event must belong to the device. Uses index ix_events_dispositivo_fecha_evento, so
+    every page costs the same regardless of depth. Pages reaching past the hot window
+    continue into the archive (archived events are always older than those in the table).
+    Returns (events as dicts, has_more).
+    """
+    if before_id is not None and after_id is not None:
+        raise ValueError("Use before_id o after_id, no ambos")
+    ascending = after_id is not None
+    cursor = None
+    session = SessionLocal()
+    try:
+        query = session.query(Events).filter(Events.id_dispositivo == id_dispositivo)
+        if desde is not None:
+            query = query.filter(Events.fecha_hora >= desde)
+        if hasta is not None:
+            query = query.filter(Events.fecha_hora <= hasta)
+        cursor_id = before_id if before_id is not None else after_id
+        cursor_archived = False
+        if cursor_id is not None:
+            cursor_fecha = session.query(Events.fecha_hora).filter(Events.id_evento == cursor_id, Events.id_dispositivo == id_dispositivo).scalar()
+            if cursor_fecha is None:
+                archived = event_archive.find(id_dispositivo, cursor_id)
+                cursor_fecha, cursor_archived = (archived.fecha_hora, True) if archived else (None, False)
+            if cursor_fecha is None:
+                raise ValueError(f"id_evento {cursor_id} no existe para el dispositivo {id_dispositivo}")
+            cursor = (cursor_fecha, cursor_id)
+            if before_id is not None:
+                query = query.filter(or_(Events.fecha_hora < cursor_fecha, and_(Events.fecha_hora == cursor_fecha, Events.id_evento < cursor_id)))
+            else:
+                query = query.filter(or_(Events.fecha_hora > cursor_fecha, and_(Events.fecha_hora == cursor_fecha, Events.id_evento > cursor_id)))
+        if ascending:
+            eventos = query.order_by(Events.fecha_hora.asc(), Events.id_evento.asc()).limit(limit + 1).all()
+        else:
+            eventos = query.order_by(Events.fecha_hora.desc(), Events.id_evento.desc()).limit(limit + 1).all()
+    finally:
+        session.close()
+    # hacia atrás el archivo continúa donde se agota la tabla; hacia adelante solo importa si
+    # el cursor está archivado
+    if (cursor_archived if ascending else len(eventos) <= limit):
+        eventos = _with_archived(eventos, id_dispositivo, desde, hasta, cursor, ascending, limit + 1)
+    has_more = len(eventos) > limit
+    eventos = eventos[:limit]
+    if ascending:
+        eventos.reverse()
+    return [event_data(evento) for evento in eventos], has_more
+
+
+def _with_archived(eventos:list, id_dispositivo:int, desde, hasta, cursor, ascending:bool, limit:int) -> list:
+    """Merge a page read from the table with the archived events that follow the cursor."""
+    if cursor is not None:
+        if ascending:
+            desde = max(desde, cursor[0]) if desde else cursor[0]
+        else:
+            hasta = min(hasta, cursor[0]) if hasta else cursor[0]
+    archived = event_archive.events(id_dispositivo, desde, hasta, reverse=not ascending)
+    if cursor is not None:
+        archived = (r for r in archived if ((r.fecha_hora, r.id_evento) > cursor if ascending else (r.fecha_hora, r.id_evento) < cursor))
+    # las filas de la tabla prevalecen sobre un duplicado archivado (borrado interrumpido)
+    merged = {r.id_evento: r for r in islice(archived, limit)}
+    merged.update((evento.id_evento, evento) for evento in eventos)
+    return sorted(merged.values(), key=lambda e: (e.fecha_hora, e.id_evento), reverse=not ascending)[:limit]
+
+
+class ExportBusy(Exception):
+    """Already EXPORT_MAX_CONCURRENT exports running."""
+
+
+# each running export holds a pool connection for as long as it streams (outside the DB
+# executor); at least one connection is always left for everything else
+_export_slots = threading.BoundedSemaphore(max(1, min(settings.EXPORT_MAX_CONCURRENT, settings.DB_POOL_SIZE - 1)))
+
+
+def iter_events(id_dispositivo:int, desde:datetime|None=None, hasta:datetime|None=None, chunk_size:int=1000):
+    """Stream a device's events (oldest first) in chunks of dicts without materializing the result.
+    Archived events come first (one segment at a time), then the table through a server-side
+    cursor (stream_results), so memory stays constant whatever the range size.
+    Takes an export slot when iteration starts; raises ExportBusy if none is free.
+    """
+    if not _export_slots.acquire(blocking=False):
+        raise ExportBusy()
+    try:
+        yield from _iter_events(id_dispositivo, desde, hasta, chunk_size)
+    finally:
+        _export_slots.release()
+
+
+def _iter_events(id_dispositivo:int, desde, hasta, chunk_size:int):
+    last = None
+    chunk = []
+    for record in event_archive.events(id_dispositivo, desde, hasta, cache=False):
+        chunk.append(event_data(record))
+        last = record
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+    stmt = select(*(getattr(Events, c) for c in _EVENT_COLUMNS)).where(Events.id_dispositivo == id_dispositivo)
+    if desde is not None:
+        stmt = stmt.where(Events.fecha_hora >= desde)
+    if hasta is not None:
+        stmt = stmt.where(Events.fecha_hora <= hasta)
+    if last is not None:
+        # sin duplicados si un borrado de archivado quedó a medias
+        stmt = stmt.where(or_(Events.fecha_hora > last.fecha_hora, and_(Events.fecha_hora == last.fecha_hora, Events.id_evento > last.id_evento)))
+    stmt = stmt.order_by(Events.fecha_hora.asc(), Events.id_evento.asc())
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(stmt)
+        for partition in result.partitions():
+            yield [event_data(row) for row in partition]
+
+
+def get_device_stats(id_dispositivo:int, periodo:str, desde:datetime, hasta:datetime):
+    """Per-bucket rollups for a device (oldest bucket first), with catalog texts.
+    Reads EstadisticasDispositivo plus unflushed deltas; never scans Events.
+    """
+    catalog.ensure()
+    buckets = stats.query(id_dispositivo, periodo, desde, hasta)
+    result = []
+    for inicio in sorted(buckets):
+        metricas = buckets[inicio]
+        result.append({
+            "inicio": inicio,
+            "operaciones": [{"id_operacion": k, "texto": catalog.operaciones.get(k), "total": int(v)}
+                            for k, v in sorted(metricas.get("operacion", {}).items())],
+            "obstaculos": [{"id_obstaculo": k, "texto": catalog.obstaculos.get(k), "total": int(v)}
+                           for k, v in sorted(metricas.get("obstaculo", {}).items())],
+            "velocidades": [{"id_velocidad": k, "texto": catalog.resolve(None, None, k)[2], "segundos": round(v, 3)}
+                            for k, v in sorted(metricas.get("velocidad_seg", {}).items())]
+        })
+    return result
 
 
 def register_velocity(id_dispositivo:int, id_cliente:int, id_velocidad:int):
-    """Insert an event recording a speed change. Uses direct SQL INSERT so we don't need to modify ORM models.
-    Returns the inserted event as dict via get_last_event_data.
+    """Insert an event recording a speed change.
+    Returns the inserted event as dict (see event_data).
     """
+    if event_buffer is not None:
+        data = event_data(event_buffer.append(id_dispositivo=id_dispositivo, id_cliente=id_cliente, id_operacion=1, id_velocidad=id_velocidad))
+        _record(data)
+        return data
     session = SessionLocal()
     try:
         # use operation 1 (Adelante) as base per stored-procedure convention
-        session.execute(text("INSERT INTO Events (id_dispositivo, id_cliente, id_operacion, id_velocidad, fecha_hora) VALUES (:d, :c, :op, :v, NOW())"), {"d": id_dispositivo, "c": id_cliente, "op": 1, "v": id_velocidad})
+        evento = Events(id_dispositivo=id_dispositivo, id_cliente=id_cliente, id_operacion=1, id_velocidad=id_velocidad, fecha_hora=datetime.utcnow())
+        session.add(evento)
         session.commit()
-        # return the most recent event for that device
-        return get_last_event_data(id_dispositivo)
+        session.refresh(evento)
+        data = event_data(evento)
+        _record(data)
+        return data
     except SQLAlchemyError:
         session.rollback()
         raise
@@ -112,19 +439,45 @@ def register_velocity(id_dispositivo:int, id_cliente:int, id_velocidad:int):
         session.close()
 
 
-def save_sequence(nombre: str, movimientos_json: str, id_cliente: int = 1):
-    """Save a sequence to SecuenciasDemo table.
-    Returns the sequence ID (id_secuencia).
+def _autoinc_settings(session) -> tuple[int, int]:
+    """(auto_increment_increment, innodb_autoinc_lock_mode) of the session's MySQL connection,
+    read once per pooled connection.
     """
+    info = session.connection().info
+    if "autoinc" not in info:
+        step, lock_mode = session.execute(text("SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode")).one()
+        info["autoinc"] = (int(step), int(lock_mode))
+    return info["autoinc"]
+
+
+def _insert_events(session, rows: list[dict]) -> list[int]:
+    """Insert several Events rows with a single multi-row INSERT and return their ids."""
+    stmt = insert(Events).values(rows)
+    if session.get_bind().dialect.insert_returning:
+        return sorted(session.execute(stmt.returning(Events.id_evento)).scalars())
+    step, lock_mode = _autoinc_settings(session)
+    if lock_mode == 2 and len(rows) > 1:
+        # modo "interleaved": los ids de un INSERT multi-fila pueden intercalarse con los de
+        # inserciones concurrentes, así que no se pueden deducir del primero; fila a fila,
+        # en la misma transacción, cada LAST_INSERT_ID() es exacto
+        return [session.execute(insert(Events).values(row)).lastrowid for row in rows]
+    # MySQL: LAST_INSERT_ID() de un INSERT multi-fila es el id de la primera fila; con
+    # innodb_autoinc_lock_mode 0 o 1 un "simple insert" reserva todos sus ids de una vez,
+    # separados por auto_increment_increment
+    first_id = session.execute(stmt).lastrowid
+    return list(range(first_id, first_id + len(rows) * step, step))
+
+
+def _write_events(rows: list[dict]):
+    """Insert `rows` in their own transaction, filling in id_evento (unless already assigned)."""
     session = SessionLocal()
     try:
-        session.execute(text(
-            "INSERT INTO SecuenciasDemo (nombre_secuencia, movimientos, activa) VALUES (:n, :m, 1)"
-        ), {"n": nombre, "m": movimientos_json})
+        if all("id_evento" in row for row in rows):
+            session.execute(insert(Events), rows)
+        else:
+            for row, id_evento in zip(rows, _insert_events(session, rows)):
+                row["id_evento"] = id_evento
         session.commit()
-        # get the last inserted id
-        result = session.execute(text("SELECT LAST_INSERT_ID() as id")).fetchone()
-        return result[0] if result else None
     except SQLAlchemyError:
         session.rollback()
         raise
@@ -132,20 +485,69 @@ def save_sequence(nombre: str, movimientos_json: str, id_cliente: int = 1):
         session.close()
 
 
-def execute_sequence(movimientos: list, id_dispositivo: int, id_cliente: int):
-    """Execute a sequence: insert an event for each operation in movimientos.
-    Returns list of inserted event dicts.
+def add_events_batch(rows: list[dict]):
+    """Insert several events (dicts with id_dispositivo, id_cliente, id_operacion and optional
+    id_obstaculo/id_velocidad/fecha_hora) in one transaction. Returns them as dicts (see event_data), in order.
     """
-    eventos = []
-    try:
-        for id_operacion in movimientos:
-            evento = add_movement(id_dispositivo, id_cliente, id_operacion, None)
-            eventos.append({
-                "id_evento": evento.id_evento,
-                "id_operacion": evento.id_operacion,
-                "id_dispositivo": evento.id_dispositivo,
-                "fecha_hora": evento.fecha_hora.isoformat() if evento.fecha_hora else None
-            })
-        return eventos
-    except SQLAlchemyError:
-        raise
+    fecha_hora = datetime.utcnow()
+    rows = [{"id_obstaculo": None, "id_velocidad": None, **row} for row in rows]
+    if event_buffer is not None:
+        rows = [event_buffer.append(**row) for row in rows]
+    else:
+        for row in rows:
+            row.setdefault("fecha_hora", fecha_hora)
+        _write_events(rows)
+    eventos = [event_data(row) for row in rows]
+    for evento in eventos:
+        _record(evento)
+    return eventos
+
+
+def _stored_instants(fecha_hora: datetime) -> set:
+    """Values `fecha_hora` may have been stored as: exact, or without the fractional seconds
+    (a MySQL DATETIME column rounds them, or truncates them with TIME_TRUNCATE_FRACTIONAL)."""
+    segundo = fecha_hora.replace(microsecond=0)
+    return {fecha_hora, segundo, segundo + timedelta(seconds=1) if fecha_hora.microsecond >= 500000 else segundo}
+
+
+def persist_obstacles(items: list[dict]) -> list[dict]:
+    """Write fast-lane obstacle events (see obstacle_lane) in one transaction, keeping their
+    fecha_hora. Always a direct write, even with EVENTS_DURABILITY=buffered: the lane drops an
+    obstacle from its journal once this returns, so it must already be in Events (in buffered
+    mode the ids are reserved from the buffer's numbering to avoid clashing with it).
+    Items recovered from a journal are first matched against existing rows, so a crash between
+    the write and the journal cleanup does not duplicate them; each row is claimed by at most
+    one item. Returns the events as dicts (see event_data), in order.
+    """
+    existing = {}
+    recovered = sorted((item for item in items if item.get("recuperado")), key=lambda item: item["fecha_hora"])
+    if recovered:
+        claimed = set()
+        session = SessionLocal()
+        try:
+            for item in recovered:
+                # la misma fecha_hora con la que se escribió; dos obstáculos del mismo carro en
+                # el mismo segundo no se distinguen sin microsegundos, pero cada fila cuenta una vez
+                evento = session.query(Events).filter(
+                    Events.id_dispositivo == item["id_dispositivo"], Events.id_operacion == item["id_operacion"],
+                    Events.id_obstaculo == item["id_obstaculo"],
+                    Events.fecha_hora.in_(list(_stored_instants(item["fecha_hora"]))),
+                    Events.id_evento.notin_(list(claimed))).order_by(Events.id_evento).first()
+                if evento is not None:
+                    claimed.add(evento.id_evento)
+                    existing[item["id_provisional"]] = event_data(evento)
+        finally:
+            session.close()
+    fields = ("id_dispositivo", "id_cliente", "id_operacion", "id_obstaculo", "fecha_hora")
+    rows = [{"id_velocidad": None, **{f: item[f] for f in fields}}
+            for item in items if item["id_provisional"] not in existing]
+    if rows:
+        if event_buffer is not None:
+            for row, id_evento in zip(rows, event_buffer.reserve_ids(len(rows))):
+                row["id_evento"] = id_evento
+        _write_events(rows)
+    eventos = [event_data(row) for row in rows]
+    for evento in eventos:
+        _record(evento)
+    written = iter(eventos)
+    return [existing.get(item["id_provisional"]) or next(written) for item in items]
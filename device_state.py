@@ -0,0 +1,64 @@
+import threading
+from sqlalchemy import func, select
+from .models import Events
+
+
+class DeviceStateStore:
+    """Último estado conocido de cada dispositivo, actualizado en cada escritura de Events.
+
+    Por dispositivo guarda el último evento (con textos del catálogo), la última velocidad
+    configurada y el último obstáculo. Se precarga desde la BD al arrancar (warm) para que
+    /api/last no consulte la BD. Cada proceso mantiene su propia copia.
+    """
+
+    def __init__(self):
+        self._states: dict[int, dict] = {}
+        self._lock = threading.Lock()
+        self.warmed = False
+
+    def update(self, evento: dict):
+        """Aplica un evento (dict de crud.event_data) si es más reciente que el estado actual."""
+        id_dispositivo = evento["id_dispositivo"]
+        with self._lock:
+            state = self._states.get(id_dispositivo)
+            if state is None:
+                state = self._states[id_dispositivo] = {"evento": None, "velocidad": None, "obstaculo": None}
+            _apply(state, evento)
+
+    def get(self, id_dispositivo: int) -> dict | None:
+        return self._states.get(id_dispositivo)
+
+    def devices(self) -> list[int]:
+        return list(self._states)
+
+    def last_id(self) -> int:
+        """Mayor id_evento conocido (0 si no hay eventos)."""
+        with self._lock:
+            return max((state["evento"]["id_evento"] for state in self._states.values() if state["evento"]), default=0)
+
+    def warm(self, session_factory, event_data):
+        """Carga el último evento, la última velocidad y el último obstáculo de cada dispositivo."""
+        session = session_factory()
+        try:
+            latest = []
+            for condition in (None, Events.id_velocidad.isnot(None), Events.id_obstaculo.isnot(None)):
+                ids = select(func.max(Events.id_evento)).group_by(Events.id_dispositivo)
+                if condition is not None:
+                    ids = ids.where(condition)
+                latest.extend(session.query(Events).filter(Events.id_evento.in_(ids.scalar_subquery())).all())
+            eventos = [event_data(evento) for evento in latest]
+        finally:
+            session.close()
+        for evento in sorted(eventos, key=lambda ev: ev["id_evento"]):
+            self.update(evento)
+        self.warmed = True
+
+
+def _apply(state: dict, evento: dict):
+    last = state["evento"]
+    if last is None or evento["id_evento"] >= last["id_evento"]:
+        state["evento"] = evento
+    if evento.get("id_velocidad") is not None and (state["velocidad"] is None or evento["id_evento"] >= state["velocidad"]["id_evento"]):
+        state["velocidad"] = evento
+    if evento.get("id_obstaculo") is not None and (state["obstaculo"] is None or evento["id_evento"] >= state["obstaculo"]["id_evento"]):
+        state["obstaculo"] = evento
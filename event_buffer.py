@@ -0,0 +1,148 @@
+import asyncio
+import json
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import func, insert, select
+from .models import Events
+
+logger = logging.getLogger(__name__)
+
+
+class EventBufferFull(Exception):
+    """Hay `max_pending` eventos sin escribir (BD caída o lenta); el evento no se aceptó."""
+
+
+class EventBuffer:
+    """Write-behind de la tabla Events (EVENTS_DURABILITY=buffered).
+
+    Los eventos reciben id_evento y fecha_hora en memoria, se devuelven de inmediato y se
+    insertan por lotes (un INSERT multi-fila por transacción) al llegar a `flush_size`
+    filas o cada `flush_interval` segundos. Los ids se asignan a partir de MAX(id_evento),
+    así que sólo debe haber un proceso escribiendo Events en este modo (config rechaza
+    combinarlo con EVENT_BUS=unix|redis).
+
+    Si la BD rechaza un lote con un error permanente (`permanent_errors`, p. ej. una FK
+    inexistente), el lote se parte en mitades hasta aislar las filas inválidas, que van a
+    `dead_letter` (ndjson, con el error) para no bloquear a las demás. Con cualquier otro error
+    las filas vuelven al buffer y se reintentan; si se acumulan `max_pending` filas sin
+    escribir, append() rechaza los eventos nuevos con EventBufferFull.
+    """
+
+    def __init__(self, session_factory, flush_size: int, flush_interval: float, max_pending: int = 0,
+                 permanent_errors: tuple = (), dead_letter: str | None = None, on_discard=None):
+        self._session_factory = session_factory
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # errores de escritura que no se resuelven reintentando
+        self.permanent_errors = permanent_errors
+        self.dead_letter = dead_letter
+        self.dead_letters = 0
+        self._on_discard = on_discard
+        self._rows: list[dict] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._next_id: int | None = None
+
+    def prime(self):
+        """Lee el último id_evento de la BD para continuar la numeración."""
+        session = self._session_factory()
+        try:
+            last_id = session.execute(select(func.max(Events.id_evento))).scalar()
+        finally:
+            session.close()
+        with self._lock:
+            self._next_id = (last_id or 0) + 1
+
+    def append(self, **values) -> dict:
+        """Asigna id/fecha a un evento y lo deja pendiente de escritura. Devuelve la fila."""
+        if self._next_id is None:
+            self.prime()
+        with self._lock:
+            if self.max_pending and len(self._rows) >= self.max_pending:
+                raise EventBufferFull(f"{len(self._rows)} eventos pendientes de escribir en la BD")
+            row = {"id_evento": self._next_id, "fecha_hora": datetime.utcnow(), **values}
+            self._next_id += 1
+            self._rows.append(row)
+            full = len(self._rows) >= self.flush_size
+        if full:
+            try:
+                self.flush()
+            except Exception:
+                # el evento ya quedó en el buffer; la tarea de fondo reintenta
+                logger.exception("No se pudo escribir el lote de eventos; se reintentará")
+        return row
+
+    def reserve_ids(self, n: int) -> range:
+        """Reserva `n` ids de la numeración para filas que se escriben fuera del buffer."""
+        if self._next_id is None:
+            self.prime()
+        with self._lock:
+            first = self._next_id
+            self._next_id += n
+        return range(first, first + n)
+
+    def pending(self) -> int:
+        return len(self._rows)
+
+    def flush(self) -> int:
+        """Inserta las filas pendientes. Devuelve cuántas escribió (sin contar las descartadas)."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+            written = 0
+            chunks = [rows]
+            while chunks:
+                chunk = chunks.pop(0)
+                try:
+                    self._insert(chunk)
+                except self.permanent_errors as e:
+                    if len(chunk) == 1:
+                        self._reject(chunk[0], e)
+                    else:
+                        # alguna fila es inválida: mitades hasta aislarla, las demás se escriben
+                        half = len(chunk) // 2
+                        chunks[:0] = [chunk[:half], chunk[half:]]
+                    continue
+                except Exception:
+                    # error transitorio: lo no escrito vuelve al frente para el próximo flush
+                    with self._lock:
+                        self._rows[:0] = [row for pending in (chunk, *chunks) for row in pending]
+                    raise
+                written += len(chunk)
+            return written
+
+    def _insert(self, rows: list[dict]):
+        session = self._session_factory()
+        try:
+            session.execute(insert(Events), rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _reject(self, row: dict, e: Exception):
+        """Error permanente: la fila pasa a la dead-letter y deja de reintentarse."""
+        # el mensaje del driver (sin la SQL ni los parámetros que añade SQLAlchemy)
+        error = f"{type(e).__name__}: {getattr(e, 'orig', None) or e}"
+        logger.error("Evento %s descartado: %s", row["id_evento"], error)
+        if self.dead_letter:
+            with open(self.dead_letter, "a") as f:
+                f.write(json.dumps({**row, "fecha_hora": row["fecha_hora"].isoformat(), "error": error}) + "\n")
+        self.dead_letters += 1
+        if self._on_discard is not None:
+            self._on_discard()
+
+    async def run(self, run_in_db):
+        """Tarea de fondo: vacía el buffer cada `flush_interval` segundos."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await run_in_db(self.flush)
+            except Exception:
+                logger.exception("No se pudo escribir el lote de eventos; se reintentará")
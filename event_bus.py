@@ -0,0 +1,343 @@
+"""Backends pub/sub para repartir los broadcasts entre workers/nodos.
+
+El ConnectionManager entrega cada mensaje a sus conexiones locales y lo publica en el bus
+como un sobre (cabecera JSON + "\\n" + frame ya serializado). Los demás procesos reciben el
+sobre y lo entregan a sus propias conexiones; el origen nunca se lo reentrega a sí mismo.
+
+- memory: un solo proceso (por defecto), publish no hace nada.
+- unix:   varios procesos en la misma máquina, sin servicios externos. Cada proceso escucha
+          en un socket Unix en EVENT_BUS_PATH y publica por una conexión con cada uno de los demás.
+- redis:  varios nodos a través de un broker compatible con Redis (PUBLISH/SUBSCRIBE).
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def pack(header: dict, frame: str) -> bytes:
+    return json.dumps(header, separators=(",", ":")).encode() + b"\n" + frame.encode()
+
+
+def unpack(envelope: bytes) -> tuple[dict, str]:
+    header, _, frame = envelope.partition(b"\n")
+    return json.loads(header), frame.decode()
+
+
+class InProcessBus:
+    """Bus de un solo proceso: no hay nadie más a quien publicar."""
+    remote = False
+
+    async def start(self, deliver):
+        pass
+
+    async def publish(self, envelope: bytes, priority: bool = False):
+        pass
+
+    async def claim(self, name: str) -> bool:
+        return True
+
+    async def stop(self):
+        pass
+
+
+class _Peer:
+    __slots__ = ("path", "queue", "urgent", "ready", "task")
+
+    def __init__(self, path: str):
+        self.path = path
+        # (sobre, prioritario) pendientes de enviar a este proceso
+        self.queue: deque[tuple[bytes, bool]] = deque()
+        self.urgent = 0
+        self.ready = asyncio.Event()
+        self.task = None
+
+
+class UnixSocketBus:
+    """Bus entre procesos de la misma máquina sobre sockets Unix de tipo stream.
+
+    Cada proceso escucha en `<path>/<pid>.sock` y mantiene una conexión con cada uno de los
+    demás sockets del directorio. Los sobres viajan con un prefijo de longitud (4 bytes), así
+    que ninguno se trunca; los mayores de MAX_FRAME se rechazan al publicarlos. Cada peer tiene
+    una cola de como mucho QUEUE_SIZE sobres: si el receptor no lee al ritmo de los envíos se
+    descarta el más antiguo no prioritario, y los prioritarios (obstáculos) nunca se descartan.
+    Los sockets de procesos muertos se eliminan al rechazar la conexión. `name` sustituye al pid
+    en el nombre del socket (dos buses en el mismo proceso, p. ej. en las pruebas).
+    """
+    remote = True
+    # la lista de peers se relee del directorio como mucho una vez por intervalo
+    PEERS_TTL = 1.0
+    MAX_FRAME = 16 * 1024 * 1024
+    QUEUE_SIZE = 1024
+
+    def __init__(self, path: str, name: str | None = None):
+        self.path = path
+        self.own = os.path.join(path, f"{name or os.getpid()}.sock")
+        self.dropped = 0
+        self._server = None
+        self._deliver = None
+        self._peers: dict[str, _Peer] = {}
+        self._peers_at = 0.0
+        self._readers: set[asyncio.StreamWriter] = set()
+        self._claims: list = []
+
+    async def start(self, deliver):
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self.own):
+            os.unlink(self.own)
+        self._deliver = deliver
+        self._server = await asyncio.start_unix_server(self._read, path=self.own)
+
+    async def claim(self, name: str) -> bool:
+        """True si este proceso es el único que se queda con `name` (flock mientras vive)."""
+        os.makedirs(self.path, exist_ok=True)
+        f = open(os.path.join(self.path, f"{name}.lock"), "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self._claims.append(f)
+        return True
+
+    async def _read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._readers.add(writer)
+        try:
+            while True:
+                size = int.from_bytes(await reader.readexactly(4), "big")
+                if size > self.MAX_FRAME:
+                    # nadie publica sobres así: el flujo está corrupto
+                    logger.error("Sobre de %d bytes en el bus; se cierra la conexión", size)
+                    return
+                self._deliver(await reader.readexactly(size))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._readers.discard(writer)
+            writer.close()
+
+    def _current_peers(self) -> list[_Peer]:
+        now = time.monotonic()
+        if now - self._peers_at > self.PEERS_TTL:
+            paths = {e.path for e in os.scandir(self.path) if e.name.endswith(".sock") and e.path != self.own}
+            for path in self._peers.keys() - paths:
+                self._forget(self._peers[path])
+            for path in paths - self._peers.keys():
+                peer = self._peers[path] = _Peer(path)
+                peer.task = asyncio.create_task(self._send(peer))
+            self._peers_at = now
+        return list(self._peers.values())
+
+    def _forget(self, peer: _Peer):
+        if self._peers.get(peer.path) is peer:
+            del self._peers[peer.path]
+        if peer.task is not None and peer.task is not asyncio.current_task():
+            peer.task.cancel()
+        self.dropped += len(peer.queue)
+
+    async def publish(self, envelope: bytes, priority: bool = False):
+        if len(envelope) > self.MAX_FRAME:
+            logger.error("Mensaje de %d bytes demasiado grande para el bus; no se publica", len(envelope))
+            self.dropped += 1
+            return
+        for peer in self._current_peers():
+            queue = peer.queue
+            if len(queue) >= self.QUEUE_SIZE and peer.urgent < len(queue):
+                # el peer no lee al ritmo de los envíos: fuera el más antiguo no prioritario
+                for i, (_, urgent) in enumerate(queue):
+                    if not urgent:
+                        del queue[i]
+                        break
+                self.dropped += 1
+            queue.append((envelope, priority))
+            peer.urgent += priority
+            peer.ready.set()
+
+    async def _send(self, peer: _Peer):
+        """Tarea por peer: mantiene la conexión y le escribe lo que haya en su cola."""
+        while True:
+            await peer.ready.wait()
+            try:
+                _, writer = await asyncio.open_unix_connection(peer.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # proceso terminado: limpiar su socket
+                try:
+                    os.unlink(peer.path)
+                except OSError:
+                    pass
+                self._forget(peer)
+                return
+            except OSError:
+                logger.warning("No se pudo conectar con %s por el bus; reintentando", peer.path)
+                await asyncio.sleep(self.PEERS_TTL)
+                continue
+            batch = []
+            try:
+                while True:
+                    await peer.ready.wait()
+                    peer.ready.clear()
+                    batch = list(peer.queue)
+                    peer.queue.clear()
+                    peer.urgent = 0
+                    writer.write(b"".join(len(envelope).to_bytes(4, "big") + envelope for envelope, _ in batch))
+                    await writer.drain()
+                    batch = []
+            except (ConnectionError, OSError):
+                # lo que iba en el lote se pierde salvo los prioritarios, que se reenvían
+                urgent = [item for item in batch if item[1]]
+                self.dropped += len(batch) - len(urgent)
+                peer.queue.extendleft(reversed(urgent))
+                peer.urgent += len(urgent)
+                peer.ready.set()
+            finally:
+                writer.close()
+
+    async def stop(self):
+        for peer in list(self._peers.values()):
+            self._forget(peer)
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._readers):
+                writer.close()
+            # que las lecturas vean el cierre y terminen
+            await asyncio.sleep(0)
+            self._server = None
+        try:
+            os.unlink(self.own)
+        except OSError:
+            pass
+        for f in self._claims:
+            f.close()
+        self._claims = []
+
+
+class RedisBus:
+    """Bus entre nodos sobre PUBLISH/SUBSCRIBE de un broker compatible con Redis.
+
+    Requiere el paquete `redis` (redis.asyncio), salvo que se pase un `client` ya creado con
+    la misma interfaz (por ejemplo fakeredis.aioredis.FakeRedis para pruebas locales).
+    """
+    remote = True
+    # las claves de claim() caducan a los CLAIM_TTL segundos si su dueño deja de renovarlas
+    CLAIM_TTL = 60
+
+    def __init__(self, url: str, channel: str, client=None):
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise RuntimeError("EVENT_BUS=redis requiere el paquete 'redis'") from None
+            client = redis.from_url(url)
+        self.client = client
+        self.channel = channel
+        # los mensajes propios vuelven por la suscripción: se ignoran por origen
+        self.origin = uuid.uuid4().hex
+        self._prefix = self.origin.encode() + b"|"
+        self._pubsub = None
+        self._task = None
+        # clave reclamada -> tarea que la renueva
+        self._claims: dict[str, asyncio.Task] = {}
+
+    async def start(self, deliver):
+        self._pubsub = self.client.pubsub()
+        await self._pubsub.subscribe(self.channel)
+
+        async def reader():
+            while True:
+                try:
+                    async for message in self._pubsub.listen():
+                        if message.get("type") != "message":
+                            continue
+                        data = message["data"]
+                        if not data.startswith(self._prefix):
+                            deliver(data.partition(b"|")[2])
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Error leyendo del bus Redis; reintentando")
+                    await asyncio.sleep(1)
+
+        self._task = asyncio.create_task(reader())
+
+    async def claim(self, name: str) -> bool:
+        """True si este nodo se queda con `name`. La clave caduca a los CLAIM_TTL segundos, pero
+        el dueño la renueva mientras vive y la libera en stop(): otro nodo sólo la gana si este
+        termina o deja de responder.
+        """
+        key = f"{self.channel}:{name}"
+        try:
+            if not await self.client.set(key, self.origin, nx=True, px=int(self.CLAIM_TTL * 1000)):
+                return False
+        except Exception:
+            logger.exception("No se pudo reclamar %s en Redis", name)
+            return False
+        self._claims[key] = asyncio.create_task(self._keep_claim(key))
+        return True
+
+    async def _keep_claim(self, key: str):
+        while True:
+            await asyncio.sleep(self.CLAIM_TTL / 3)
+            try:
+                if await self._if_owner(key, lambda pipe: pipe.pexpire(key, int(self.CLAIM_TTL * 1000))):
+                    continue
+                # caducó (Redis reiniciado o este nodo sin responder más de CLAIM_TTL): recuperarla
+                # si nadie la tomó entretanto
+                if not await self.client.set(key, self.origin, nx=True, px=int(self.CLAIM_TTL * 1000)):
+                    logger.error("Otro nodo se quedó con %s", key)
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("No se pudo renovar %s en Redis; reintentando", key)
+
+    async def _if_owner(self, key: str, command) -> bool:
+        """Ejecuta command(pipe) en una transacción sólo si `key` sigue siendo de este nodo."""
+        from redis.exceptions import WatchError
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                if await pipe.get(key) != self.origin.encode():
+                    return False
+                pipe.multi()
+                command(pipe)
+                await pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    async def publish(self, envelope: bytes, priority: bool = False):
+        try:
+            await self.client.publish(self.channel, self._prefix + envelope)
+        except Exception:
+            logger.exception("No se pudo publicar en el bus Redis")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        for key, task in self._claims.items():
+            task.cancel()
+            try:
+                await self._if_owner(key, lambda pipe: pipe.delete(key))
+            except Exception:
+                logger.exception("No se pudo liberar %s en Redis", key)
+        self._claims = {}
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe(self.channel)
+            await self._pubsub.aclose()
+
+
+def create_bus(kind: str, path: str, redis_url: str, channel: str):
+    if kind == "memory":
+        return InProcessBus()
+    if kind == "unix":
+        return UnixSocketBus(path)
+    if kind == "redis":
+        return RedisBus(redis_url, channel)
+    raise ValueError(f"EVENT_BUS inválido: {kind}")
@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import NamedTuple
+
+
+class EventRecord(NamedTuple):
+    """Representación compacta de una fila de Events (los textos se resuelven al leer)."""
+    id_evento: int
+    id_dispositivo: int
+    id_cliente: int
+    id_operacion: int
+    id_obstaculo: int | None
+    id_velocidad: int | None
+    fecha_hora: datetime
+
+    @classmethod
+    def of(cls, evento) -> "EventRecord":
+        if isinstance(evento, dict):
+            return cls(*(evento.get(f) for f in cls._fields))
+        return cls(*(getattr(evento, f) for f in cls._fields))
+
+
+class _DeviceHistory:
+    __slots__ = ("events", "complete")
+
+    def __init__(self, depth: int):
+        # más reciente a la derecha
+        self.events: deque = deque(maxlen=depth)
+        # True si `events` contiene toda la historia del dispositivo
+        self.complete = False
+
+
+class EventHistory:
+    """Ring buffer por dispositivo con los últimos `depth` eventos.
+
+    Como máximo se guardan `max_devices` dispositivos (LRU), así que la memoria queda acotada
+    a depth * max_devices registros. Se alimenta desde las escrituras de Events y se
+    completa desde la BD la primera vez que se consulta un dispositivo.
+    """
+
+    def __init__(self, depth: int, max_devices: int):
+        self.depth = depth
+        self.max_devices = max_devices
+        self._devices: OrderedDict[int, _DeviceHistory] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _history(self, id_dispositivo: int) -> _DeviceHistory:
+        history = self._devices.get(id_dispositivo)
+        if history is None:
+            history = self._devices[id_dispositivo] = _DeviceHistory(self.depth)
+            if len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+        else:
+            self._devices.move_to_end(id_dispositivo)
+        return history
+
+    def append(self, evento):
+        record = EventRecord.of(evento)
+        with self._lock:
+            history = self._history(record.id_dispositivo)
+            events = history.events
+            if events and record.id_evento < events[-1].id_evento:
+                # llega fuera de orden (escrito por otro worker): se coloca en su sitio
+                self._insert(history, record)
+                return
+            if len(events) == self.depth:
+                # se descarta el más antiguo: ya no tenemos la historia completa
+                history.complete = False
+            events.append(record)
+
+    def _insert(self, history: _DeviceHistory, record: EventRecord):
+        events = history.events
+        if len(events) == self.depth:
+            if record.id_evento < events[0].id_evento:
+                history.complete = False
+                return
+            events.popleft()
+            history.complete = False
+        i = len(events)
+        while i > 0 and events[i - 1].id_evento > record.id_evento:
+            i -= 1
+        if i == 0 or events[i - 1].id_evento != record.id_evento:
+            events.insert(i, record)
+
+    def latest(self, id_dispositivo: int, n: int) -> list[EventRecord] | None:
+        """Últimos `n` eventos (más reciente primero) o None si la memoria no alcanza."""
+        if n <= 0:
+            return []
+        with self._lock:
+            history = self._devices.get(id_dispositivo)
+            if history is None or (len(history.events) < n and not history.complete):
+                return None
+            self._devices.move_to_end(id_dispositivo)
+            events = list(history.events)
+        return events[:-n - 1:-1] if n < len(events) else events[::-1]
+
+    def load(self, id_dispositivo: int, db_events: list, complete: bool) -> list[EventRecord]:
+        """Combina filas leídas de la BD (más reciente primero) con lo que ya hay en memoria
+        (que puede incluir eventos aún no escritos) y devuelve la lista combinada completa.
+        """
+        records = [EventRecord.of(ev) for ev in db_events]
+        with self._lock:
+            history = self._history(id_dispositivo)
+            known = {r.id_evento for r in records}
+            newer = [r for r in history.events if r.id_evento not in known]
+            merged = sorted(records + newer, key=lambda r: r.id_evento, reverse=True)
+            history.events.clear()
+            history.events.extend(reversed(merged[:self.depth]))
+            history.complete = complete and len(merged) <= self.depth
+        return merged
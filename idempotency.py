@@ -0,0 +1,99 @@
+"""Claves de idempotencia para los comandos que los carros reintentan (move, speed, obstaculo).
+
+El cliente manda una clave (cabecera Idempotency-Key o campo "idempotency_key" del cuerpo); la
+primera petición con esa clave se ejecuta y su respuesta se guarda IDEMPOTENCY_TTL_S segundos.
+Un reintento con la misma clave recibe la respuesta guardada sin registrar otro evento ni
+difundir nada; si llega mientras la primera sigue en curso, espera su resultado. Si la primera
+falla la clave se libera y el siguiente reintento se ejecuta de nuevo.
+
+Como máximo se guardan IDEMPOTENCY_MAX_KEYS claves: todas tienen el mismo TTL, así que el orden
+de inserción es también el de caducidad y las más antiguas se descartan por el frente (O(1)).
+Las claves viven en la memoria de cada proceso: con varios workers, un reintento que cae en
+otro worker no se detecta.
+"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from .config import settings
+from . import metrics
+
+# longitud máxima aceptada para una clave (las claves más largas se rechazan con 400)
+MAX_KEY_LENGTH = 128
+
+
+class IdempotencyConflict(Exception):
+    """La clave ya se usó con otro cuerpo."""
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "expires", "future")
+
+    def __init__(self, fingerprint: str, expires: float, future: asyncio.Future):
+        self.fingerprint = fingerprint
+        self.expires = expires
+        self.future = future
+
+
+def fingerprint(body: dict) -> str:
+    """Huella del cuerpo (sin la propia clave) para detectar claves reutilizadas con otro comando."""
+    data = {k: v for k, v in body.items() if k != "idempotency_key"}
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IdempotencyCache:
+    def __init__(self, max_keys: int, ttl: float):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        # (ruta, clave) -> entrada, en orden de inserción (= orden de caducidad)
+        self._entries: OrderedDict[tuple[str, str], _Entry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expire(self, now: float):
+        entries = self._entries
+        while entries:
+            entry = next(iter(entries.values()))
+            if entry.expires > now and len(entries) <= self.max_keys:
+                break
+            entries.popitem(last=False)
+
+    async def run(self, scope: str, key: str, huella: str, handler):
+        """Ejecuta `handler()` una sola vez por (scope, key) dentro del TTL.
+        Devuelve (respuesta, repetida). IdempotencyConflict si la clave llegó con otro cuerpo.
+        """
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._entries.get((scope, key))
+        if entry is not None:
+            if entry.fingerprint != huella:
+                raise IdempotencyConflict(key)
+            metrics.idempotency_replays.inc()
+            # shield: si este reintento se cancela, la petición original sigue su curso
+            return await asyncio.shield(entry.future), True
+        future = asyncio.get_running_loop().create_future()
+        # sin esperas entre la búsqueda y el alta: las peticiones concurrentes ven la entrada
+        entry = self._entries[(scope, key)] = _Entry(huella, now + self.ttl, future)
+        self._expire(now)
+        try:
+            response = await handler()
+        except BaseException as e:
+            # la clave queda libre para reintentar; los que esperaban reciben el mismo error
+            if self._entries.get((scope, key)) is entry:
+                del self._entries[(scope, key)]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # evita el aviso "exception was never retrieved" cuando nadie esperaba
+                future.exception()
+            raise
+        future.set_result(response)
+        return response, False
+
+
+cache = IdempotencyCache(settings.IDEMPOTENCY_MAX_KEYS, settings.IDEMPOTENCY_TTL_S)
+
+metrics.registry.register(metrics.Gauge("idempotency_keys", "Claves de idempotencia guardadas", func=lambda: len(cache)))
@@ -1,11 +1,103 @@
+import asyncio
+import csv
+import io
+import itertools
+import json
+import logging
+import math
+import threading
+import time
 import uvicorn
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from .config import settings
-from .websocket_manager import manager
-from . import crud, schemas
+from .websocket_manager import encode_message, manager
+from .coalescer import CommandSuperseded, RateLimited, coalescer
+from .sequences import SequenceBusy, canonical, parse_pasos, scheduler
+from . import crud, idempotency, metrics, schemas
 
-app = FastAPI(title="IoT Carrito API")
+logger = logging.getLogger(__name__)
+
+
+async def _flush_stats_periodically():
+    """Escribe los rollups acumulados en EstadisticasDispositivo cada STATS_FLUSH_INTERVAL_S."""
+    while True:
+        await asyncio.sleep(settings.STATS_FLUSH_INTERVAL_S)
+        try:
+            await crud.run_in_db(crud.stats.flush)
+        except Exception:
+            # los deltas se conservan y se reintentan en el siguiente ciclo
+            logger.exception("No se pudieron escribir las estadísticas")
+
+
+async def _archive_periodically():
+    """Mueve a ARCHIVE_DIR los eventos fuera de la ventana caliente cada ARCHIVE_INTERVAL_S."""
+    while True:
+        try:
+            archived = await crud.run_in_db(crud.archive_cold_events)
+            if archived:
+                logger.info("%d eventos archivados", archived)
+        except Exception:
+            logger.exception("Error archivando eventos")
+        await asyncio.sleep(settings.ARCHIVE_INTERVAL_S)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        await crud.run_in_db(crud.catalog.reload)
+    except Exception:
+        # la caché se carga en la primera consulta si la BD no responde al arrancar
+        logger.exception("No se pudieron cargar los catálogos al iniciar")
+    # con varios workers, cada uno aplica a su estado en memoria los eventos que escriben los
+    # demás; el bus arranca antes de la precarga para no perder los que lleguen mientras tanto
+    crud.record_listeners.append(manager.share_event)
+    manager.on_remote_events(crud.record_remote)
+    await manager.start()
+    # el tiempo a la velocidad vigente lo cuenta un solo worker (después, el que registre el cambio)
+    own_speeds = await manager.bus.claim("stats-velocidad")
+    try:
+        await crud.run_in_db(crud.warm_device_state, own_speeds)
+        # el log de reanudación de /ws/monitor tiene todo lo posterior a este id
+        manager.replay_floor = crud.device_state.last_id()
+    except Exception:
+        # sin precarga, /api/last consulta la BD hasta conocer cada dispositivo (y las
+        # reanudaciones de /ws/monitor, también)
+        logger.exception("No se pudo precargar el estado de los dispositivos")
+    try:
+        await crud.run_in_db(crud.sequences.load)
+    except Exception:
+        # sin precarga, las secuencias existentes se leen al usarse (y no se deduplica contra ellas)
+        logger.exception("No se pudieron cargar las secuencias")
+    manager.on_remote("obstaculo", _cancel_remote_sequences)
+    scheduler.start(_run_sequence_steps, _sequence_status)
+    await crud.obstacle_lane.start(crud.run_in_db, crud.persist_obstacles, _obstacle_persisted,
+                                   on_error=metrics.obstacle_persist_errors.inc, discard=_obstacle_discarded)
+    flusher = None
+    if crud.event_buffer is not None:
+        await crud.run_in_db(crud.event_buffer.prime)
+        flusher = asyncio.create_task(crud.event_buffer.run(crud.run_in_db))
+    stats_flusher = asyncio.create_task(_flush_stats_periodically())
+    archiver = asyncio.create_task(_archive_periodically()) if settings.EVENTS_HOT_DAYS > 0 else None
+    yield
+    stats_flusher.cancel()
+    if archiver is not None:
+        archiver.cancel()
+    if flusher is not None:
+        flusher.cancel()
+    await scheduler.stop()
+    await crud.obstacle_lane.stop()
+    await manager.stop()
+    # cerrar el executor, escribir eventos pendientes y liberar el pool de la BD
+    crud.shutdown_db()
+
+
+app = FastAPI(title="IoT Carrito API", lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
 
 # CORS - permitir cualquier origen (acepta peticiones desde cualquier IP pública)
 app.add_middleware(
@@ -16,12 +108,84 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(crud.EventBufferFull)
+async def _event_buffer_full(request: Request, exc: crud.EventBufferFull):
+    # EVENTS_DURABILITY=buffered con la BD caída: el buffer llegó a EVENTS_BUFFER_MAX
+    return JSONResponse(status_code=503, content={"detail": f"No se aceptan eventos: {exc}"}, headers={"Retry-After": "5"})
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def _device_command(ev: dict) -> dict:
+    """Comando compacto para el canal del carro (/ws/device):
+    t=c (comando), e=id_evento (o p=id provisional), op=id_operacion y, si cambia la velocidad,
+    v=id_velocidad y pwm=valor_pwm.
+    """
+    cmd = {"t": "c", "e": ev["id_evento"], "op": ev["id_operacion"]}
+    if ev.get("id_evento") is None:
+        # obstáculo aún no escrito: id provisional
+        cmd = {"t": "c", "p": ev["id_provisional"], "op": ev["id_operacion"]}
+    if ev.get("id_velocidad") is not None:
+        cmd["v"] = ev["id_velocidad"]
+        velocidad = crud.catalog.velocidad(ev["id_velocidad"])
+        if velocidad is not None:
+            cmd["pwm"] = velocidad.valor_pwm
+    return cmd
+
+
+async def _idempotent(request: Request, response: Response, body: dict, handler):
+    """Ejecuta `handler()` respetando la clave de idempotencia de la petición (cabecera
+    Idempotency-Key o campo idempotency_key); sin clave se ejecuta siempre.
+    Un reintento devuelve la respuesta guardada con la cabecera Idempotent-Replayed: true.
+    """
+    key = request.headers.get("Idempotency-Key") or body.get("idempotency_key")
+    if key is None:
+        return await handler()
+    key = str(key)
+    if not key or len(key) > idempotency.MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"La clave de idempotencia debe tener entre 1 y {idempotency.MAX_KEY_LENGTH} caracteres")
+    try:
+        result, replayed = await idempotency.cache.run(request.url.path, key, idempotency.fingerprint(body), handler)
+    except idempotency.IdempotencyConflict:
+        raise HTTPException(status_code=422, detail="La clave de idempotencia ya se usó con otro comando")
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+async def _limited(id_dispositivo: int, tipo: str, value, write):
+    """Pasa el comando por el límite/fusión del carro (ver coalescer) y traduce sus errores a HTTP."""
+    try:
+        return await coalescer.submit(id_dispositivo, tipo, value, write)
+    except RateLimited as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+    except CommandSuperseded as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
 # --- Endpoints REST (Controlador) ---
 # NOTE: API key verification removed for demo/testing. Endpoints are open (CORS still allows origins).
 
 @app.post("/api/move", response_model=schemas.MovementOut)
-async def post_move(mv: schemas.MovementIn):
-    evento = crud.add_movement(mv.id_dispositivo, mv.id_cliente, mv.id_operacion, mv.id_obstaculo)
+async def post_move(mv: schemas.MovementIn, request: Request, response: Response):
+    return await _idempotent(request, response, mv.model_dump(), lambda: _move(mv))
+
+
+async def _move(mv: schemas.MovementIn) -> dict:
+    if mv.id_operacion == 3:  # 3 = Detener
+        # un Detener ni espera su ventana ni se limita: descarta lo pendiente y la secuencia en
+        # curso (su siguiente paso volvería a arrancar el carro) y se escribe ya
+        coalescer.supersede(mv.id_dispositivo, "el carro recibió un Detener")
+        await _cancel_sequence(mv.id_dispositivo, "detenida")
+        return await _write_move(mv)
+    # los movimientos seguidos del mismo carro se fusionan (gana el último)
+    return await _limited(mv.id_dispositivo, "movimiento", mv, _write_move)
+
+
+async def _write_move(mv: schemas.MovementIn) -> dict:
+    evento = await crud.run_in_db(crud.add_movement, mv.id_dispositivo, mv.id_cliente, mv.id_operacion, mv.id_obstaculo)
     # preparar payload para broadcast
     payload = {
         "tipo": "movimiento",
@@ -36,27 +200,155 @@ async def post_move(mv: schemas.MovementIn):
     }
     # push
     await manager.broadcast(payload)
+    await manager.send_to_device(evento.id_dispositivo, _device_command(payload["evento"]))
     return payload["evento"]
 
+def _obstacle_fields(item: dict) -> dict:
+    return {"id_evento": item.get("id_evento"), "id_provisional": item["id_provisional"],
+            "id_dispositivo": item["id_dispositivo"], "id_cliente": item["id_cliente"], "id_operacion": item["id_operacion"],
+            "id_obstaculo": item["id_obstaculo"], "fecha_hora": _iso(item["fecha_hora"])}
+
+
+# segundos mínimos entre dos recargas del catálogo provocadas por ids desconocidos
+_CATALOG_RETRY_S = 5
+
+
+def _optional_int(value) -> int | None:
+    return None if value is None else int(value)
+
+
+async def _validate_obstacle(id_dispositivo: int, id_cliente: int, id_obstaculo: int | None):
+    """Comprueba contra el catálogo en memoria que los ids existen antes de aceptar el obstáculo:
+    la escritura en Events es posterior y una fila inválida no debe llegar al journal.
+    Con ids desconocidos se recarga el catálogo (como mucho cada _CATALOG_RETRY_S) por si son
+    nuevos. ValueError si alguno no existe; si la BD no responde, se acepta sin comprobar (una
+    fila rechazada por la BD acaba en la dead-letter de obstacle_lane).
+    """
+    catalog = crud.catalog
+    unknown = catalog.unknown_ids(id_dispositivo, id_cliente, id_obstaculo)
+    if unknown and (catalog.loaded_at is None or time.monotonic() - catalog.loaded_at > _CATALOG_RETRY_S):
+        try:
+            await crud.run_in_db(catalog.reload)
+        except Exception:
+            logger.warning("No se pudo recargar el catálogo para validar un obstáculo; se acepta sin comprobar")
+            return
+        unknown = catalog.unknown_ids(id_dispositivo, id_cliente, id_obstaculo)
+    if unknown:
+        raise ValueError(f"No existe: {', '.join(unknown)}")
+
+
+async def _report_obstacle(id_dispositivo: int, id_cliente: int, id_obstaculo: int | None) -> dict:
+    """Vía rápida del obstáculo: cancela la secuencia en curso, difunde el Detener con un id
+    provisional sin esperar a la BD y lo anota en el journal; se escribe en Events después
+    (ver obstacle_lane) y entonces se difunde de nuevo con estado "confirmado".
+    """
+    start = time.perf_counter()
+    ejecucion = scheduler.cancel(id_dispositivo)
+    coalescer.supersede(id_dispositivo)
+    item = crud.obstacle_lane.provisional(id_dispositivo, id_cliente, id_obstaculo)
+    evento = _obstacle_fields(item)
+    await manager.broadcast({"tipo": "obstaculo", "estado": "provisional", "evento": evento}, priority=True)
+    await manager.send_to_device(id_dispositivo, _device_command(evento), priority=True)
+    metrics.obstacle_broadcast_seconds.observe(time.perf_counter() - start)
+    if ejecucion is not None:
+        await _sequence_status(ejecucion, "obstaculo")
+    await crud.obstacle_lane.submit(item)
+    return evento
+
+
+async def _obstacle_persisted(item: dict, ev: dict, elapsed: float):
+    metrics.obstacle_persist_seconds.observe(elapsed)
+    await manager.broadcast({"tipo": "obstaculo", "estado": "confirmado",
+                             "evento": _obstacle_fields({**item, "id_evento": ev["id_evento"]})})
+
+
+async def _obstacle_discarded(item: dict, error: str):
+    # el Detener ya se difundió y se envió al carro; los monitores dejan de esperar su confirmación
+    metrics.obstacle_dead_letters.inc()
+    await manager.broadcast({"tipo": "obstaculo", "estado": "descartado", "error": error,
+                             "evento": _obstacle_fields(item)})
+
+
 @app.post("/api/obstaculo", response_model=dict)
-async def post_obstaculo(data: dict):
-    # Espera: id_dispositivo, id_cliente, id_obstaculo
-    evento = crud.add_movement(data["id_dispositivo"], data["id_cliente"], 3, data.get("id_obstaculo"))  # 3 = Detener
-    payload = {"tipo": "obstaculo", "evento": {
-        "id_evento": evento.id_evento,
-        "id_operacion": evento.id_operacion,
-        "id_obstaculo": evento.id_obstaculo,
-        "fecha_hora": evento.fecha_hora.isoformat()
-    }}
+async def post_obstaculo(data: dict, request: Request, response: Response):
+    """Obstáculo detectado (Detener). Espera: id_dispositivo, id_cliente, id_obstaculo.
+    Responde en cuanto el Detener está difundido y anotado en el journal, con su id_provisional;
+    el id_evento llega después a los monitores ({"tipo": "obstaculo", "estado": "confirmado"}).
+    """
+    return await _idempotent(request, response, data, lambda: _obstaculo(data))
+
+
+async def _obstaculo(data: dict) -> dict:
+    try:
+        id_dispositivo, id_cliente = int(data["id_dispositivo"]), int(data["id_cliente"])
+        id_obstaculo = _optional_int(data.get("id_obstaculo"))
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Se requieren id_dispositivo e id_cliente (enteros); id_obstaculo debe ser entero")
+    try:
+        await _validate_obstacle(id_dispositivo, id_cliente, id_obstaculo)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    evento = await _report_obstacle(id_dispositivo, id_cliente, id_obstaculo)
+    return {"ok": True, "id_provisional": evento["id_provisional"], "fecha_hora": evento["fecha_hora"]}
+
+
+@app.post("/api/events/batch")
+async def post_events_batch(lote: schemas.BatchIn):
+    """Registra un lote de comandos (movimiento/velocidad/obstaculo, mezclados) en una sola
+    transacción y emite un único broadcast {"tipo": "lote", "eventos": [...]}.
+    Los movimientos y velocidades cuentan para el límite de cada carro (COMMAND_RATE_PER_S): si
+    alguno no tiene tokens para los suyos, el lote entero recibe 429.
+    """
+    comandos = lote.comandos
+    if not comandos:
+        raise HTTPException(status_code=400, detail="comandos debe ser una lista no vacía")
+    if len(comandos) > settings.BATCH_MAX_COMMANDS:
+        raise HTTPException(status_code=413, detail=f"Máximo {settings.BATCH_MAX_COMMANDS} comandos por lote")
+    if any(c.tipo == "velocidad" for c in comandos) and crud.catalog.stale:
+        await crud.run_in_db(crud.catalog.reload)
+    rows = []
+    for i, c in enumerate(comandos):
+        if c.tipo == "movimiento":
+            rows.append({"id_dispositivo": c.id_dispositivo, "id_cliente": c.id_cliente, "id_operacion": c.id_operacion, "id_obstaculo": c.id_obstaculo})
+        elif c.tipo == "velocidad":
+            velocidad = crud.catalog.velocidad(c.id_velocidad)
+            if velocidad is None or not velocidad.activo:
+                raise HTTPException(status_code=400, detail=f"comandos[{i}]: id_velocidad inválido")
+            # operación 1 (Adelante) como base, igual que /api/speed
+            rows.append({"id_dispositivo": c.id_dispositivo, "id_cliente": c.id_cliente, "id_operacion": 1, "id_velocidad": c.id_velocidad})
+        else:
+            rows.append({"id_dispositivo": c.id_dispositivo, "id_cliente": c.id_cliente, "id_operacion": 3, "id_obstaculo": c.id_obstaculo})  # 3 = Detener
+    # los movimientos y velocidades del lote gastan tokens del límite de cada carro, igual que por
+    # /api/move y /api/speed (los Detener y obstáculos no se limitan)
+    limitados = {}
+    for c in comandos:
+        if c.tipo == "velocidad" or (c.tipo == "movimiento" and c.id_operacion != 3):
+            limitados[c.id_dispositivo] = limitados.get(c.id_dispositivo, 0) + 1
+    try:
+        coalescer.take(limitados)
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except RateLimited as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+    for c in comandos:
+        if c.tipo == "obstaculo":
+            coalescer.supersede(c.id_dispositivo)
+            await _cancel_sequence(c.id_dispositivo, "obstaculo")
+    eventos = await crud.run_in_db(crud.add_events_batch, rows)
+    eventos = [{**ev, "fecha_hora": _iso(ev["fecha_hora"])} for ev in eventos]
+    payload = {"tipo": "lote", "eventos": [{"tipo": c.tipo, "evento": ev} for c, ev in zip(comandos, eventos)]}
     await manager.broadcast(payload)
-    return {"ok": True}
+    for ev in eventos:
+        await manager.send_to_device(ev["id_dispositivo"], _device_command(ev))
+    return {"ok": True, "total": len(eventos), "eventos": eventos}
 
 
 @app.get("/api/events/{id_dispositivo}")
-async def get_events(id_dispositivo: int, n: int = 10):
-    """Devuelve los últimos `n` eventos del dispositivo (con texto legible para operación/obstáculo/velocidad).
+async def get_events(id_dispositivo: int, n: int = Query(10, ge=1, le=settings.HISTORY_PAGE_MAX)):
+    """Devuelve los últimos `n` eventos del dispositivo (con texto legible para operación/obstáculo/velocidad);
+    `n` entre 1 y HISTORY_PAGE_MAX (para ir más atrás, /api/events/{id}/history).
     """
-    eventos = crud.get_last_n_events_data(id_dispositivo, n)
+    eventos = await crud.run_in_db(crud.get_last_n_events_data, id_dispositivo, n)
     if not eventos:
         return []
     results = []
@@ -76,16 +368,177 @@ async def get_events(id_dispositivo: int, n: int = 10):
     return results
 
 
+@app.get("/api/events/{id_dispositivo}/history")
+async def get_events_history(id_dispositivo: int, before_id: int | None = None, after_id: int | None = None,
+                             desde: datetime | None = None, hasta: datetime | None = None, limit: int = 50):
+    """Historial paginado (keyset) del dispositivo, del más reciente al más antiguo.
+    Para la página siguiente (más antigua) usar before_id=next_before_id; para eventos más nuevos,
+    after_id=next_after_id. desde/hasta acotan por fecha_hora (inclusive).
+    """
+    limit = max(1, min(limit, settings.HISTORY_PAGE_MAX))
+    try:
+        eventos, has_more = await crud.run_in_db(crud.get_events_page, id_dispositivo, before_id, after_id, desde, hasta, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    for ev in eventos:
+        ev["fecha_hora"] = _iso(ev["fecha_hora"])
+    return {
+        "eventos": eventos,
+        "has_more": has_more,
+        "next_before_id": eventos[-1]["id_evento"] if eventos else None,
+        "next_after_id": eventos[0]["id_evento"] if eventos else None
+    }
+
+
+_EXPORT_FIELDS = ["id_evento", "id_dispositivo", "id_cliente", "id_operacion", "operacion_texto", "id_obstaculo",
+                  "obstaculo_texto", "id_velocidad", "velocidad_texto", "fecha_hora"]
+
+
+def _export_chunks(id_dispositivo: int, formato: str, desde, hasta):
+    """Genera el export por bloques (un bloque por lote leído del cursor). El primer lote se lee
+    antes de generar nada, así que crud.ExportBusy salta en el primer next().
+    """
+    lotes = crud.iter_events(id_dispositivo, desde, hasta, settings.EXPORT_CHUNK_SIZE)
+    primero = next(lotes, None)
+    if formato == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=_EXPORT_FIELDS)
+        writer.writeheader()
+        yield buffer.getvalue()
+    if primero is None:
+        return
+    for eventos in itertools.chain([primero], lotes):
+        for ev in eventos:
+            ev["fecha_hora"] = _iso(ev["fecha_hora"])
+        if formato == "csv":
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(eventos)
+            yield buffer.getvalue()
+        else:
+            yield "".join(json.dumps(ev, ensure_ascii=False) + "\n" for ev in eventos)
+
+
+@app.get("/api/events/{id_dispositivo}/export")
+async def export_events(id_dispositivo: int, formato: str = "ndjson", desde: datetime | None = None, hasta: datetime | None = None):
+    """Exporta todos los eventos del dispositivo en el rango (orden cronológico) como NDJSON o CSV,
+    incluidos los archivados. La respuesta se transmite a medida que se lee del archivo y de la BD
+    (cursor del lado del servidor).
+    """
+    if formato not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="formato debe ser ndjson o csv")
+    media_type = "text/csv" if formato == "csv" else "application/x-ndjson"
+    filename = f"eventos_{id_dispositivo}.{formato}"
+    chunks = _ClosingIterator(_export_chunks(id_dispositivo, formato, desde, hasta))
+    # el primer bloque se genera antes de responder: si no hay hueco para otro export aún se
+    # puede contestar 503
+    try:
+        primero = await run_in_threadpool(next, chunks, "")
+    except crud.ExportBusy:
+        raise HTTPException(status_code=503, detail="Demasiados exports en curso; reintentar más tarde",
+                            headers={"Retry-After": "5"})
+    return _ExportResponse(chunks, primero, media_type=media_type,
+                           headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+class _ClosingIterator:
+    """Iterador síncrono que se puede cerrar desde otro hilo aunque haya un next() en curso."""
+
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            return next(self._iterator)
+
+    def close(self):
+        with self._lock:
+            self._iterator.close()
+
+
+class _ExportResponse(StreamingResponse):
+    """StreamingResponse que cierra el generador del export al terminar, también si el cliente
+    se desconecta a medias: así el export suelta su conexión y su hueco en cuanto acaba la
+    respuesta, sin esperar al recolector de basura.
+    """
+
+    def __init__(self, chunks: _ClosingIterator, primero: str, **kwargs):
+        # generador síncrono: Starlette lo recorre en un hilo, sin bloquear el event loop
+        super().__init__(itertools.chain([primero], chunks), **kwargs)
+        self._chunks = chunks
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await run_in_threadpool(self._chunks.close)
+
+
+@app.get("/api/stats/{id_dispositivo}")
+async def device_stats(id_dispositivo: int, periodo: str = "hora", desde: datetime | None = None, hasta: datetime | None = None):
+    """Rollups del dispositivo por hora o por día: operaciones por tipo, obstáculos por categoría
+    y segundos en cada velocidad. Por defecto las últimas 24 horas (hora) o 30 días (dia).
+    """
+    if periodo not in ("hora", "dia"):
+        raise HTTPException(status_code=400, detail="periodo debe ser hora o dia")
+    hasta = hasta or datetime.utcnow()
+    desde = desde or hasta - (timedelta(hours=24) if periodo == "hora" else timedelta(days=30))
+    if desde > hasta:
+        raise HTTPException(status_code=400, detail="desde debe ser anterior a hasta")
+    buckets = await crud.run_in_db(crud.get_device_stats, id_dispositivo, periodo, desde, hasta)
+    for bucket in buckets:
+        bucket["inicio"] = _iso(bucket["inicio"])
+    return {"id_dispositivo": id_dispositivo, "periodo": periodo, "buckets": buckets}
+
+
 @app.get("/health")
 async def health():
     """Simple health check to test reachability from frontend/tools."""
     return {"ok": True}
 
+@app.get("/metrics")
+async def get_metrics():
+    """Métricas en formato de texto de Prometheus (METRICS_ENABLED)."""
+    if not metrics.registry.enabled:
+        raise HTTPException(status_code=404, detail="Métricas deshabilitadas")
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/api/catalog/reload")
+async def reload_catalog():
+    """Recarga la caché de catálogos (Operations, Obstaculos, Velocidades) desde la BD."""
+    await crud.run_in_db(crud.catalog.reload)
+    return {
+        "ok": True,
+        "operaciones": len(crud.catalog.operaciones),
+        "obstaculos": len(crud.catalog.obstaculos),
+        "velocidades": len(crud.catalog.velocidades)
+    }
+
 @app.get("/api/last/{id_dispositivo}")
 async def last_event(id_dispositivo: int):
-    ev = crud.get_last_event_data(id_dispositivo)
-    if not ev:
+    """Último evento del dispositivo, servido desde el estado en memoria.
+    Incluye la velocidad vigente (último cambio de velocidad) y el último obstáculo.
+    """
+    state = crud.device_state.get(id_dispositivo)
+    if state is None and not crud.device_state.warmed:
+        ev = await crud.run_in_db(crud.get_last_event_data, id_dispositivo)
+        if ev:
+            crud.device_state.update(ev)
+        state = crud.device_state.get(id_dispositivo)
+    if state is None:
         return {}
+    return _state_view(state)
+
+
+def _state_view(state: dict) -> dict:
+    """Estado en memoria de un dispositivo (DeviceStateStore) tal como lo devuelve /api/last."""
+    ev = state["evento"]
+    velocidad = state["velocidad"]
+    obstaculo = state["obstaculo"]
     return {
         "id_evento": ev.get("id_evento"),
         "id_dispositivo": ev.get("id_dispositivo"),
@@ -96,13 +549,31 @@ async def last_event(id_dispositivo: int):
         "obstaculo_texto": ev.get("obstaculo_texto"),
         "id_velocidad": ev.get("id_velocidad"),
         "velocidad_texto": ev.get("velocidad_texto"),
-        "fecha_hora": ev.get("fecha_hora").isoformat() if ev.get("fecha_hora") else None
+        "fecha_hora": _iso(ev.get("fecha_hora")),
+        # 3 = Detener
+        "detenido": ev.get("id_operacion") == 3,
+        "velocidad_actual": {
+            "id_velocidad": velocidad["id_velocidad"],
+            "velocidad_texto": velocidad["velocidad_texto"],
+            "fecha_hora": _iso(velocidad["fecha_hora"])
+        } if velocidad else None,
+        "ultimo_obstaculo": {
+            "id_evento": obstaculo["id_evento"],
+            "id_obstaculo": obstaculo["id_obstaculo"],
+            "obstaculo_texto": obstaculo["obstaculo_texto"],
+            "fecha_hora": _iso(obstaculo["fecha_hora"])
+        } if obstaculo else None
     }
-    
+
+
 @app.post("/api/speed")
-async def control_velocidad(comando: dict):
+async def control_velocidad(comando: dict, request: Request, response: Response):
     """Registra un cambio de velocidad en la BD y emite broadcast. Espera: {id_dispositivo, id_cliente, id_velocidad}
     """
+    return await _idempotent(request, response, comando, lambda: _velocidad(comando))
+
+
+async def _velocidad(comando: dict) -> dict:
     try:
         required_fields = ["id_dispositivo", "id_cliente", "id_velocidad"]
         for f in required_fields:
@@ -113,94 +584,352 @@ async def control_velocidad(comando: dict):
         id_cliente = int(comando["id_cliente"]) 
         id_velocidad = int(comando["id_velocidad"]) 
 
-        # basic validation
-        if id_velocidad <= 0:
+        # validar contra el catálogo de velocidades en memoria
+        if crud.catalog.stale:
+            await crud.run_in_db(crud.catalog.reload)
+        velocidad = crud.catalog.velocidad(id_velocidad)
+        if velocidad is None or not velocidad.activo:
             raise HTTPException(status_code=400, detail="id_velocidad inválido")
 
-        ev = crud.register_velocity(id_dispositivo, id_cliente, id_velocidad)
-        if not ev:
-            raise HTTPException(status_code=500, detail="No se pudo registrar la velocidad")
-
-        payload = {
-            "tipo": "velocidad",
-            "evento": {
-                "id_evento": ev.get("id_evento"),
-                "id_dispositivo": ev.get("id_dispositivo"),
-                "id_cliente": ev.get("id_cliente"),
-                "id_velocidad": ev.get("id_velocidad"),
-                "velocidad_texto": ev.get("velocidad_texto"),
-                "fecha_hora": ev.get("fecha_hora").isoformat() if ev.get("fecha_hora") else None
-            }
-        }
-        await manager.broadcast(payload)
-        return payload["evento"]
-    except HTTPException:
+        # los cambios de velocidad seguidos del mismo carro se fusionan (gana el último)
+        return await _limited(id_dispositivo, "velocidad", (id_dispositivo, id_cliente, id_velocidad), _write_velocidad)
+    except (HTTPException, crud.EventBufferFull):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/sequence")
-async def create_sequence(comando: dict):
-    """Registra y ejecuta una secuencia de movimientos. 
-    Espera: {nombre, movimientos: [op_ids], id_dispositivo, id_cliente}
-    Devuelve: {ok, id_secuencia, mensaje}
+async def _write_velocidad(comando: tuple[int, int, int]) -> dict:
+    id_dispositivo, id_cliente, id_velocidad = comando
+    ev = await crud.run_in_db(crud.register_velocity, id_dispositivo, id_cliente, id_velocidad)
+    if not ev:
+        raise HTTPException(status_code=500, detail="No se pudo registrar la velocidad")
+
+    payload = {
+        "tipo": "velocidad",
+        "evento": {
+            "id_evento": ev.get("id_evento"),
+            "id_dispositivo": ev.get("id_dispositivo"),
+            "id_cliente": ev.get("id_cliente"),
+            "id_velocidad": ev.get("id_velocidad"),
+            "velocidad_texto": ev.get("velocidad_texto"),
+            "fecha_hora": ev.get("fecha_hora").isoformat() if ev.get("fecha_hora") else None
+        }
+    }
+    await manager.broadcast(payload)
+    await manager.send_to_device(id_dispositivo, _device_command(ev))
+    return payload["evento"]
+
+
+def _event_fields(ev: dict) -> dict:
+    return {"id_evento": ev["id_evento"], "id_dispositivo": ev["id_dispositivo"], "id_cliente": ev["id_cliente"],
+            "id_operacion": ev["id_operacion"], "id_obstaculo": ev["id_obstaculo"], "fecha_hora": _iso(ev["fecha_hora"])}
+
+
+def _insert_sequence_steps(pasos):
+    """(hilo de BD) Inserta los pasos de las ejecuciones que siguen activas. Se comprueba aquí,
+    justo antes del INSERT, porque la espera del executor puede ser larga y un obstáculo puede
+    cancelar la ejecución mientras tanto. Devuelve (pasos insertados, eventos).
     """
+    vivos = [(e, i) for e, i in pasos if e.activa]
+    if not vivos:
+        return [], []
+    rows = [{"id_dispositivo": e.id_dispositivo, "id_cliente": e.id_cliente, "id_operacion": e.secuencia.pasos[i].op} for e, i in vivos]
+    return vivos, crud.add_events_batch(rows)
+
+
+async def _run_sequence_steps(pasos):
+    """Registra (un INSERT para todos) y envía los pasos de secuencia que vencen a la vez."""
+    pasos, eventos = await crud.run_in_db(_insert_sequence_steps, pasos)
+    for (ejecucion, paso), ev in zip(pasos, eventos):
+        if not ejecucion.activa:
+            # cancelada durante el INSERT (obstáculo, stop): el paso ya no se difunde ni llega al
+            # carro, que podría arrancar de nuevo después del Detener
+            continue
+        evento = _event_fields(ev)
+        await manager.broadcast({"tipo": "movimiento", "id_secuencia": ejecucion.secuencia.id_secuencia,
+                                 "id_ejecucion": ejecucion.id_ejecucion, "paso": paso, "evento": evento})
+        await manager.send_to_device(ejecucion.id_dispositivo, _device_command(evento))
+
+
+async def _sequence_status(ejecucion, estado: str):
+    """Avisa a los monitores del estado de una ejecución (iniciada, completada, detenida, ...)."""
+    await manager.broadcast({"tipo": "secuencia", "estado": estado, **ejecucion.info()})
+
+
+async def _cancel_sequence(id_dispositivo: int, motivo: str):
+    ejecucion = scheduler.cancel(id_dispositivo)
+    if ejecucion is not None:
+        await _sequence_status(ejecucion, motivo)
+
+
+def _cancel_remote_sequences(dispositivos):
+    """Obstáculo registrado en otro worker/nodo: cancelar aquí las secuencias y los comandos
+    pendientes de esos carros."""
+    for id_dispositivo in dispositivos:
+        coalescer.supersede(id_dispositivo)
+        if scheduler.get(id_dispositivo) is not None:
+            asyncio.create_task(_cancel_sequence(id_dispositivo, "obstaculo"))
+
+
+async def _start_sequence(secuencia, id_dispositivo: int, id_cliente: int, replace: bool):
     try:
-        required_fields = ["nombre", "movimientos", "id_dispositivo", "id_cliente"]
-        for f in required_fields:
-            if f not in comando:
-                raise HTTPException(status_code=400, detail=f"Campo requerido: {f}")
+        ejecucion, previa = scheduler.run(secuencia, id_dispositivo, id_cliente, replace=replace)
+    except SequenceBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if previa is not None:
+        await _sequence_status(previa, "reemplazada")
+    await manager.broadcast({"tipo": "secuencia", "estado": "iniciada", **ejecucion.info(), "id_cliente": id_cliente,
+                             "movimientos": json.loads(canonical(secuencia.pasos))})
+    return ejecucion
 
-        nombre = str(comando["nombre"])
-        movimientos = comando["movimientos"]
-        if not isinstance(movimientos, list) or len(movimientos) == 0:
-            raise HTTPException(status_code=400, detail="movimientos debe ser una lista no vacía")
 
+@app.post("/api/sequence")
+async def create_sequence(comando: dict):
+    """Registra y ejecuta una secuencia de movimientos.
+    Espera: {nombre, movimientos: [op_id | {"op": op_id, "ms": duración}], id_dispositivo, id_cliente}
+    Una secuencia idéntica a una ya guardada reutiliza su id_secuencia. Los pasos se ejecutan en el
+    servidor, cada uno a su hora; si el carro ya ejecutaba otra secuencia, se reemplaza.
+    Devuelve: {ok, id_secuencia, id_ejecucion, nueva, mensaje}
+    """
+    required_fields = ["nombre", "movimientos", "id_dispositivo", "id_cliente"]
+    for f in required_fields:
+        if f not in comando:
+            raise HTTPException(status_code=400, detail=f"Campo requerido: {f}")
+    nombre = str(comando["nombre"])
+    try:
+        pasos = parse_pasos(comando["movimientos"])
         id_dispositivo = int(comando["id_dispositivo"])
         id_cliente = int(comando["id_cliente"])
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        secuencia, nueva = await crud.run_in_db(crud.sequences.save, nombre, pasos)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    ejecucion = await _start_sequence(secuencia, id_dispositivo, id_cliente, replace=True)
+    return {
+        "ok": True,
+        "id_secuencia": secuencia.id_secuencia,
+        "id_ejecucion": ejecucion.id_ejecucion,
+        "nueva": nueva,
+        "total_movimientos": len(pasos),
+        "mensaje": f"Secuencia '{secuencia.nombre}' (ID {secuencia.id_secuencia}) iniciada en el carrito con {len(pasos)} movimientos"
+    }
 
-        # Guardar secuencia en BD
-        import json
-        movimientos_json = json.dumps(movimientos)
-        id_secuencia = crud.save_sequence(nombre, movimientos_json, id_cliente)
-
-        # ✅ CAMBIO CRÍTICO: Enviar UNA SOLA VEZ toda la secuencia al carrito
-        payload = {
-            "tipo": "secuencia",
-            "id_dispositivo": id_dispositivo,
-            "id_cliente": id_cliente,
-            "id_secuencia": id_secuencia,
-            "nombre": nombre,
-            "movimientos": movimientos  # ✅ Array completo
-        }
-        await manager.broadcast(payload)
 
-        # Opcional: También registrar los eventos en la BD (sin enviar broadcasts individuales)
-        eventos = crud.execute_sequence(movimientos, id_dispositivo, id_cliente)
+async def _stored_sequence(id_secuencia: int):
+    secuencia = await crud.run_in_db(crud.sequences.get, id_secuencia)
+    if secuencia is None:
+        raise HTTPException(status_code=404, detail=f"Secuencia {id_secuencia} no encontrada")
+    return secuencia
 
-        return {
-            "ok": True,
-            "id_secuencia": id_secuencia,
-            "total_movimientos": len(movimientos),
-            "mensaje": f"Secuencia '{nombre}' (ID {id_secuencia}) enviada al carrito con {len(movimientos)} movimientos"
-        }
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/sequence/{id_secuencia}/start")
+async def start_sequence(id_secuencia: int, cuerpo: schemas.SequenceRunIn):
+    """Ejecuta una secuencia guardada en el carro; 409 si ya ejecuta otra."""
+    secuencia = await _stored_sequence(id_secuencia)
+    ejecucion = await _start_sequence(secuencia, cuerpo.id_dispositivo, cuerpo.id_cliente, replace=False)
+    return {"ok": True, **ejecucion.info()}
+
+
+@app.post("/api/sequence/{id_secuencia}/replay")
+async def replay_sequence(id_secuencia: int, cuerpo: schemas.SequenceRunIn):
+    """Ejecuta de nuevo una secuencia guardada desde el primer paso, reemplazando la que esté en curso."""
+    secuencia = await _stored_sequence(id_secuencia)
+    ejecucion = await _start_sequence(secuencia, cuerpo.id_dispositivo, cuerpo.id_cliente, replace=True)
+    return {"ok": True, **ejecucion.info()}
+
+
+@app.post("/api/sequence/{id_secuencia}/stop")
+async def stop_sequence(id_secuencia: int, cuerpo: schemas.SequenceRunIn):
+    """Detiene la secuencia en curso en el carro y registra y envía Detener."""
+    ejecucion = scheduler.get(cuerpo.id_dispositivo)
+    if ejecucion is None or ejecucion.secuencia.id_secuencia != id_secuencia:
+        raise HTTPException(status_code=404, detail=f"El dispositivo {cuerpo.id_dispositivo} no ejecuta la secuencia {id_secuencia}")
+    await _cancel_sequence(cuerpo.id_dispositivo, "detenida")
+    evento = await crud.run_in_db(crud.add_movement, cuerpo.id_dispositivo, cuerpo.id_cliente, 3)  # 3 = Detener
+    payload = {"tipo": "movimiento", "evento": _event_fields({f: getattr(evento, f) for f in crud._EVENT_COLUMNS if f != "id_velocidad"})}
+    await manager.broadcast(payload)
+    await manager.send_to_device(cuerpo.id_dispositivo, _device_command(payload["evento"]))
+    return {"ok": True, **ejecucion.info(), "id_evento": payload["evento"]["id_evento"]}
+
+
+@app.get("/api/sequence/activas")
+async def running_sequences():
+    """Secuencias en ejecución en este proceso."""
+    return {"ejecuciones": [e.info() for e in scheduler.running()]}
 
 # --- WebSocket endpoint ---
+def _parse_list(value, cast=str):
+    """Acepta "1,2,3" (query param) o una lista JSON; None/vacío = sin filtro."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = [v for v in value.split(",") if v.strip()]
+    return [cast(v) for v in value] or None
+
+
+def _replay_message(ev: dict) -> dict:
+    """Mensaje de broadcast equivalente a un evento leído de la BD (para reanudar monitores)."""
+    if ev["id_velocidad"] is not None:
+        return {"tipo": "velocidad", "evento": {
+            "id_evento": ev["id_evento"], "id_dispositivo": ev["id_dispositivo"], "id_cliente": ev["id_cliente"],
+            "id_velocidad": ev["id_velocidad"], "velocidad_texto": ev["velocidad_texto"], "fecha_hora": _iso(ev["fecha_hora"])}}
+    if ev["id_operacion"] == 3 and ev["id_obstaculo"] is not None:
+        return {"tipo": "obstaculo", "estado": "confirmado", "evento": _event_fields(ev)}
+    return {"tipo": "movimiento", "evento": _event_fields(ev)}
+
+
+def _snapshot_frame(client, reinicio: bool = False) -> str:
+    """Estado actual de los dispositivos del monitor. `ultimo_id_evento` sirve de `since` al reconectar."""
+    ids = client.dispositivos if client.dispositivos is not None else crud.device_state.devices()
+    estados = [crud.device_state.get(i) for i in ids]
+    return encode_message({
+        "tipo": "snapshot",
+        "reinicio": reinicio,
+        "ultimo_id_evento": max(manager.last_id, manager.replay_floor or 0),
+        "dispositivos": [_state_view(estado) for estado in estados if estado is not None and estado["evento"] is not None]
+    })
+
+
+async def _monitor_backlog(since: int | None, dispositivos):
+    """Prepara los primeros frames de un monitor: sin `since`, un snapshot del estado actual; con
+    `since`, un frame {"tipo": "reanudacion", "mensajes": [...]} con lo que se perdió, sacado del log
+    en memoria (o de la BD si el hueco es más antiguo). Si el hueco supera WS_REPLAY_DB_MAX eventos,
+    snapshot con reinicio=true. Devuelve la función que ConnectionManager.connect llama al registrarlo.
+    """
+    if since is None:
+        def snapshot(client):
+            metrics.ws_resumes.inc("snapshot")
+            return [_snapshot_frame(client)]
+        return snapshot
+    eventos, desde_bd = [], not manager.covers(since)
+    if desde_bd:
+        eventos = await crud.run_in_db(crud.get_events_since, since, dispositivos, settings.WS_REPLAY_DB_MAX + 1)
+        if len(eventos) > settings.WS_REPLAY_DB_MAX:
+            eventos = None
+    cursor = eventos[-1]["id_evento"] if eventos else since
+
+    def resume(client):
+        # el log pudo descartar frames mientras se leía la BD
+        if eventos is None or not manager.covers(cursor, complete=desde_bd):
+            metrics.ws_resumes.inc("reinicio")
+            return [_snapshot_frame(client, reinicio=True)]
+        metrics.ws_resumes.inc("bd" if desde_bd else "memoria")
+        mensajes = [_replay_message(ev) for ev in eventos]
+        frames = [encode_message(m) for m in mensajes if client.tipos is None or m["tipo"] in client.tipos]
+        frames += manager.replay_frames(client, cursor)
+        # los frames ya están serializados: se concatenan sin volver a codificarlos
+        return [f'{{"tipo":"reanudacion","desde":{since},"mensajes":[{",".join(frames)}]}}']
+    return resume
+
+
 @app.websocket("/ws/monitor")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+    """Monitor de eventos. Filtros opcionales por query (?dispositivos=1,2&tipos=movimiento,obstaculo)
+    o con un mensaje {"tipo": "subscribe", "dispositivos": [...], "tipos": [...]}.
+    Al conectar recibe un {"tipo": "snapshot"} con el estado actual; al reconectar con
+    ?since=<último id_evento recibido> recibe en su lugar un {"tipo": "reanudacion"} con los
+    mensajes que se perdió (ver _monitor_backlog).
+    El servidor envía {"tipo": "ping"} si lleva WS_PING_INTERVAL_S sin recibir nada del monitor, que
+    debe responder (con {"tipo": "pong"} o cualquier otro mensaje) antes de WS_PING_TIMEOUT_S o se
+    cierra la conexión; un {"tipo": "ping"} del cliente se responde con {"tipo": "pong"}.
+    Con ?modo=tick los mensajes llegan agrupados cada WS_TICK_MS en un {"tipo": "tick", "mensajes":
+    [...], "estado": {...}} donde "estado" trae, por dispositivo, sólo los campos que cambiaron desde
+    el tick anterior (null si el campo se vació o dejó de aplicar, como id_provisional al confirmarse
+    el obstáculo); con ?modo=tick&eventos=0 llega sólo "estado".
+    """
+    try:
+        dispositivos = _parse_list(websocket.query_params.get("dispositivos"), int)
+        since = websocket.query_params.get("since")
+        since = int(since) if since is not None else None
+        modo = websocket.query_params.get("modo", "evento")
+        if modo not in ("evento", "tick"):
+            raise ValueError(modo)
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    tipos = _parse_list(websocket.query_params.get("tipos"))
+    tick_events = websocket.query_params.get("eventos", "1").lower() not in ("0", "false", "no")
+    backlog = await _monitor_backlog(since, dispositivos)
+    await manager.connect(websocket, dispositivos, tipos, backlog=backlog, tick=modo == "tick", tick_events=tick_events)
+    try:
+        while True:
+            # el cliente puede enviar suscripciones y latidos; el resto se ignora
+            msg = await websocket.receive_text()
+            manager.touch(websocket)
+            try:
+                data = json.loads(msg)
+            except ValueError:
+                continue
+            if not isinstance(data, dict):
+                continue
+            if data.get("tipo") == "subscribe":
+                try:
+                    dispositivos = _parse_list(data.get("dispositivos"), int)
+                except (TypeError, ValueError):
+                    await manager.send_personal_message({"tipo": "error", "msg": "dispositivos inválidos"}, websocket)
+                    continue
+                tipos = _parse_list(data.get("tipos"))
+                manager.subscribe(websocket, dispositivos, tipos)
+                await manager.send_personal_message({"tipo": "subscribed", "dispositivos": dispositivos, "tipos": tipos}, websocket)
+            elif data.get("tipo") == "ping":
+                await manager.send_personal_message(_PONG, websocket)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.disconnect(websocket)
+
+
+# respuesta a {"tipo": "ping"} de un monitor
+_PONG = {"tipo": "pong"}
+
+@app.websocket("/ws/device/{id_dispositivo}")
+async def device_endpoint(websocket: WebSocket, id_dispositivo: int):
+    """Canal bidireccional del carro. Recibe sólo los comandos de su dispositivo
+    ({"t": "c", "e", "op", "v", "pwm"}, también los pasos de las secuencias) y reporta con claves cortas:
+    - obstáculo: {"t": "o", "c": id_cliente, "b": id_obstaculo} -> Detener por la vía rápida; responde {"t": "a", "p": id_provisional}
+      (como en /api/obstaculo, sin límite por carro: un Detener nunca se retrasa ni se rechaza, y la
+      obstacle lane escribe los obstáculos por lotes)
+    - telemetría: {"t": "tl", "d": {...}} -> se reenvía a los monitores como {"tipo": "telemetria"} (no se guarda)
+    - ping: {"t": "p"} -> {"t": "p"}
+    El servidor envía {"t": "hb"} si lleva WS_PING_INTERVAL_S sin recibir nada del carro; el carro debe
+    responder (con {"t": "hb"} o cualquier otro mensaje) antes de WS_PING_TIMEOUT_S o se cierra el canal.
+    """
+    await manager.connect_device(websocket, id_dispositivo)
     try:
         while True:
-            # el cliente puede enviar ping u otros mensajes; aquí sólo escuchamos
             msg = await websocket.receive_text()
-            # opcional: responder pong
-            await websocket.send_json({"tipo": "ack", "msg": f"recibido: {msg}"})
+            manager.touch(websocket)
+            try:
+                data = json.loads(msg)
+                t = data["t"]
+                if t == "o":
+                    id_cliente, id_obstaculo = int(data["c"]), _optional_int(data.get("b"))
+                    try:
+                        await _validate_obstacle(id_dispositivo, id_cliente, id_obstaculo)
+                    except ValueError as e:
+                        await manager.send_personal_message({"t": "err", "m": str(e)}, websocket)
+                        continue
+                    evento = await _report_obstacle(id_dispositivo, id_cliente, id_obstaculo)
+                    await manager.send_personal_message({"t": "a", "p": evento["id_provisional"]}, websocket)
+                elif t == "tl":
+                    await manager.broadcast({"tipo": "telemetria", "id_dispositivo": id_dispositivo, "datos": data.get("d")})
+                elif t == "p":
+                    await manager.send_personal_message({"t": "p"}, websocket)
+                elif t == "hb":
+                    pass  # respuesta al latido del servidor (ya anotada por touch)
+                else:
+                    await manager.send_personal_message({"t": "err", "m": f"tipo desconocido: {t}"}, websocket)
+            except (ValueError, KeyError, TypeError):
+                await manager.send_personal_message({"t": "err", "m": "mensaje inválido"}, websocket)
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
 if __name__ == "__main__":
-    uvicorn.run("app.main:app", host=settings.APP_HOST, port=settings.APP_PORT, reload=False)
+    # además del latido de aplicación, ping/pong del protocolo WebSocket con los mismos tiempos; con
+    # la CLI (uvicorn app.main:app) hay que pasarlos como --ws-ping-interval/--ws-ping-timeout
+    uvicorn.run("app.main:app", host=settings.APP_HOST, port=settings.APP_PORT, reload=False,
+                ws_ping_interval=settings.WS_PING_INTERVAL_S or None, ws_ping_timeout=settings.WS_PING_TIMEOUT_S or None)
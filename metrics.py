@@ -0,0 +1,177 @@
+"""Métricas en formato de texto de Prometheus, sin dependencias externas.
+
+Los histogramas usan buckets fijos y guardan una lista de contadores por combinación de
+etiquetas, creada una sola vez; observar un valor no reserva memoria nueva.
+Con METRICS_ENABLED=False todas las operaciones son no-ops.
+"""
+import bisect
+import threading
+import time
+from .config import settings
+
+# segundos: de 0.5 ms a 10 s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        if not registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Gauge:
+    """Gauge con valor fijado (set) o calculado al exportar (func)."""
+
+    def __init__(self, name: str, help: str, labels: tuple = (), func=None):
+        self.name, self.help, self.labels, self.func = name, help, labels, func
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, *labels):
+        if registry.enabled:
+            self._values[labels] = value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        if self.func is not None:
+            yield f"{self.name} {self.func()}"
+            return
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        # etiquetas -> [contador por bucket..., +Inf, suma]
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        if not registry.enabled:
+            return
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series.setdefault(labels, [0] * (len(self.buckets) + 2))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series[i] += 1
+            series[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in list(self._series.items()):
+            base = _labels(self.labels, labels)[1:-1]
+            sep = "," if base else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                yield f'{self.name}_bucket{{{base}{sep}le="{bound}"}} {cumulative}'
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {series[-1]}"
+
+
+class Registry:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry(settings.METRICS_ENABLED)
+
+http_request_seconds = registry.register(Histogram(
+    "http_request_duration_seconds", "Latencia de las peticiones HTTP por ruta", ("method", "route", "status")))
+db_call_seconds = registry.register(Histogram(
+    "db_call_duration_seconds", "Duración de las funciones de crud ejecutadas en el executor de BD", ("function",)))
+db_call_errors = registry.register(Counter(
+    "db_call_errors_total", "Errores en funciones de crud", ("function",)))
+# el executor tiene tantos hilos como conexiones el pool (sin overflow), así que esperar un hilo
+# equivale a esperar una conexión del pool
+db_executor_wait_seconds = registry.register(Histogram(
+    "db_executor_wait_seconds", "Espera hasta obtener un hilo del executor de BD (y con él una conexión del pool)"))
+broadcast_seconds = registry.register(Histogram(
+    "ws_broadcast_duration_seconds", "Duración del reparto (encolado) de un broadcast", ("kind",)))
+obstacle_broadcast_seconds = registry.register(Histogram(
+    "obstacle_broadcast_seconds", "Desde que llega un obstáculo hasta que su Detener está encolado para monitores y carro"))
+obstacle_persist_seconds = registry.register(Histogram(
+    "obstacle_persist_seconds", "Desde que llega un obstáculo hasta que queda escrito en Events",
+    buckets=DEFAULT_BUCKETS + (30.0, 60.0, 300.0)))
+obstacle_persist_errors = registry.register(Counter(
+    "obstacle_persist_errors_total", "Intentos fallidos de escribir obstáculos en la BD"))
+events_dead_letters = registry.register(Counter(
+    "events_dead_letter_total", "Eventos del buffer write-behind rechazados por la BD y apartados en EVENTS_DEAD_LETTER"))
+obstacle_dead_letters = registry.register(Counter(
+    "obstacle_dead_letter_total", "Obstáculos rechazados por la BD y apartados en la dead-letter del journal"))
+idempotency_replays = registry.register(Counter(
+    "idempotency_replays_total", "Reintentos con clave de idempotencia respondidos sin volver a ejecutarse"))
+commands_coalesced = registry.register(Counter(
+    "commands_coalesced_total", "Comandos de movimiento/velocidad fusionados con uno posterior del mismo carro", ("tipo",)))
+commands_rejected = registry.register(Counter(
+    "commands_rejected_total", "Comandos rechazados por superar el límite del carro", ("tipo",)))
+commands_superseded = registry.register(Counter(
+    "commands_superseded_total", "Comandos pendientes descartados por un obstáculo", ("tipo",)))
+ws_resumes = registry.register(Counter(
+    "ws_monitor_resumes_total", "Conexiones a /ws/monitor por cómo recibieron lo que se habían perdido", ("fuente",)))
+ws_reaped_connections = registry.register(Counter(
+    "ws_reaped_connections_total", "Conexiones WebSocket cerradas por no completar el latido"))
+ws_connection_seconds = registry.register(Histogram(
+    "ws_connection_duration_seconds", "Duración de las conexiones WebSocket al cerrarse",
+    buckets=(1.0, 10.0, 60.0, 300.0, 900.0, 3600.0, 14400.0, 86400.0)))
+ws_dropped_frames = registry.register(Counter(
+    "ws_dropped_frames_total", "Frames descartados por colas de salida llenas"))
+
+
+class MetricsMiddleware:
+    """Middleware ASGI que mide la latencia por ruta (plantilla de la ruta, no la URL)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not registry.enabled:
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            http_request_seconds.observe(time.perf_counter() - start, scope["method"],
+                                         getattr(route, "path", "unmatched"), status)
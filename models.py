@@ -1,4 +1,4 @@
-from sqlalchemy import (Column, Integer, String, DateTime, ForeignKey, DECIMAL, JSON, Boolean, Table)
+from sqlalchemy import (Column, Integer, String, Text, DateTime, ForeignKey, DECIMAL, JSON, Boolean, Float, Table, Index)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
@@ -37,6 +37,13 @@ class ClientesIoT(Base):
     longitud = Column(DECIMAL(10,6), nullable=False)
     latitud = Column(DECIMAL(10,6), nullable=False)
 
+class SecuenciasDemo(Base):
+    __tablename__ = "SecuenciasDemo"
+    id_secuencia = Column(Integer, primary_key=True, autoincrement=True)
+    nombre_secuencia = Column(String(100), nullable=False)
+    movimientos = Column(Text, nullable=False)  # lista JSON de id_operacion
+    activa = Column(Boolean, default=True)
+
 class Events(Base):
     __tablename__ = "Events"
     id_evento = Column(Integer, primary_key=True, autoincrement=True)
@@ -47,8 +54,26 @@ class Events(Base):
     id_obstaculo = Column(Integer, ForeignKey("Obstaculos.id_obstaculo"), nullable=True)
     fecha_hora = Column(DateTime, server_default=func.now())
 
+    # historial por dispositivo con paginación keyset sobre (fecha_hora, id_evento); en una BD existente:
+    # CREATE INDEX ix_events_dispositivo_fecha_evento ON Events (id_dispositivo, fecha_hora, id_evento);
+    __table_args__ = (
+        Index("ix_events_dispositivo_fecha_evento", "id_dispositivo", "fecha_hora", "id_evento"),
+    )
+
     dispositivo = relationship("Dispositivos")
     cliente = relationship("ClientesIoT")
     operacion = relationship("Operations")
     obstaculo = relationship("Obstaculos", lazy="joined")
     velocidad = relationship("Velocidades", lazy="joined")
+
+# rollups por dispositivo y periodo: conteo de operaciones y obstáculos y segundos en cada
+# velocidad; los mantiene stats.StatsAggregator
+class EstadisticasDispositivo(Base):
+    __tablename__ = "EstadisticasDispositivo"
+    id_dispositivo = Column(Integer, primary_key=True)
+    periodo = Column(String(4), primary_key=True)       # "hora" | "dia"
+    inicio = Column(DateTime, primary_key=True)         # inicio del bucket
+    metrica = Column(String(16), primary_key=True)      # "operacion" | "obstaculo" | "velocidad_seg"
+    clave = Column(Integer, primary_key=True)           # id_operacion / id_obstaculo / id_velocidad
+    valor = Column(Float, nullable=False, default=0)
+
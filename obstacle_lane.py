@@ -0,0 +1,236 @@
+"""Vía rápida para los obstáculos (Detener): difundir primero, persistir después.
+
+El obstáculo recibe un id provisional y una fecha_hora en memoria y se difunde a los monitores
+y al carro sin esperar a la BD. Antes de responder se anota en un journal en disco (append +
+fsync, fuera del event loop); una tarea de fondo lo escribe en Events por lotes, con reintentos
+y espera creciente mientras la BD no responda, y avisa con el id_evento definitivo.
+
+Cada proceso usa `<dir>/<pid>.jsonl`, protegido por un flock sobre `<pid>.lock` mientras vive.
+Al arrancar, un proceso adopta los journals cuyo lock está libre (su dueño terminó) y los
+escribe como propios; esas filas se comprueban contra Events antes de insertar por si ya se
+habían escrito justo antes de la caída.
+
+Si un lote falla con un error permanente (`permanent_errors`, p. ej. una FK inexistente), los
+obstáculos se escriben de uno en uno para que una fila inválida no bloquee a las demás; las que
+la BD rechaza van a `<dir>/dead-letter.ndjson` (con el error) en lugar de reintentarse.
+"""
+import asyncio
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class ObstacleLane:
+    def __init__(self, directory: str, retry_max: float = 30.0, permanent_errors: tuple = ()):
+        self.directory = directory
+        self.retry_max = retry_max
+        # errores de escritura que no se resuelven reintentando
+        self.permanent_errors = permanent_errors
+        self.dead_letters = 0
+        # id_provisional -> obstáculo pendiente de escribir (orden de llegada)
+        self._pending: dict[str, dict] = {}
+        # id_provisional -> instante (perf_counter) en que llegó, para la métrica de persistencia
+        self._received: dict[str, float] = {}
+        self._ready = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._file = None
+        self._lock_file = None
+        self._file_lock = threading.Lock()
+        self._task = None
+        self._run_in_db = self._persist = self._confirm = self._discard = None
+
+    def provisional(self, id_dispositivo: int, id_cliente: int, id_obstaculo: int | None) -> dict:
+        """Evento Detener (id_operacion 3) con id provisional, aún sin escribir."""
+        item = {"id_provisional": uuid.uuid4().hex[:16], "id_dispositivo": id_dispositivo, "id_cliente": id_cliente,
+                "id_operacion": 3, "id_obstaculo": id_obstaculo, "fecha_hora": datetime.utcnow()}
+        self._received[item["id_provisional"]] = time.perf_counter()
+        return item
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    # --- journal (se usa desde hilos: open/fsync no deben bloquear el event loop) ---
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"{pid}.jsonl")
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = open(os.path.join(self.directory, f"{os.getpid()}.lock"), "w")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self._file = open(self._path(os.getpid()), "a")
+
+    def _append(self, items: list[dict]):
+        with self._file_lock:
+            for item in items:
+                self._file.write(json.dumps({**item, "fecha_hora": item["fecha_hora"].isoformat()}) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _rewrite(self, items: list[dict]):
+        """Deja en el journal sólo `items` (los que siguen pendientes)."""
+        with self._file_lock:
+            if not items:
+                self._file.truncate(0)
+                return
+            path = self._path(os.getpid())
+            with open(path + ".tmp", "w") as f:
+                for item in items:
+                    f.write(json.dumps({**item, "fecha_hora": item["fecha_hora"].isoformat()}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+            self._file.close()
+            self._file = open(path, "a")
+
+    def _dead_letter(self, item: dict, error: str):
+        with self._file_lock:
+            with open(os.path.join(self.directory, "dead-letter.ndjson"), "a") as f:
+                f.write(json.dumps({**item, "fecha_hora": item["fecha_hora"].isoformat(), "error": error}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _recover(self) -> list[dict]:
+        """Adopta los journals de procesos terminados. Devuelve sus obstáculos."""
+        recovered = []
+        for path in glob.glob(os.path.join(self.directory, "*.jsonl")):
+            pid = os.path.basename(path).split(".")[0]
+            if pid == str(os.getpid()):
+                continue
+            lock_path = os.path.join(self.directory, f"{pid}.lock")
+            with open(lock_path, "w") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # su dueño sigue vivo
+                with open(path) as f:
+                    items = [json.loads(line) for line in f if line.strip()]
+                for item in items:
+                    item["fecha_hora"] = datetime.fromisoformat(item["fecha_hora"])
+                    item["recuperado"] = True
+                # primero se copian al journal propio, después se borra el ajeno
+                self._append(items)
+                os.unlink(path)
+            os.unlink(lock_path)
+            recovered.extend(items)
+        return recovered
+
+    # --- ciclo de vida ---
+
+    async def start(self, run_in_db, persist, confirm, on_error=None, discard=None):
+        """Abre el journal, adopta los huérfanos y arranca la tarea que escribe en la BD.
+        persist(items) -> eventos (en hilo de BD); confirm(item, evento, segundos) tras escribirse;
+        discard(item, error) cuando la BD lo rechaza de forma permanente (va a la dead-letter).
+        """
+        self._run_in_db, self._persist, self._confirm, self._discard = run_in_db, persist, confirm, discard
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._open)
+        for item in await loop.run_in_executor(None, self._recover):
+            self._pending[item["id_provisional"]] = item
+        if self._pending:
+            logger.warning("%d obstáculos recuperados del journal", len(self._pending))
+            self._ready.set()
+        self._task = asyncio.create_task(self._run(on_error))
+
+    async def submit(self, item: dict):
+        """Anota el obstáculo en el journal (durable) y lo encola para escribirlo en la BD."""
+        # pendiente antes de anotarlo: si entretanto se reescribe el journal, lo conserva
+        self._pending[item["id_provisional"]] = item
+        await asyncio.get_running_loop().run_in_executor(None, self._append, [item])
+        self._ready.set()
+
+    async def _run(self, on_error):
+        backoff = 0.1
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            if self._stopping.is_set():
+                return
+            if await self._write():
+                backoff = 0.1
+                continue
+            if on_error is not None:
+                on_error()
+            # BD caída o lenta: los obstáculos siguen en el journal; stop() interrumpe la espera
+            try:
+                await asyncio.wait_for(self._stopping.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+            backoff = min(backoff * 2, self.retry_max)
+            self._ready.set()
+
+    async def _write(self) -> bool:
+        """Escribe lo pendiente. False si hay que reintentar más tarde."""
+        items = list(self._pending.values())
+        if not items:
+            return True
+        try:
+            eventos = await self._run_in_db(self._persist, items)
+        except self.permanent_errors as e:
+            if len(items) == 1:
+                await self._reject(items[0], e)
+                ok = True
+            else:
+                # alguna fila es inválida: de uno en uno, para escribir las demás
+                ok = await self._write_each(items)
+        except Exception:
+            logger.exception("No se pudieron escribir %d obstáculos; se reintentará", len(items))
+            return False
+        else:
+            for item, evento in zip(items, eventos):
+                await self._confirmed(item, evento)
+            ok = True
+        await asyncio.get_running_loop().run_in_executor(None, self._rewrite, list(self._pending.values()))
+        return ok
+
+    async def _write_each(self, items: list[dict]) -> bool:
+        for item in items:
+            try:
+                eventos = await self._run_in_db(self._persist, [item])
+            except self.permanent_errors as e:
+                await self._reject(item, e)
+            except Exception:
+                logger.exception("No se pudo escribir el obstáculo %s; se reintentará", item["id_provisional"])
+                return False
+            else:
+                await self._confirmed(item, eventos[0])
+        return True
+
+    async def _confirmed(self, item: dict, evento: dict):
+        del self._pending[item["id_provisional"]]
+        elapsed = time.perf_counter() - self._received.pop(item["id_provisional"], time.perf_counter())
+        await self._confirm(item, evento, elapsed)
+
+    async def _reject(self, item: dict, e: Exception):
+        """Error permanente: el obstáculo pasa a la dead-letter y deja de reintentarse."""
+        # el mensaje del driver (sin la SQL ni los parámetros que añade SQLAlchemy)
+        error = f"{type(e).__name__}: {getattr(e, 'orig', None) or e}"
+        logger.error("Obstáculo %s descartado: %s", item["id_provisional"], error)
+        await asyncio.get_running_loop().run_in_executor(None, self._dead_letter, item, error)
+        del self._pending[item["id_provisional"]]
+        self._received.pop(item["id_provisional"], None)
+        self.dead_letters += 1
+        if self._discard is not None:
+            await self._discard(item, error)
+
+    async def stop(self):
+        """Último intento de escribir lo pendiente; si falla queda en el journal para el próximo arranque."""
+        if self._task is not None:
+            # sin cancelar: una escritura en curso debe terminar para no repetirla
+            self._stopping.set()
+            self._ready.set()
+            await self._task
+            self._task = None
+        if self._file is not None:
+            await self._write()
+            self._file.close()
+            self._lock_file.close()
+            self._file = None
@@ -1,11 +1,13 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import Annotated, List, Literal, Optional, Union
 
 class MovementIn(BaseModel):
     id_dispositivo: int
     id_cliente: int
     id_operacion: int
     id_obstaculo: Optional[int] = None
+    # clave de idempotencia (alternativa a la cabecera Idempotency-Key)
+    idempotency_key: Optional[str] = None
 
 class MovementOut(BaseModel):
     id_evento: int
@@ -14,3 +16,32 @@ class MovementOut(BaseModel):
     id_operacion: int
     id_obstaculo: Optional[int]
     fecha_hora: str
+
+class SpeedIn(BaseModel):
+    id_dispositivo: int
+    id_cliente: int
+    id_velocidad: int
+
+class SequenceRunIn(BaseModel):
+    id_dispositivo: int
+    id_cliente: int
+
+class ObstacleIn(BaseModel):
+    id_dispositivo: int
+    id_cliente: int
+    id_obstaculo: Optional[int] = None
+
+# --- Lote de comandos (/api/events/batch) ---
+class BatchMovement(MovementIn):
+    tipo: Literal["movimiento"]
+
+class BatchSpeed(SpeedIn):
+    tipo: Literal["velocidad"]
+
+class BatchObstacle(ObstacleIn):
+    tipo: Literal["obstaculo"]
+
+BatchCommand = Annotated[Union[BatchMovement, BatchSpeed, BatchObstacle], Field(discriminator="tipo")]
+
+class BatchIn(BaseModel):
+    comandos: List[BatchCommand]
@@ -0,0 +1,281 @@
+"""Secuencias de movimientos: definiciones deduplicadas y ejecución pautada en el servidor.
+
+Una secuencia es una lista de pasos; cada paso es un id_operacion (dura SEQUENCE_STEP_MS) o
+{"op": id_operacion, "ms": duración}. Las definiciones se guardan en SecuenciasDemo en forma
+canónica y se identifican por el hash de su contenido: registrar dos veces la misma lista de
+pasos devuelve el mismo id_secuencia. Las secuencias ya leídas quedan en memoria.
+
+SequenceScheduler ejecuta las secuencias de todos los carros con una sola tarea y un heap de
+vencimientos: en cada vencimiento se registran juntos (un INSERT por lote) los pasos que tocan,
+cada uno con la hora en que se ejecuta de verdad. Un carro ejecuta una secuencia a la vez; la
+ejecución se cancela con stop, al reemplazarla por otra o al detectarse un obstáculo.
+"""
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import threading
+from typing import NamedTuple
+from sqlalchemy import select
+from .config import settings
+from .models import SecuenciasDemo
+
+logger = logging.getLogger(__name__)
+
+
+class Paso(NamedTuple):
+    op: int
+    ms: int | None  # None = duración por defecto
+
+
+class Secuencia(NamedTuple):
+    id_secuencia: int
+    nombre: str
+    pasos: tuple[Paso, ...]
+    hash: str
+
+
+def parse_pasos(movimientos) -> tuple[Paso, ...]:
+    """Valida y normaliza la lista de pasos. ValueError si no es válida."""
+    if not isinstance(movimientos, list) or not movimientos:
+        raise ValueError("movimientos debe ser una lista no vacía")
+    pasos = []
+    for i, paso in enumerate(movimientos):
+        if isinstance(paso, dict):
+            op, ms = paso.get("op"), paso.get("ms")
+        else:
+            op, ms = paso, None
+        if isinstance(op, bool) or not isinstance(op, int) or (ms is not None and (isinstance(ms, bool) or not isinstance(ms, int) or ms < 0)):
+            raise ValueError(f"movimientos[{i}] inválido")
+        pasos.append(Paso(op, ms))
+    return tuple(pasos)
+
+
+def canonical(pasos: tuple[Paso, ...]) -> str:
+    """JSON canónico de los pasos (lo que se guarda en SecuenciasDemo.movimientos)."""
+    return json.dumps([p.op if p.ms is None else {"op": p.op, "ms": p.ms} for p in pasos], separators=(",", ":"))
+
+
+def content_hash(pasos: tuple[Paso, ...]) -> str:
+    return hashlib.sha256(canonical(pasos).encode()).hexdigest()
+
+
+class SequenceStore:
+    """Definiciones de secuencias en memoria, indexadas por id y por hash de contenido."""
+
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+        self._by_id: dict[int, Secuencia] = {}
+        self._by_hash: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, row) -> Secuencia:
+        pasos = parse_pasos(json.loads(row.movimientos))
+        secuencia = Secuencia(row.id_secuencia, row.nombre_secuencia, pasos, content_hash(pasos))
+        self._by_id[secuencia.id_secuencia] = secuencia
+        # ante duplicados antiguos se conserva el id más bajo
+        if self._by_hash.setdefault(secuencia.hash, secuencia.id_secuencia) > secuencia.id_secuencia:
+            self._by_hash[secuencia.hash] = secuencia.id_secuencia
+        return secuencia
+
+    def load(self):
+        """Carga todas las secuencias activas (para deduplicar contra las existentes)."""
+        session = self._session_factory()
+        try:
+            rows = session.execute(select(SecuenciasDemo).where(SecuenciasDemo.activa.is_(True))).scalars().all()
+        finally:
+            session.close()
+        with self._lock:
+            for row in rows:
+                try:
+                    self._add(row)
+                except ValueError:
+                    logger.warning("Secuencia %s con movimientos inválidos; se ignora", row.id_secuencia)
+
+    def get(self, id_secuencia: int) -> Secuencia | None:
+        secuencia = self._by_id.get(id_secuencia)
+        if secuencia is not None:
+            return secuencia
+        session = self._session_factory()
+        try:
+            row = session.get(SecuenciasDemo, id_secuencia)
+        finally:
+            session.close()
+        if row is None or not row.activa:
+            return None
+        with self._lock:
+            return self._add(row)
+
+    def save(self, nombre: str, pasos: tuple[Paso, ...]) -> tuple[Secuencia, bool]:
+        """Devuelve la secuencia con esos pasos, creándola si no existe. (secuencia, creada)."""
+        digest = content_hash(pasos)
+        with self._lock:
+            id_secuencia = self._by_hash.get(digest)
+            if id_secuencia is not None:
+                return self._by_id[id_secuencia], False
+            movimientos = canonical(pasos)
+            session = self._session_factory()
+            try:
+                # otro worker pudo haberla creado: se busca por su forma canónica antes de insertar
+                row = session.execute(select(SecuenciasDemo).where(
+                    SecuenciasDemo.movimientos == movimientos, SecuenciasDemo.activa.is_(True)
+                ).order_by(SecuenciasDemo.id_secuencia).limit(1)).scalar()
+                created = row is None
+                if created:
+                    row = SecuenciasDemo(nombre_secuencia=nombre, movimientos=movimientos, activa=True)
+                    session.add(row)
+                    session.commit()
+                return self._add(row), created
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+
+class Ejecucion:
+    """Una secuencia en curso en un carro."""
+    __slots__ = ("id_ejecucion", "secuencia", "id_dispositivo", "id_cliente", "paso", "vence", "activa")
+
+    def __init__(self, id_ejecucion: int, secuencia: Secuencia, id_dispositivo: int, id_cliente: int):
+        self.id_ejecucion = id_ejecucion
+        self.secuencia = secuencia
+        self.id_dispositivo = id_dispositivo
+        self.id_cliente = id_cliente
+        self.paso = 0
+        self.vence = 0.0
+        self.activa = True
+
+    def info(self) -> dict:
+        return {"id_ejecucion": self.id_ejecucion, "id_secuencia": self.secuencia.id_secuencia,
+                "nombre": self.secuencia.nombre, "id_dispositivo": self.id_dispositivo,
+                "paso": self.paso, "total_pasos": len(self.secuencia.pasos)}
+
+
+class SequenceBusy(Exception):
+    """El carro ya ejecuta una secuencia."""
+
+
+class SequenceScheduler:
+    """Ejecuta las secuencias de todos los carros con una única tarea (heap de vencimientos).
+
+    `execute(pasos)` recibe la lista [(ejecucion, indice_paso)] que vence en el mismo instante y
+    debe registrarlos y enviarlos; `finished(ejecucion, motivo)` se llama al terminar una
+    ejecución ("completada", "error"). Las cancelaciones las gestiona quien llama a cancel().
+    """
+
+    def __init__(self, step_ms: int):
+        self.step_ms = step_ms
+        self._heap: list[tuple[float, int, Ejecucion]] = []
+        self._runs: dict[int, Ejecucion] = {}
+        self._ids = itertools.count(1)
+        self._order = itertools.count()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._execute = None
+        self._finished = None
+
+    def start(self, execute, finished):
+        self._execute, self._finished = execute, finished
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._runs.clear()
+        self._heap.clear()
+
+    def running(self) -> list[Ejecucion]:
+        return list(self._runs.values())
+
+    def get(self, id_dispositivo: int) -> Ejecucion | None:
+        return self._runs.get(id_dispositivo)
+
+    def run(self, secuencia: Secuencia, id_dispositivo: int, id_cliente: int, replace: bool = True) -> tuple[Ejecucion, Ejecucion | None]:
+        """Programa la secuencia en el carro desde el primer paso. Devuelve (nueva, reemplazada)."""
+        if not replace and id_dispositivo in self._runs:
+            raise SequenceBusy(f"el dispositivo {id_dispositivo} ya ejecuta una secuencia")
+        previous = self.cancel(id_dispositivo)
+        ejecucion = Ejecucion(next(self._ids), secuencia, id_dispositivo, id_cliente)
+        self._runs[id_dispositivo] = ejecucion
+        self._push(ejecucion, asyncio.get_running_loop().time())
+        return ejecucion, previous
+
+    def cancel(self, id_dispositivo: int) -> Ejecucion | None:
+        """Cancela la ejecución del carro (su entrada en el heap se descarta al vencer)."""
+        ejecucion = self._runs.pop(id_dispositivo, None)
+        if ejecucion is not None:
+            ejecucion.activa = False
+        return ejecucion
+
+    def _push(self, ejecucion: Ejecucion, vence: float):
+        ejecucion.vence = vence
+        heapq.heappush(self._heap, (vence, next(self._order), ejecucion))
+        if self._heap[0][2] is ejecucion:
+            # vence antes que lo que esperaba el bucle
+            self._wake.set()
+
+    async def _sleep_until_due(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wake.clear()
+            if self._heap:
+                delay = self._heap[0][0] - loop.time()
+                if delay <= 0:
+                    return
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    return
+            else:
+                await self._wake.wait()
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._sleep_until_due()
+            now = loop.time()
+            pasos = []
+            while self._heap and self._heap[0][0] <= now:
+                _, _, ejecucion = heapq.heappop(self._heap)
+                if not ejecucion.activa:
+                    continue
+                if ejecucion.paso >= len(ejecucion.secuencia.pasos):
+                    self._runs.pop(ejecucion.id_dispositivo, None)
+                    ejecucion.activa = False
+                    await self._notify(ejecucion, "completada")
+                else:
+                    pasos.append((ejecucion, ejecucion.paso))
+            if not pasos:
+                continue
+            try:
+                await self._execute(pasos)
+            except Exception:
+                logger.exception("Error ejecutando pasos de secuencia")
+                for ejecucion, _ in pasos:
+                    if ejecucion.activa:
+                        self.cancel(ejecucion.id_dispositivo)
+                        await self._notify(ejecucion, "error")
+                continue
+            for ejecucion, paso in pasos:
+                if ejecucion.activa:
+                    ms = ejecucion.secuencia.pasos[paso].ms
+                    ejecucion.paso = paso + 1
+                    # sobre la hora planificada, no la real: los retrasos no se acumulan
+                    self._push(ejecucion, ejecucion.vence + (self.step_ms if ms is None else ms) / 1000)
+
+    async def _notify(self, ejecucion: Ejecucion, motivo: str):
+        try:
+            await self._finished(ejecucion, motivo)
+        except Exception:
+            logger.exception("Error notificando el fin de la secuencia %s", ejecucion.id_ejecucion)
+
+
+scheduler = SequenceScheduler(settings.SEQUENCE_STEP_MS)
@@ -0,0 +1,236 @@
+"""Estadísticas incrementales por dispositivo (tabla EstadisticasDispositivo).
+
+Por dispositivo y bucket de hora y de día se cuentan las operaciones (por id_operacion), los
+obstáculos (por id_obstaculo) y los segundos pasados en cada velocidad (por id_velocidad;
+una velocidad rige desde su evento hasta el siguiente cambio de velocidad).
+
+Los eventos se acumulan en memoria como deltas y se suman a la tabla periódicamente, así
+que consultar un rango cuesta O(buckets) y nunca recorre Events. Para reconstruir la tabla
+desde Events (con la API detenida):
+
+    python -m app.stats backfill
+"""
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import and_, bindparam, delete, insert, or_, select, update
+from .models import EstadisticasDispositivo, Events
+
+PERIODOS = ("hora", "dia")
+
+
+def bucket_start(fecha_hora: datetime, periodo: str) -> datetime:
+    if periodo == "hora":
+        return fecha_hora.replace(minute=0, second=0, microsecond=0)
+    return fecha_hora.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _bucket_end(inicio: datetime, periodo: str) -> datetime:
+    return inicio + (timedelta(hours=1) if periodo == "hora" else timedelta(days=1))
+
+
+class StatsAggregator:
+    def __init__(self, session_factory):
+        self._session_factory = session_factory
+        # (id_dispositivo, periodo, inicio, metrica, clave) -> delta pendiente de escribir
+        self._pending: dict[tuple, float] = defaultdict(float)
+        # id_dispositivo -> (id_velocidad vigente, desde cuándo se contabiliza)
+        self._speed: dict[int, tuple[int, datetime]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def warm(self, velocidades: dict[int, int], since: datetime):
+        """Toma la velocidad vigente de cada dispositivo y empieza a contar su tiempo desde `since`."""
+        with self._lock:
+            for id_dispositivo, id_velocidad in velocidades.items():
+                self._speed.setdefault(id_dispositivo, (id_velocidad, since))
+
+    def record(self, evento):
+        """Suma un evento (dict o fila con id_dispositivo, id_operacion, id_obstaculo, id_velocidad, fecha_hora)."""
+        get = evento.get if isinstance(evento, dict) else lambda f: getattr(evento, f)
+        id_dispositivo, fecha_hora = get("id_dispositivo"), get("fecha_hora")
+        id_obstaculo, id_velocidad = get("id_obstaculo"), get("id_velocidad")
+        with self._lock:
+            for periodo in PERIODOS:
+                inicio = bucket_start(fecha_hora, periodo)
+                self._pending[(id_dispositivo, periodo, inicio, "operacion", get("id_operacion"))] += 1
+                if id_obstaculo is not None:
+                    self._pending[(id_dispositivo, periodo, inicio, "obstaculo", id_obstaculo)] += 1
+            if id_velocidad is not None:
+                self._accrue_speed(id_dispositivo, fecha_hora)
+                self._speed[id_dispositivo] = (id_velocidad, fecha_hora)
+
+    def release_speed(self, evento: dict):
+        """Cambio de velocidad registrado por otro proceso: el tiempo hasta ese momento se
+        contabiliza aquí y desde entonces lo cuenta él (cada tramo lo suma un solo worker).
+        """
+        if evento.get("id_velocidad") is None:
+            return
+        with self._lock:
+            self._accrue_speed(evento["id_dispositivo"], evento["fecha_hora"])
+            self._speed.pop(evento["id_dispositivo"], None)
+
+    def _accrue_speed(self, id_dispositivo: int, until: datetime):
+        """Suma el tiempo de la velocidad vigente hasta `until`, repartido por buckets."""
+        current = self._speed.get(id_dispositivo)
+        if current is None:
+            return
+        id_velocidad, since = current
+        if until <= since:
+            return
+        for periodo in PERIODOS:
+            start = since
+            while start < until:
+                inicio = bucket_start(start, periodo)
+                end = min(_bucket_end(inicio, periodo), until)
+                self._pending[(id_dispositivo, periodo, inicio, "velocidad_seg", id_velocidad)] += (end - start).total_seconds()
+                start = end
+        self._speed[id_dispositivo] = (id_velocidad, until)
+
+    def flush(self, now: datetime | None = None, close_speed: bool = True) -> int:
+        """Suma los deltas a la tabla en una transacción (UPDATE por lotes para las filas que ya
+        existen, INSERT por lotes para las nuevas). Con `close_speed` antes contabiliza el tiempo
+        de la velocidad vigente de cada dispositivo hasta `now`.
+        """
+        now = now or datetime.utcnow()
+        with self._flush_lock:
+            with self._lock:
+                if close_speed:
+                    for id_dispositivo in list(self._speed):
+                        self._accrue_speed(id_dispositivo, now)
+                pending, self._pending = self._pending, defaultdict(float)
+            if not pending:
+                return 0
+            session = self._session_factory()
+            try:
+                table = EstadisticasDispositivo.__table__
+                # qué filas ya existen: una consulta por (dispositivo, periodo) sobre el rango de buckets
+                ranges: dict[tuple, list] = {}
+                for id_dispositivo, periodo, inicio, _, _ in pending:
+                    bounds = ranges.setdefault((id_dispositivo, periodo), [inicio, inicio])
+                    bounds[0], bounds[1] = min(bounds[0], inicio), max(bounds[1], inicio)
+                existing = set()
+                for (id_dispositivo, periodo), (first, last) in ranges.items():
+                    existing.update(tuple(row) for row in session.execute(
+                        select(table.c.id_dispositivo, table.c.periodo, table.c.inicio, table.c.metrica, table.c.clave).where(
+                            (table.c.id_dispositivo == id_dispositivo) & (table.c.periodo == periodo)
+                            & (table.c.inicio >= first) & (table.c.inicio <= last))))
+                updates, inserts = [], []
+                for (id_dispositivo, periodo, inicio, metrica, clave), delta in pending.items():
+                    row = {"d": id_dispositivo, "p": periodo, "i": inicio, "m": metrica, "c": clave, "v": delta}
+                    (updates if (id_dispositivo, periodo, inicio, metrica, clave) in existing else inserts).append(row)
+                if updates:
+                    session.execute(update(table).where(
+                        (table.c.id_dispositivo == bindparam("d")) & (table.c.periodo == bindparam("p"))
+                        & (table.c.inicio == bindparam("i")) & (table.c.metrica == bindparam("m")) & (table.c.clave == bindparam("c"))
+                    ).values(valor=table.c.valor + bindparam("v")), updates)
+                if inserts:
+                    session.execute(insert(table), [{"id_dispositivo": r["d"], "periodo": r["p"], "inicio": r["i"], "metrica": r["m"],
+                                                     "clave": r["c"], "valor": r["v"]} for r in inserts])
+                session.commit()
+                return len(pending)
+            except Exception:
+                session.rollback()
+                # conservar los deltas para el próximo intento
+                with self._lock:
+                    for key, delta in pending.items():
+                        self._pending[key] += delta
+                raise
+            finally:
+                session.close()
+
+    def query(self, id_dispositivo: int, periodo: str, desde: datetime, hasta: datetime) -> dict:
+        """Buckets del rango [desde, hasta]: persistidos + deltas en memoria + tiempo de la velocidad vigente.
+        Devuelve {inicio: {metrica: {clave: valor}}}.
+        """
+        desde, hasta = bucket_start(desde, periodo), bucket_start(hasta, periodo)
+        buckets: dict = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))
+        session = self._session_factory()
+        try:
+            table = EstadisticasDispositivo.__table__
+            rows = session.execute(select(table.c.inicio, table.c.metrica, table.c.clave, table.c.valor).where(
+                (table.c.id_dispositivo == id_dispositivo) & (table.c.periodo == periodo)
+                & (table.c.inicio >= desde) & (table.c.inicio <= hasta)))
+            for inicio, metrica, clave, valor in rows:
+                buckets[inicio][metrica][clave] += valor
+        finally:
+            session.close()
+        with self._lock:
+            extra = [(k, v) for k, v in self._pending.items() if k[0] == id_dispositivo and k[1] == periodo]
+            current = self._speed.get(id_dispositivo)
+        for (_, _, inicio, metrica, clave), valor in extra:
+            if desde <= inicio <= hasta:
+                buckets[inicio][metrica][clave] += valor
+        if current is not None:
+            # tramo abierto de la velocidad vigente (aún no contabilizado)
+            id_velocidad, since = current
+            now = datetime.utcnow()
+            start = since
+            while start < now:
+                inicio = bucket_start(start, periodo)
+                end = min(_bucket_end(inicio, periodo), now)
+                if desde <= inicio <= hasta:
+                    buckets[inicio]["velocidad_seg"][id_velocidad] += (end - start).total_seconds()
+                start = end
+        return buckets
+
+
+def backfill(session_factory, chunk_size: int = 5000, archive=None) -> int:
+    """Reconstruye EstadisticasDispositivo desde Events en una sola pasada.
+    Borra la tabla y recorre Events por bloques en orden (id_dispositivo, fecha_hora, id_evento),
+    paginando por keyset sobre ix_events_dispositivo_fecha_evento; cada bloque se escribe antes
+    de leer el siguiente, así que la memoria no depende del tamaño de Events. Con `archive`
+    (archive.EventArchive) se cuentan antes los eventos archivados, que son anteriores a los
+    de la tabla en cada dispositivo.
+    Devuelve los eventos leídos.
+    """
+    session = session_factory()
+    try:
+        session.execute(delete(EstadisticasDispositivo))
+        session.commit()
+    finally:
+        session.close()
+    aggregator = StatsAggregator(session_factory)
+    stmt = select(Events.id_evento, Events.id_dispositivo, Events.id_operacion, Events.id_obstaculo, Events.id_velocidad,
+                  Events.fecha_hora).order_by(Events.id_dispositivo, Events.fecha_hora, Events.id_evento).limit(chunk_size)
+    total = 0
+    if archive is not None:
+        devices = sorted({int(d) for entry in archive.entries() for d in entry["dispositivos"]})
+        for id_dispositivo in devices:
+            for record in archive.events(id_dispositivo):
+                aggregator.record(record)
+                total += 1
+                if total % chunk_size == 0:
+                    aggregator.flush(close_speed=False)
+    last = None
+    while True:
+        query = stmt
+        if last is not None:
+            query = query.where(or_(
+                Events.id_dispositivo > last.id_dispositivo,
+                and_(Events.id_dispositivo == last.id_dispositivo, Events.fecha_hora > last.fecha_hora),
+                and_(Events.id_dispositivo == last.id_dispositivo, Events.fecha_hora == last.fecha_hora, Events.id_evento > last.id_evento)))
+        session = session_factory()
+        try:
+            rows = session.execute(query).all()
+        finally:
+            session.close()
+        if not rows:
+            break
+        for row in rows:
+            aggregator.record(row)
+        total += len(rows)
+        last = rows[-1]
+        # los tramos de velocidad abiertos se cierran al final (hasta ahora)
+        aggregator.flush(close_speed=False)
+    aggregator.flush()
+    return total
+
+
+if __name__ == "__main__":
+    import sys
+    from . import crud
+
+    if sys.argv[1:] != ["backfill"]:
+        sys.exit("uso: python -m app.stats backfill")
+    print(f"{backfill(crud.SessionLocal, archive=crud.event_archive)} eventos procesados")
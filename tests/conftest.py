@@ -0,0 +1,58 @@
+"""Entorno de las pruebas: base SQLite temporal con los catálogos y el repositorio importado como
+paquete `carro` (los módulos usan imports relativos). Las variables de entorno se fijan antes de
+importar nada del paquete, porque config.settings se lee al importarlo.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP_DIR = tempfile.mkdtemp(prefix="carro-iot-tests-")
+DB_PATH = os.path.join(TMP_DIR, "test.db")
+
+os.symlink(REPO_DIR, os.path.join(TMP_DIR, "carro"))
+sys.path.insert(0, TMP_DIR)
+os.environ.update(
+    DB_USER="test", DB_PASSWORD="test", DB_HOST="localhost", DB_NAME="test", DB_URL=f"sqlite:///{DB_PATH}",
+    EVENT_BUS="memory", EVENTS_DURABILITY="sync",
+    OBSTACLE_JOURNAL_DIR=os.path.join(TMP_DIR, "journal"), ARCHIVE_DIR=os.path.join(TMP_DIR, "archive"),
+)
+
+from sqlalchemy import create_engine, insert, text  # noqa: E402
+from carro import models  # noqa: E402
+
+# carros 1..10, un cliente y los catálogos de operaciones, obstáculos y velocidades
+_engine = create_engine(f"sqlite:///{DB_PATH}")
+models.Base.metadata.create_all(_engine)
+with _engine.begin() as conn:
+    conn.execute(text("INSERT INTO Operations (id_operation, status_texto) VALUES (1,'Adelante'),(2,'Atras'),(3,'Detener'),(4,'Izquierda'),(5,'Derecha')"))
+    conn.execute(text("INSERT INTO Obstaculos (id_obstaculo, status_texto) VALUES (1,'Adelante'),(2,'Atras')"))
+    conn.execute(text("INSERT INTO Velocidades (id_velocidad, nivel_velocidad, descripcion, valor_pwm, activo) VALUES (1,1,'Lenta',100,1),(2,2,'Media',180,1),(3,3,'Rapida',255,1)"))
+    conn.execute(text("INSERT INTO ClientesIoT (id_cliente, ip, pais, ciudad, longitud, latitud) VALUES (1,'127.0.0.1','MX','CDMX',0,0)"))
+    conn.execute(insert(models.Dispositivos), [{"id_dispositivo": d, "nombre_dispositivo": f"carro-{d}"} for d in range(1, 11)])
+_engine.dispose()
+
+
+def count_events(**where) -> int:
+    """Filas de Events que cumplen las igualdades de `where` (columna=valor)."""
+    sql = "SELECT COUNT(*) FROM Events" + (" WHERE " + " AND ".join(f"{k} = ?" for k in where) if where else "")
+    with sqlite3.connect(DB_PATH) as conn:
+        return conn.execute(sql, tuple(where.values())).fetchone()[0]
+
+
+@pytest.fixture
+def events():
+    return count_events
+
+
+@pytest.fixture(scope="session")
+def client():
+    """Cliente HTTP de la API con su lifespan (precarga, scheduler, obstacle lane...) en marcha."""
+    from fastapi.testclient import TestClient
+    from carro.main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
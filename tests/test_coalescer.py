@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+
+from carro.coalescer import CommandCoalescer, CommandSuperseded, RateLimited
+
+
+def _writer():
+    writes = []
+
+    async def write(value):
+        writes.append(value)
+        return {"valor": value}
+
+    return writes, write
+
+
+def test_commands_in_window_merge_and_last_wins():
+    async def scenario():
+        coalescer = CommandCoalescer(window_ms=50, rate=0, burst=1)
+        writes, write = _writer()
+        first = await coalescer.submit(1, "movimiento", "a", write)
+        pending = asyncio.create_task(coalescer.submit(1, "movimiento", "b", write))
+        await asyncio.sleep(0)
+        last = await coalescer.submit(1, "movimiento", "c", write)
+        return writes, first, await pending, last
+
+    writes, first, pending, last = asyncio.run(scenario())
+    assert first == {"valor": "a"}
+    # las dos peticiones fusionadas reciben el comando que se escribió de verdad
+    assert pending == last == {"valor": "c"}
+    assert writes == ["a", "c"]
+
+
+def test_types_have_separate_windows():
+    async def scenario():
+        coalescer = CommandCoalescer(window_ms=50, rate=0, burst=1)
+        writes, write = _writer()
+        await coalescer.submit(1, "movimiento", "a", write)
+        await coalescer.submit(1, "velocidad", 2, write)
+        await coalescer.submit(2, "movimiento", "b", write)
+        return writes
+
+    assert asyncio.run(scenario()) == ["a", 2, "b"]
+
+
+def test_without_window_commands_over_the_limit_get_rate_limited():
+    async def scenario():
+        coalescer = CommandCoalescer(window_ms=0, rate=1.0, burst=2)
+        writes, write = _writer()
+        await coalescer.submit(1, "movimiento", "a", write)
+        await coalescer.submit(1, "movimiento", "b", write)
+        with pytest.raises(RateLimited) as exc:
+            await coalescer.submit(1, "movimiento", "c", write)
+        # otro carro tiene su propio límite
+        await coalescer.submit(2, "movimiento", "d", write)
+        return writes, exc.value
+
+    writes, error = asyncio.run(scenario())
+    assert writes == ["a", "b", "d"]
+    assert 0 < error.retry_after <= 1.0
+
+
+def test_supersede_discards_pending_command():
+    async def scenario():
+        coalescer = CommandCoalescer(window_ms=100, rate=0, burst=1)
+        writes, write = _writer()
+        await coalescer.submit(1, "movimiento", "a", write)
+        pending = asyncio.create_task(coalescer.submit(1, "movimiento", "b", write))
+        await asyncio.sleep(0)
+        assert coalescer.pending() == 1
+        coalescer.supersede(1)
+        with pytest.raises(CommandSuperseded):
+            await pending
+        # el comando descartado no se escribe al cerrarse la ventana
+        await asyncio.sleep(0.15)
+        return writes, coalescer.pending()
+
+    writes, pending = asyncio.run(scenario())
+    assert writes == ["a"]
+    assert pending == 0
+
+
+def test_detener_move_is_not_coalesced(client, events):
+    # un Detener por /api/move descarta lo pendiente del carro y se escribe sin esperar ventana
+    body = {"id_dispositivo": 7, "id_cliente": 1}
+    assert client.post("/api/move", json={**body, "id_operacion": 1}).status_code == 200
+    stops = [client.post("/api/move", json={**body, "id_operacion": 3}) for _ in range(3)]
+    assert [r.status_code for r in stops] == [200, 200, 200]
+    assert len({r.json()["id_evento"] for r in stops}) == 3
+    assert events(id_dispositivo=7, id_operacion=3) == 3
+
+
+def test_supersede_reports_its_reason():
+    async def scenario():
+        coalescer = CommandCoalescer(window_ms=100, rate=0, burst=1)
+        _, write = _writer()
+        await coalescer.submit(1, "movimiento", "a", write)
+        pending = asyncio.create_task(coalescer.submit(1, "movimiento", "b", write))
+        await asyncio.sleep(0)
+        coalescer.supersede(1, "el carro recibió un Detener")
+        with pytest.raises(CommandSuperseded) as exc:
+            await pending
+        return str(exc.value)
+
+    assert asyncio.run(scenario()) == "Comando descartado: el carro recibió un Detener"
+
+
+def test_detener_move_cancels_the_running_sequence(client, events):
+    body = {"id_dispositivo": 4, "id_cliente": 1}
+    secuencia = {"nombre": "larga", "movimientos": [{"op": 1, "ms": 60000}, {"op": 2, "ms": 60000}], **body}
+    assert client.post("/api/sequence", json=secuencia).status_code == 200
+    assert [e["id_dispositivo"] for e in client.get("/api/sequence/activas").json()["ejecuciones"]] == [4]
+    assert client.post("/api/move", json={**body, "id_operacion": 3}).status_code == 200
+    assert client.get("/api/sequence/activas").json()["ejecuciones"] == []
+
+
+def test_batches_take_tokens_from_the_same_bucket():
+    async def scenario():
+        coalescer = CommandCoalescer(window_ms=0, rate=1.0, burst=3)
+        writes, write = _writer()
+        coalescer.take({1: 2, 2: 3})
+        # al carro 1 le queda un token: un lote de dos no cabe y no gasta nada
+        with pytest.raises(RateLimited):
+            coalescer.take({1: 2})
+        await coalescer.submit(1, "movimiento", "a", write)
+        with pytest.raises(RateLimited):
+            await coalescer.submit(1, "movimiento", "b", write)
+        with pytest.raises(ValueError):
+            coalescer.take({3: 4})
+        return writes
+
+    assert asyncio.run(scenario()) == ["a"]
+
+
+def test_batch_over_the_car_limit_is_rejected(client, events):
+    mover = {"tipo": "movimiento", "id_dispositivo": 3, "id_cliente": 1, "id_operacion": 1}
+    detener = {**mover, "id_operacion": 3}
+    # más comandos que una ráfaga completa; los Detener no cuentan
+    assert client.post("/api/events/batch", json={"comandos": [mover] * 21}).status_code == 413
+    assert client.post("/api/events/batch", json={"comandos": [mover] * 20 + [detener] * 5}).status_code == 200
+    limited = client.post("/api/events/batch", json={"comandos": [mover] * 10})
+    assert limited.status_code == 429 and "Retry-After" in limited.headers
+    assert events(id_dispositivo=3) == 25
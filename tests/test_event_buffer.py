@@ -0,0 +1,67 @@
+import json
+
+import pytest
+from sqlalchemy.exc import DataError, IntegrityError, OperationalError
+
+from carro.event_buffer import EventBuffer, EventBufferFull
+
+
+def _buffer(tmp_path, fail, max_pending=0):
+    """Buffer cuyo INSERT llama a fail(filas) (que puede lanzar) en vez de ir a la BD."""
+    buffer = EventBuffer(None, flush_size=1000, flush_interval=1, max_pending=max_pending,
+                         permanent_errors=(IntegrityError, DataError), dead_letter=str(tmp_path / "dead-letter.ndjson"))
+    buffer._next_id = 1
+    written = []
+
+    def insert(rows):
+        fail(rows)
+        written.extend(row["id_dispositivo"] for row in rows)
+
+    buffer._insert = insert
+    return buffer, written
+
+
+def _fk(rows):
+    if any(row["id_dispositivo"] >= 900 for row in rows):
+        raise IntegrityError("INSERT INTO Events", {}, Exception("FOREIGN KEY constraint failed"))
+
+
+def test_invalid_rows_are_isolated_and_dead_lettered(tmp_path):
+    buffer, written = _buffer(tmp_path, _fk)
+    for id_dispositivo in (1, 2, 999, 3, 4, 5, 998, 6):
+        buffer.append(id_dispositivo=id_dispositivo, id_cliente=1, id_operacion=1)
+    assert buffer.flush() == 6
+    assert written == [1, 2, 3, 4, 5, 6]
+    assert buffer.pending() == 0 and buffer.dead_letters == 2
+    with open(tmp_path / "dead-letter.ndjson") as f:
+        dead = [json.loads(line) for line in f]
+    assert [d["id_dispositivo"] for d in dead] == [999, 998]
+    assert "FOREIGN KEY" in dead[0]["error"]
+
+
+def test_transient_errors_keep_the_rows_for_the_next_flush(tmp_path):
+    failures = [OperationalError("INSERT INTO Events", {}, Exception("server has gone away"))]
+
+    def fail(rows):
+        if failures:
+            raise failures.pop()
+
+    buffer, written = _buffer(tmp_path, fail)
+    for id_dispositivo in (1, 2, 3):
+        buffer.append(id_dispositivo=id_dispositivo, id_cliente=1, id_operacion=1)
+    with pytest.raises(OperationalError):
+        buffer.flush()
+    assert buffer.pending() == 3
+    assert buffer.flush() == 3
+    assert written == [1, 2, 3] and buffer.dead_letters == 0
+
+
+def test_full_buffer_refuses_new_events(tmp_path):
+    buffer, _ = _buffer(tmp_path, _fk, max_pending=2)
+    buffer.append(id_dispositivo=1, id_cliente=1, id_operacion=1)
+    buffer.append(id_dispositivo=2, id_cliente=1, id_operacion=1)
+    with pytest.raises(EventBufferFull):
+        buffer.append(id_dispositivo=3, id_cliente=1, id_operacion=1)
+    buffer.flush()
+    buffer.append(id_dispositivo=3, id_cliente=1, id_operacion=1)
+    assert buffer.pending() == 1
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from carro.event_bus import RedisBus, UnixSocketBus, pack, unpack
+
+
+async def _until(condition, timeout=2.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+
+
+def test_unix_buses_exchange_envelopes(tmp_path):
+    async def scenario():
+        a, b = UnixSocketBus(str(tmp_path), "a"), UnixSocketBus(str(tmp_path), "b")
+        got_a, got_b = [], []
+        await a.start(got_a.append)
+        await b.start(got_b.append)
+        # mayor que un datagrama: con el prefijo de longitud llega entero
+        grande = pack({"c": "m"}, "x" * 300000)
+        await a.publish(pack({"c": "m"}, "hola"))
+        await a.publish(grande, priority=True)
+        await b.publish(pack({"c": "m"}, "adios"))
+        await _until(lambda: len(got_b) == 2 and len(got_a) == 1)
+        await a.stop()
+        await b.stop()
+        return got_a, got_b, grande
+
+    got_a, got_b, grande = asyncio.run(scenario())
+    assert [unpack(e)[1] for e in got_a] == ["adios"]
+    assert got_b[0] == pack({"c": "m"}, "hola") and got_b[1] == grande
+
+
+def test_unix_bus_drops_oldest_non_priority_when_a_peer_falls_behind(tmp_path):
+    async def scenario():
+        a, b = UnixSocketBus(str(tmp_path), "a"), UnixSocketBus(str(tmp_path), "b")
+        a.QUEUE_SIZE = 4
+        got = []
+        await a.start(lambda envelope: None)
+        await b.start(got.append)
+        # sin ceder el loop, la cola del peer no se vacía entre publicaciones
+        await a.publish(pack({}, "obstaculo"), priority=True)
+        for i in range(6):
+            await a.publish(pack({}, str(i)))
+        await _until(lambda: len(got) == 4)
+        await a.stop()
+        await b.stop()
+        return [unpack(e)[1] for e in got], a.dropped
+
+    got, dropped = asyncio.run(scenario())
+    assert got == ["obstaculo", "3", "4", "5"]
+    assert dropped == 3
+
+
+def test_unix_bus_claim_is_held_until_stop(tmp_path):
+    async def scenario():
+        a, b = UnixSocketBus(str(tmp_path), "a"), UnixSocketBus(str(tmp_path), "b")
+        claims = [await a.claim("stats-velocidad"), await b.claim("stats-velocidad")]
+        await a.stop()
+        claims.append(await b.claim("stats-velocidad"))
+        await b.stop()
+        return claims
+
+    assert asyncio.run(scenario()) == [True, False, True]
+
+
+def test_redis_claim_is_renewed_and_released():
+    fakeredis = pytest.importorskip("fakeredis")
+
+    async def scenario():
+        server = fakeredis.FakeServer()
+        a = RedisBus("", "carro", client=fakeredis.aioredis.FakeRedis(server=server))
+        b = RedisBus("", "carro", client=fakeredis.aioredis.FakeRedis(server=server))
+        a.CLAIM_TTL = b.CLAIM_TTL = 0.3
+        claims = [await a.claim("stats-velocidad")]
+        # pasado el TTL la clave sigue siendo de a, que la renueva
+        await asyncio.sleep(0.8)
+        claims.append(await b.claim("stats-velocidad"))
+        await a.stop()
+        claims.append(await b.claim("stats-velocidad"))
+        await b.stop()
+        return claims
+
+    assert asyncio.run(scenario()) == [True, False, True]
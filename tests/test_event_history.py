@@ -0,0 +1,7 @@
+def test_last_events_reject_n_out_of_range(client):
+    for n in (-1, 0, 10 ** 6):
+        assert client.get(f"/api/events/1?n={n}").status_code == 422
+    client.post("/api/move", json={"id_dispositivo": 1, "id_cliente": 1, "id_operacion": 3})
+    client.post("/api/move", json={"id_dispositivo": 1, "id_cliente": 1, "id_operacion": 3})
+    eventos = client.get("/api/events/1?n=1").json()
+    assert len(eventos) == 1
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from carro.idempotency import IdempotencyCache, IdempotencyConflict, fingerprint
+
+
+def test_replay_returns_stored_response_without_running_again():
+    async def scenario():
+        cache = IdempotencyCache(max_keys=10, ttl=60)
+        calls = []
+
+        async def handler():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"n": len(calls)}
+
+        first, concurrent = await asyncio.gather(cache.run("/api/move", "k", "h", handler),
+                                                 cache.run("/api/move", "k", "h", handler))
+        later = await cache.run("/api/move", "k", "h", handler)
+        # la misma clave en otra ruta es otra petición
+        other = await cache.run("/api/speed", "k", "h", handler)
+        return calls, first, concurrent, later, other
+
+    calls, first, concurrent, later, other = asyncio.run(scenario())
+    assert first == ({"n": 1}, False)
+    assert concurrent == ({"n": 1}, True)
+    assert later == ({"n": 1}, True)
+    assert other == ({"n": 2}, False)
+    assert len(calls) == 2
+
+
+def test_key_reused_with_another_body_conflicts():
+    async def scenario():
+        cache = IdempotencyCache(max_keys=10, ttl=60)
+
+        async def handler():
+            return {}
+
+        await cache.run("/api/move", "k", fingerprint({"id_operacion": 1}), handler)
+        await cache.run("/api/move", "k", fingerprint({"id_operacion": 2}), handler)
+
+    with pytest.raises(IdempotencyConflict):
+        asyncio.run(scenario())
+
+
+def test_failed_request_frees_the_key():
+    async def scenario():
+        cache = IdempotencyCache(max_keys=10, ttl=60)
+        attempts = []
+
+        async def handler():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RuntimeError("BD caída")
+            return {"ok": True}
+
+        with pytest.raises(RuntimeError):
+            await cache.run("/api/move", "k", "h", handler)
+        return await cache.run("/api/move", "k", "h", handler), len(attempts)
+
+    assert asyncio.run(scenario()) == (({"ok": True}, False), 2)
+
+
+def test_keys_expire_after_ttl():
+    async def scenario():
+        cache = IdempotencyCache(max_keys=10, ttl=0.01)
+
+        async def handler():
+            return {}
+
+        await cache.run("/api/move", "k", "h", handler)
+        await asyncio.sleep(0.02)
+        return await cache.run("/api/move", "k", "h", handler)
+
+    assert asyncio.run(scenario()) == ({}, False)
+
+
+def test_move_retry_is_replayed_once_written(client, events):
+    body = {"id_dispositivo": 5, "id_cliente": 1, "id_operacion": 1}
+    headers = {"Idempotency-Key": "test-move-1"}
+    first = client.post("/api/move", json=body, headers=headers)
+    retry = client.post("/api/move", json=body, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers.get("Idempotent-Replayed") == "true"
+    assert events(id_dispositivo=5) == 1
+    # la misma clave con otro comando se rechaza
+    conflict = client.post("/api/move", json={**body, "id_operacion": 2}, headers=headers)
+    assert conflict.status_code == 422
+    assert events(id_dispositivo=5) == 1
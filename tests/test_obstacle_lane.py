@@ -0,0 +1,93 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+from carro import crud
+from carro.obstacle_lane import ObstacleLane
+
+# pid de un proceso que ya no existe (nadie tiene el lock de su journal)
+DEAD_PID = 4194303
+
+
+def _orphan_journal(directory, items):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{DEAD_PID}.jsonl"), "w") as f:
+        for item in items:
+            f.write(json.dumps({**item, "fecha_hora": item["fecha_hora"].isoformat()}) + "\n")
+
+
+def _item(id_provisional, id_dispositivo, fecha_hora=None):
+    return {"id_provisional": id_provisional, "id_dispositivo": id_dispositivo, "id_cliente": 1, "id_operacion": 3,
+            "id_obstaculo": 1, "fecha_hora": fecha_hora or datetime.utcnow()}
+
+
+async def _run_lane(directory, expected, persist=crud.persist_obstacles):
+    """Arranca una lane sobre `directory`, espera `expected` confirmaciones/descartes y la para."""
+    lane = ObstacleLane(str(directory), retry_max=0.5, permanent_errors=(IntegrityError, DataError))
+    confirmed, discarded = [], []
+
+    async def confirm(item, evento, elapsed):
+        confirmed.append((item["id_provisional"], evento["id_evento"]))
+
+    async def discard(item, error):
+        discarded.append(item["id_provisional"])
+
+    await lane.start(crud.run_in_db, persist, confirm, discard=discard)
+    for _ in range(100):
+        if len(confirmed) + len(discarded) >= expected:
+            break
+        await asyncio.sleep(0.02)
+    await lane.stop()
+    return lane, confirmed, discarded
+
+
+def test_orphaned_journal_is_recovered_and_written(tmp_path, events):
+    _orphan_journal(tmp_path, [_item("rec-1", 8), _item("rec-2", 8)])
+    lane, confirmed, _ = asyncio.run(_run_lane(tmp_path, 2))
+    assert [p for p, _ in confirmed] == ["rec-1", "rec-2"]
+    assert events(id_dispositivo=8, id_operacion=3) == 2
+    # el journal ajeno se adoptó y el propio quedó vacío al escribirse
+    assert not os.path.exists(tmp_path / f"{DEAD_PID}.jsonl")
+    assert os.path.getsize(tmp_path / f"{os.getpid()}.jsonl") == 0
+    assert lane.pending() == 0
+
+
+def test_recovered_obstacle_already_written_is_not_duplicated(tmp_path, events):
+    fecha_hora = datetime.utcnow()
+    escrito = crud.persist_obstacles([_item("dup-1", 9, fecha_hora)])[0]
+    _orphan_journal(tmp_path, [{**_item("dup-1", 9, fecha_hora)}])
+    _, confirmed, _ = asyncio.run(_run_lane(tmp_path, 1))
+    assert confirmed == [("dup-1", escrito["id_evento"])]
+    assert events(id_dispositivo=9, id_operacion=3) == 1
+
+
+def test_each_written_row_is_claimed_by_one_recovered_obstacle(tmp_path, events):
+    # A se escribió antes de la caída; B llegó 300 ms después y no llegó a escribirse
+    a = datetime.utcnow().replace(microsecond=100000)
+    b = a + timedelta(milliseconds=300)
+    escrito = crud.persist_obstacles([_item("a", 6, a)])[0]
+    _orphan_journal(tmp_path, [_item("a", 6, a), _item("b", 6, b)])
+    _, confirmed, _ = asyncio.run(_run_lane(tmp_path, 2))
+    assert confirmed[0] == ("a", escrito["id_evento"])
+    assert confirmed[1][0] == "b" and confirmed[1][1] != escrito["id_evento"]
+    assert events(id_dispositivo=6, id_operacion=3) == 2
+
+
+def test_rows_rejected_by_the_db_go_to_dead_letter(tmp_path):
+    def persist(items):
+        if any(item["id_obstaculo"] == 99 for item in items):
+            raise IntegrityError("INSERT INTO Events", {}, Exception("FOREIGN KEY constraint failed"))
+        return [{"id_evento": i} for i, _ in enumerate(items, 1)]
+
+    _orphan_journal(tmp_path, [_item("ok-1", 10), {**_item("bad", 10), "id_obstaculo": 99}, _item("ok-2", 10)])
+    lane, confirmed, discarded = asyncio.run(_run_lane(tmp_path, 3, persist))
+    assert [p for p, _ in confirmed] == ["ok-1", "ok-2"]
+    assert discarded == ["bad"]
+    assert lane.dead_letters == 1 and lane.pending() == 0
+    with open(tmp_path / "dead-letter.ndjson") as f:
+        dead = [json.loads(line) for line in f]
+    assert [d["id_provisional"] for d in dead] == ["bad"]
+    assert "FOREIGN KEY" in dead[0]["error"]
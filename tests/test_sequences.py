@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from carro.sequences import Paso, Secuencia, SequenceBusy, SequenceScheduler
+
+SECUENCIA = Secuencia(1, "prueba", (Paso(1, None), Paso(2, None), Paso(1, None), Paso(2, None)), "hash")
+
+
+def _scheduler(step_ms: int = 20):
+    scheduler = SequenceScheduler(step_ms)
+    executed, finished = [], []
+
+    async def execute(pasos):
+        executed.extend((ejecucion.id_dispositivo, paso) for ejecucion, paso in pasos)
+
+    async def notify(ejecucion, motivo):
+        finished.append((ejecucion.id_dispositivo, motivo))
+
+    scheduler.start(execute, notify)
+    return scheduler, executed, finished
+
+
+def test_sequence_runs_all_steps_and_completes():
+    async def scenario():
+        scheduler, executed, finished = _scheduler()
+        scheduler.run(SECUENCIA, 1, 1)
+        await asyncio.sleep(0.15)
+        await scheduler.stop()
+        return executed, finished
+
+    executed, finished = asyncio.run(scenario())
+    assert executed == [(1, 0), (1, 1), (1, 2), (1, 3)]
+    assert finished == [(1, "completada")]
+
+
+def test_cancelled_sequence_sends_no_more_steps():
+    async def scenario():
+        scheduler, executed, finished = _scheduler()
+        ejecucion, _ = scheduler.run(SECUENCIA, 1, 1)
+        scheduler.run(SECUENCIA, 2, 1)
+        await asyncio.sleep(0.03)
+        cancelled = scheduler.cancel(1)
+        sent = len([paso for dispositivo, paso in executed if dispositivo == 1])
+        await asyncio.sleep(0.15)
+        await scheduler.stop()
+        return ejecucion, cancelled, sent, executed, finished, scheduler.get(1)
+
+    ejecucion, cancelled, sent, executed, finished, running = asyncio.run(scenario())
+    assert cancelled is ejecucion and not ejecucion.activa
+    assert running is None
+    assert 0 < sent < len(SECUENCIA.pasos)
+    assert len([paso for dispositivo, paso in executed if dispositivo == 1]) == sent
+    # la otra ejecución no se ve afectada y la cancelada no se notifica como completada
+    assert [paso for dispositivo, paso in executed if dispositivo == 2] == [0, 1, 2, 3]
+    assert finished == [(2, "completada")]
+
+
+def test_run_without_replace_refuses_busy_car():
+    async def scenario():
+        scheduler, _, _ = _scheduler()
+        scheduler.run(SECUENCIA, 1, 1)
+        try:
+            with pytest.raises(SequenceBusy):
+                scheduler.run(SECUENCIA, 1, 1, replace=False)
+            # reemplazar cancela la anterior
+            nueva, anterior = scheduler.run(SECUENCIA, 1, 1)
+            return nueva, anterior
+        finally:
+            await scheduler.stop()
+
+    nueva, anterior = asyncio.run(scenario())
+    assert anterior is not None and not anterior.activa
+    assert nueva.activa
@@ -0,0 +1,78 @@
+import asyncio
+
+from carro.websocket_manager import PING_FRAME, ConnectionManager, _Client
+
+
+class FakeWebSocket:
+    """WebSocket cuyos envíos siempre tienen éxito (como un socket medio abierto con buffer libre)."""
+
+    def __init__(self, manager=None, answer_pings=False):
+        self.sent = []
+        self.closed = None
+        self._manager, self._answer_pings = manager, answer_pings
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, frame):
+        self.sent.append(frame)
+        if self._answer_pings and frame == PING_FRAME:
+            self._manager.touch(self)
+
+    async def close(self, code=1000):
+        self.closed = code
+
+
+def _manager(interval=0.05, timeout=0.05):
+    manager = ConnectionManager(queue_size=10)
+    manager.ping_interval, manager.ping_timeout = interval, timeout
+    return manager
+
+
+def test_silent_connection_is_reaped_even_if_writes_succeed():
+    async def scenario():
+        manager = _manager()
+        await manager.start()
+        silent, alive = FakeWebSocket(), FakeWebSocket(manager, answer_pings=True)
+        await manager.connect(silent)
+        await manager.connect(alive)
+        await asyncio.sleep(0.3)
+        connected = set(manager.active_connections)
+        await manager.stop()
+        return silent, alive, connected, manager.reaped_connections
+
+    silent, alive, connected, reaped = asyncio.run(scenario())
+    assert PING_FRAME in silent.sent and silent.closed == 1001
+    assert connected == {alive} and alive.closed is None
+    assert reaped == 1
+
+
+def test_heartbeat_is_never_dropped_from_a_full_queue():
+    client = _Client(FakeWebSocket())
+    client.queue.extend([(None, PING_FRAME), (None, "obstaculo-1"), (None, "obstaculo-2")])
+    client.urgent = 3
+    ConnectionManager._drop_oldest(client)
+    assert list(client.queue) == [(None, PING_FRAME), (None, "obstaculo-2")]
+    assert client.urgent == 2
+
+
+def test_tick_task_stops_with_the_last_tick_monitor():
+    async def scenario():
+        manager = _manager(interval=0)
+        a, b = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(a, tick=True)
+        task = manager._tick_task
+        await manager.connect(b, tick=True)
+        assert manager._tick_task is task
+        manager.disconnect(a)
+        running = manager._tick_task is task and not task.done()
+        manager.disconnect(b)
+        await asyncio.sleep(0)
+        stopped = manager._tick_task is None and task.cancelled()
+        # un nuevo monitor en modo tick lo vuelve a arrancar
+        await manager.connect(FakeWebSocket(), tick=True)
+        restarted = manager._tick_task is not None and manager._tick_task is not task
+        await manager.stop()
+        return running, stopped, restarted
+
+    assert asyncio.run(scenario()) == (True, True, True)
@@ -1,30 +1,624 @@
-from typing import List
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterable, Set
 from fastapi import WebSocket
+from .config import settings
+from . import metrics
+from .event_bus import create_bus, pack, unpack
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# políticas cuando la cola de salida de un cliente está llena
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+
+# latido de aplicación (frames constantes, codificados una vez): monitores y canal del carro
+PING_FRAME = '{"tipo":"ping"}'
+DEVICE_PING_FRAME = '{"t":"hb"}'
+
+
+class _Client:
+    """Una conexión con su cola de salida, la tarea que la vacía y sus suscripciones."""
+    __slots__ = ("websocket", "queue", "urgent", "ready", "task", "dispositivos", "tipos",
+                 "connected_at", "last_seen", "last_sent", "ping_queued",
+                 "tick", "tick_events", "batch", "dirty", "sent_state")
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        # time.monotonic(): alta, último mensaje recibido del cliente, último frame enviado y
+        # latido encolado que aún no salió (None = ninguno)
+        self.connected_at = self.last_seen = self.last_sent = time.monotonic()
+        self.ping_queued: float | None = None
+        # modo tick (opcional): frames acumulados hasta el próximo tick, dispositivos que cambiaron
+        # y último estado enviado de cada dispositivo (para mandar sólo las diferencias)
+        self.tick = False
+        self.tick_events = True
+        self.batch: list[str] = []
+        self.dirty: Set[int] = set()
+        self.sent_state: Dict[int, dict] = {}
+        # None = todos los dispositivos / todos los tipos
+        self.dispositivos: Set[int] | None = None
+        self.tipos: Set[str] | None = None
+        # elementos (clave_coalesce, frame_json)
+        self.queue = deque()
+        # los primeros `urgent` elementos de la cola son prioritarios (obstáculos)
+        self.urgent = 0
+        self.ready = asyncio.Event()
+        self.task = None
+
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, queue_size: int | None = None, overflow_policy: str | None = None, bus=None):
+        self.active_connections: Dict[WebSocket, _Client] = {}
+        # índice id_dispositivo -> clientes suscritos; _all_devices = sin filtro de dispositivo
+        self._by_device: Dict[int, Set[_Client]] = {}
+        self._all_devices: Set[_Client] = set()
+        # canal dedicado de cada carro (/ws/device): id_dispositivo -> conexiones del carro
+        self.device_channels: Dict[int, Dict[WebSocket, _Client]] = {}
+        self._device_of: Dict[WebSocket, int] = {}
+        self.queue_size = queue_size or settings.WS_QUEUE_SIZE
+        self.overflow_policy = overflow_policy or settings.WS_OVERFLOW_POLICY
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"WS_OVERFLOW_POLICY inválida: {self.overflow_policy}")
+        self.dropped_frames = 0
+        # reparto a otros workers/nodos (ver event_bus); por defecto sólo este proceso
+        self.bus = bus or create_bus(settings.EVENT_BUS, settings.EVENT_BUS_PATH, settings.EVENT_BUS_REDIS_URL, settings.EVENT_BUS_CHANNEL)
+        # tipo -> callbacks(dispositivos) para mensajes de ese tipo llegados de otros procesos
+        self._remote_listeners: Dict[str, list] = {}
+        # eventos escritos por este proceso que aún no se han publicado (ver share_event) y
+        # callback(eventos) para los que escriben los demás
+        self._shared: list = []
+        self._remote_events = None
+        self._loop = None
+        # últimos frames con id_evento (id, dispositivos, tipos, frame) para reanudar monitores
+        # con ?since=; replay_floor = id hasta el que el log puede tener huecos (None = desconocido:
+        # lo fija el arranque con el último id conocido y sube al descartar frames del log)
+        self.replay_size = settings.WS_REPLAY_SIZE
+        self._replay: deque = deque()
+        self.replay_floor: int | None = None
+        self._evicted = 0
+        self.last_id = 0
+        # latidos: una sola tarea para todas las conexiones (ver _heartbeat)
+        self.ping_interval = settings.WS_PING_INTERVAL_S
+        self.ping_timeout = settings.WS_PING_TIMEOUT_S
+        self.reaped_connections = 0
+        self._heartbeat_task = None
+        # modo tick: monitores que reciben un frame por tick y estado actual de cada dispositivo
+        # según los mensajes difundidos mientras haya alguno (lo que se les envía como diferencias);
+        # la tarea del tick se arranca con el primer monitor en ese modo
+        self.tick_interval = settings.WS_TICK_MS / 1000
+        self._tick_clients: Set[_Client] = set()
+        self._device_views: Dict[int, dict] = {}
+        self._tick_task = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        await self.bus.start(self._on_bus_message)
+        if self.ping_interval > 0:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    def on_remote(self, tipo: str, callback):
+        """Llama a callback(dispositivos) cuando otro worker/nodo emite un mensaje de `tipo`."""
+        self._remote_listeners.setdefault(tipo, []).append(callback)
+
+    def on_remote_events(self, callback):
+        """Llama a callback(eventos) con los eventos que escriben otros workers/nodos (ver share_event)."""
+        self._remote_events = callback
+
+    def share_event(self, evento: dict):
+        """Publica en el bus un evento escrito por este proceso, para que los demás actualicen su
+        estado en memoria. Se puede llamar desde cualquier hilo; los eventos de una misma vuelta
+        del bucle salen en un solo mensaje.
+        """
+        if self._loop is None or not self.bus.remote:
+            return
+        self._loop.call_soon_threadsafe(self._queue_shared, evento)
+
+    def _queue_shared(self, evento: dict):
+        self._shared.append(evento)
+        if len(self._shared) == 1:
+            asyncio.ensure_future(self._publish_shared())
+
+    async def _publish_shared(self):
+        eventos, self._shared = self._shared, []
+        frame = json.dumps(eventos, separators=(",", ":"), default=_iso)
+        await self.bus.publish(pack({"c": "e"}, frame))
+
+    async def stop(self):
+        for task in (self._heartbeat_task, self._tick_task):
+            if task is not None:
+                task.cancel()
+        self._heartbeat_task = self._tick_task = None
+        await self.bus.stop()
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, dispositivos: Iterable[int] | None = None,
+                      tipos: Iterable[str] | None = None, backlog=None, tick: bool = False, tick_events: bool = True):
+        """Registra un monitor. `backlog(client)` devuelve los frames iniciales (snapshot o
+        reanudación); se llama sin ceder el event loop tras registrarlo, así que ningún
+        broadcast queda entre esos frames y los siguientes.
+        Con `tick` los mensajes se agrupan en un frame por tick (ver _flush_tick); sin
+        `tick_events` ese frame lleva sólo los cambios de estado de los dispositivos.
+        """
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = _Client(websocket)
+        client.task = asyncio.create_task(self._writer(client))
+        self.active_connections[websocket] = client
+        self._index(client, dispositivos, tipos)
+        if tick:
+            client.tick, client.tick_events = True, tick_events
+            self._tick_clients.add(client)
+            if self._tick_task is None:
+                self._tick_task = asyncio.create_task(self._ticker())
+        if backlog is not None:
+            for frame in backlog(client):
+                client.queue.append((None, frame))
+            client.ready.set()
+
+    async def connect_device(self, websocket: WebSocket, id_dispositivo: int):
+        """Registra la conexión propia de un carro; sólo recibe los comandos de su dispositivo."""
+        await websocket.accept()
+        client = _Client(websocket)
+        client.task = asyncio.create_task(self._writer(client))
+        self.device_channels.setdefault(id_dispositivo, {})[websocket] = client
+        self._device_of[websocket] = id_dispositivo
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        client = self.active_connections.pop(websocket, None)
+        if client is not None:
+            self._unindex(client)
+            if client.tick:
+                self._tick_clients.discard(client)
+                if not self._tick_clients:
+                    # sin monitores en modo tick el estado deja de seguirse: se descarta para no
+                    # enviar después valores que no se actualizaron, y el tick se para hasta el próximo
+                    self._device_views.clear()
+                    if self._tick_task is not None:
+                        self._tick_task.cancel()
+                        self._tick_task = None
+        else:
+            client = self._pop_device(websocket)
+            if client is None:
+                return
+        metrics.ws_connection_seconds.observe(time.monotonic() - client.connected_at)
+        if client.task and client.task is not asyncio.current_task():
+            client.task.cancel()
+
+    def _pop_device(self, websocket: WebSocket):
+        id_dispositivo = self._device_of.pop(websocket, None)
+        if id_dispositivo is None:
+            return None
+        channel = self.device_channels[id_dispositivo]
+        client = channel.pop(websocket)
+        if not channel:
+            del self.device_channels[id_dispositivo]
+        return client
+
+    def subscribe(self, websocket: WebSocket, dispositivos: Iterable[int] | None = None,
+                  tipos: Iterable[str] | None = None):
+        """Reemplaza las suscripciones de la conexión (None = sin filtro)."""
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return
+        self._unindex(client)
+        self._index(client, dispositivos, tipos)
+
+    def _index(self, client: _Client, dispositivos, tipos):
+        client.dispositivos = set(dispositivos) if dispositivos else None
+        client.tipos = set(tipos) if tipos else None
+        if client.dispositivos is None:
+            self._all_devices.add(client)
+            return
+        for id_dispositivo in client.dispositivos:
+            self._by_device.setdefault(id_dispositivo, set()).add(client)
+
+    def _unindex(self, client: _Client):
+        self._all_devices.discard(client)
+        for id_dispositivo in client.dispositivos or ():
+            subscribers = self._by_device.get(id_dispositivo)
+            if subscribers is not None:
+                subscribers.discard(client)
+                if not subscribers:
+                    del self._by_device[id_dispositivo]
+
+    def _subscribers(self, dispositivos: Set[int], tipos: Set[str]):
+        """Clientes interesados en un mensaje según sus dispositivos y tipos."""
+        if not dispositivos:
+            candidates = self.active_connections.values()
+        elif len(dispositivos) == 1 and not self._all_devices:
+            candidates = self._by_device.get(next(iter(dispositivos)), ())
+        else:
+            candidates = set(self._all_devices)
+            for id_dispositivo in dispositivos:
+                candidates.update(self._by_device.get(id_dispositivo, ()))
+        return [c for c in candidates if c.tipos is None or not c.tipos.isdisjoint(tipos)]
 
     async def send_personal_message(self, message: dict, websocket: WebSocket):
-        await websocket.send_json(message)
+        frame = encode_message(message)
+        client = self.active_connections.get(websocket)
+        if client is None and websocket in self._device_of:
+            client = self.device_channels[self._device_of[websocket]][websocket]
+        if client is None:
+            await websocket.send_text(frame)
+        else:
+            self._enqueue(client, None, frame)
+
+    async def broadcast(self, message: dict, encoded: str | None = None, priority: bool = False):
+        """Encola el mensaje para cada conexión suscrita y retorna sin esperar los envíos.
+        El JSON se genera una sola vez; si el llamador ya lo tiene puede pasarlo en `encoded`.
+        Con un bus entre procesos el mensaje también se publica para los demás workers.
+        Con `priority` el mensaje se adelanta a lo que ya esperaba en cada cola (obstáculos).
+        """
+        start = time.perf_counter()
+        dispositivos = _message_devices(message)
+        tipos = _message_tipos(message)
+        subscribers = self._subscribers(dispositivos, tipos)
+        id_evento = _message_id(message)
+        # los eventos se guardan en el log de reanudación aunque ahora no haya monitores
+        if not subscribers and not self.bus.remote and id_evento is None:
+            return
+        frame = encoded if encoded is not None else encode_message(message)
+        key = _coalesce_key(message)
+        if self._tick_clients:
+            self._update_views(message)
+        for client in subscribers:
+            self._deliver(client, key, frame, priority, dispositivos)
+        if id_evento is not None:
+            self._log(id_evento, dispositivos, tipos, frame)
+        metrics.broadcast_seconds.observe(time.perf_counter() - start, "monitor")
+        if self.bus.remote:
+            header = {"c": "m", "d": sorted(dispositivos), "t": sorted(tipos, key=str), "k": key, "i": id_evento}
+            if priority:
+                header["p"] = 1
+            await self.bus.publish(pack(header, frame), priority)
 
-    async def broadcast(self, message: dict):
-        living = []
-        for connection in self.active_connections:
+    async def send_to_device(self, id_dispositivo: int, message: dict, encoded: str | None = None,
+                             priority: bool = False) -> bool:
+        """Encola un comando para el canal del carro (en este u otro worker).
+        False si el carro no está conectado a este proceso y no hay bus entre procesos.
+        """
+        channel = self.device_channels.get(id_dispositivo)
+        if not channel and not self.bus.remote:
+            return False
+        start = time.perf_counter()
+        frame = encoded if encoded is not None else encode_message(message)
+        self._deliver_device(id_dispositivo, frame, priority)
+        metrics.broadcast_seconds.observe(time.perf_counter() - start, "device")
+        if self.bus.remote:
+            header = {"c": "d", "d": [id_dispositivo]}
+            if priority:
+                header["p"] = 1
+            await self.bus.publish(pack(header, frame), priority)
+        return True
+
+    def _deliver_device(self, id_dispositivo: int, frame: str, priority: bool = False):
+        for client in list(self.device_channels.get(id_dispositivo, {}).values()):
+            self._enqueue(client, None, frame, priority)
+
+    def _on_bus_message(self, envelope: bytes):
+        """Entrega a las conexiones locales un mensaje publicado por otro proceso."""
+        try:
+            header, frame = unpack(envelope)
+        except ValueError:
+            return
+        priority = bool(header.get("p"))
+        if header["c"] == "e":
+            if self._remote_events is not None:
+                eventos = json.loads(frame)
+                for evento in eventos:
+                    evento["fecha_hora"] = datetime.fromisoformat(evento["fecha_hora"])
+                try:
+                    self._remote_events(eventos)
+                except Exception:
+                    logger.exception("Error aplicando eventos de otro proceso")
+            return
+        if header["c"] == "d":
+            self._deliver_device(header["d"][0], frame, priority)
+            return
+        key = tuple(header["k"]) if header.get("k") is not None else None
+        dispositivos = set(header["d"])
+        if self._tick_clients:
             try:
-                await connection.send_json(message)
-                living.append(connection)
-            except Exception:
-                # desconectar clientes muertos
+                self._update_views(json.loads(frame))
+            except ValueError:
                 pass
-        self.active_connections = living
+        for client in self._subscribers(dispositivos, set(header["t"])):
+            self._deliver(client, key, frame, priority, dispositivos)
+        if header.get("i") is not None:
+            self._log(header["i"], set(header["d"]), set(header["t"]), frame)
+        for tipo in header["t"]:
+            for callback in self._remote_listeners.get(tipo, ()):
+                try:
+                    callback(set(header["d"]))
+                except Exception:
+                    logger.exception("Error en listener remoto de %s", tipo)
+
+    def _deliver(self, client: _Client, key, frame: str, priority: bool, dispositivos: Set[int]):
+        if not client.tick:
+            self._enqueue(client, key, frame, priority)
+            return
+        batch = client.batch
+        if client.tick_events:
+            if len(batch) >= self.queue_size:
+                # mismo límite que la cola: se descarta lo más antiguo del tick
+                batch.pop(0)
+                self.dropped_frames += 1
+                metrics.ws_dropped_frames.inc()
+            batch.append(frame)
+        client.dirty.update(dispositivos)
+        if priority:
+            # un obstáculo no espera al tick
+            self._flush_tick(client)
+
+    def _update_views(self, message: dict):
+        """Aplica un mensaje al estado de los dispositivos que se envía a los monitores en modo tick."""
+        items = message["eventos"] if "eventos" in message else [message]
+        for item in items:
+            evento = item.get("evento")
+            if isinstance(evento, dict) and evento.get("id_dispositivo") is not None:
+                view = self._device_views.setdefault(evento["id_dispositivo"], {})
+                fields = {k: v for k, v in evento.items() if k != "id_dispositivo"}
+                if fields.get("id_evento") is not None:
+                    # evento ya escrito: el id provisional (obstáculos) deja de aplicar
+                    fields.pop("id_provisional", None)
+                    view.pop("id_provisional", None)
+                # los campos que vienen a null también cambian (p. ej. id_obstaculo tras un movimiento)
+                view.update(fields)
+                view["tipo"] = item.get("tipo")
+            elif item.get("tipo") == "telemetria" and item.get("id_dispositivo") is not None:
+                self._device_views.setdefault(item["id_dispositivo"], {})["telemetria"] = item.get("datos")
+
+    def _flush_tick(self, client: _Client):
+        """Encola para el cliente un único frame con lo acumulado desde el último tick:
+        {"tipo": "tick", "mensajes": [...], "estado": {"<id_dispositivo>": {campos que cambiaron}}}.
+        Un campo que pasa a null o desaparece del estado se envía como null.
+        """
+        deltas = {}
+        for id_dispositivo in client.dirty:
+            view = self._device_views.get(id_dispositivo)
+            if not view:
+                continue
+            sent = client.sent_state.setdefault(id_dispositivo, {})
+            delta = {k: v for k, v in view.items() if sent.get(k) != v}
+            sent.update(delta)
+            for k in [k for k in sent if k not in view]:
+                del sent[k]
+                delta[k] = None
+            if delta:
+                deltas[str(id_dispositivo)] = delta
+        client.dirty.clear()
+        if not client.batch and not deltas:
+            return
+        # los mensajes ya están serializados: se concatenan sin volver a codificarlos
+        frame = f'{{"tipo":"tick","mensajes":[{",".join(client.batch)}],"estado":{encode_message(deltas)}}}'
+        client.batch.clear()
+        self._enqueue(client, None, frame)
+
+    async def _ticker(self):
+        while True:
+            await asyncio.sleep(self.tick_interval)
+            for client in list(self._tick_clients):
+                if client.batch or client.dirty:
+                    self._flush_tick(client)
+
+    def _log(self, id_evento: int, dispositivos: Set[int], tipos: Set[str], frame: str):
+        replay = self._replay
+        if len(replay) >= self.replay_size:
+            self._evicted = max(self._evicted, replay.popleft()[0])
+        replay.append((id_evento, dispositivos, tipos, frame))
+        self.last_id = max(self.last_id, id_evento)
+
+    def covers(self, since: int, complete: bool = False) -> bool:
+        """Si el log tiene todos los eventos posteriores a `since`. `complete`: el llamador ya
+        leyó de la BD todo hasta `since`, así que sólo importa lo que el log haya descartado.
+        """
+        if since < self._evicted:
+            return False
+        return complete or (self.replay_floor is not None and since >= self.replay_floor)
+
+    def replay_frames(self, client: _Client, since: int) -> list[str]:
+        """Frames del log posteriores a `since` que pasan los filtros del cliente."""
+        return [frame for id_evento, dispositivos, tipos, frame in self._replay
+                if id_evento > since and _wants(client, dispositivos, tipos)]
+
+    def touch(self, websocket: WebSocket):
+        """Anota que el cliente envió algo (está vivo)."""
+        client = self.active_connections.get(websocket) or self._device_client(websocket)
+        if client is not None:
+            client.last_seen = time.monotonic()
+
+    def _device_client(self, websocket: WebSocket):
+        id_dispositivo = self._device_of.get(websocket)
+        return None if id_dispositivo is None else self.device_channels[id_dispositivo][websocket]
+
+    def _clients(self) -> list:
+        clients = list(self.active_connections.values())
+        for channel in list(self.device_channels.values()):
+            clients.extend(channel.values())
+        return clients
+
+    async def _heartbeat(self):
+        """Encola un latido a las conexiones de las que no se recibe nada en ping_interval (el
+        cliente debe responder con cualquier mensaje) y cierra las que llevan más de ping_interval +
+        ping_timeout sin enviar nada o no consiguieron enviar el latido en ping_timeout: sockets
+        medio abiertos (aunque las escrituras aún quepan en el buffer del kernel) y clientes que no
+        leen. Se revisa cada min(ping_interval, ping_timeout) / 2 para que el cliente tenga al menos
+        medio ping_timeout para responder.
+        """
+        while True:
+            await asyncio.sleep(min(self.ping_interval, self.ping_timeout or self.ping_interval) / 2)
+            now = time.monotonic()
+            for client in self._clients():
+                if self.ping_timeout > 0 and (
+                        now - client.last_seen > self.ping_interval + self.ping_timeout
+                        or (client.ping_queued is not None and now - client.ping_queued > self.ping_timeout)):
+                    self._reap(client)
+                    continue
+                if client.ping_queued is None and now - client.last_seen >= self.ping_interval:
+                    client.ping_queued = now
+                    frame = PING_FRAME if client.websocket in self.active_connections else DEVICE_PING_FRAME
+                    # por delante de lo encolado: mide si el socket avanza, no lo larga que sea la cola
+                    self._enqueue(client, None, frame, priority=True)
+
+    def _reap(self, client: _Client):
+        self.reaped_connections += 1
+        metrics.ws_reaped_connections.inc()
+        self.disconnect(client.websocket)
+        asyncio.create_task(_close_quietly(client.websocket, code=1001))
+
+    def max_idle_seconds(self) -> float:
+        """Mayor tiempo sin recibir nada de una conexión abierta."""
+        now = time.monotonic()
+        return max((now - c.last_seen for c in self._clients()), default=0.0)
+
+    def oldest_connection_seconds(self) -> float:
+        now = time.monotonic()
+        return max((now - c.connected_at for c in self._clients()), default=0.0)
+
+    def queued_frames(self) -> int:
+        return sum(len(c.queue) for c in self._clients())
+
+    def _enqueue(self, client: _Client, key, frame: str, priority: bool = False):
+        queue = client.queue
+        if len(queue) >= self.queue_size:
+            self.dropped_frames += 1
+            metrics.ws_dropped_frames.inc()
+            if self.overflow_policy == "disconnect":
+                # cliente demasiado lento: se cierra para no acumular memoria
+                self.disconnect(client.websocket)
+                asyncio.create_task(_close_quietly(client.websocket))
+                return
+            if self.overflow_policy == "coalesce" and key is not None:
+                # reemplazar el mensaje pendiente del mismo tipo/dispositivo (gana el último)
+                for i, (queued_key, _) in enumerate(queue):
+                    if queued_key == key:
+                        del queue[i]
+                        if i < client.urgent:
+                            client.urgent -= 1
+                        break
+                else:
+                    self._drop_oldest(client)
+            else:
+                self._drop_oldest(client)
+        if priority:
+            # detrás de los prioritarios ya encolados, delante del resto
+            queue.insert(client.urgent, (key, frame))
+            client.urgent += 1
+        else:
+            queue.append((key, frame))
+        client.ready.set()
+
+    @staticmethod
+    def _drop_oldest(client: _Client):
+        """Descarta el mensaje normal más antiguo; los prioritarios sólo si no queda otro, y los
+        latidos nunca (sin ellos el cliente no responde y se cerraría una conexión sana)."""
+        queue = client.queue
+        if client.urgent < len(queue):
+            del queue[client.urgent]
+            return
+        for i, (_, frame) in enumerate(queue):
+            if frame is not PING_FRAME and frame is not DEVICE_PING_FRAME:
+                del queue[i]
+                client.urgent -= 1
+                return
+
+    async def _writer(self, client: _Client):
+        queue = client.queue
+        try:
+            while True:
+                while not queue:
+                    client.ready.clear()
+                    await client.ready.wait()
+                _, frame = queue.popleft()
+                if client.urgent:
+                    client.urgent -= 1
+                await client.websocket.send_text(frame)
+                client.last_sent = time.monotonic()
+                if frame is PING_FRAME or frame is DEVICE_PING_FRAME:
+                    client.ping_queued = None
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # desconectar clientes muertos
+            self.disconnect(client.websocket)
+
+
+def encode_message(message: dict) -> str:
+    """Serializa un mensaje a texto JSON (con orjson si está instalado)."""
+    if orjson is not None:
+        return orjson.dumps(message).decode()
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+def _iso(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} no es serializable")
+
+
+def _message_id(message: dict) -> int | None:
+    """id_evento (el mayor, en los lotes) de un mensaje; None si no corresponde a un evento escrito."""
+    if "eventos" in message:
+        return max((item["evento"].get("id_evento") or 0 for item in message["eventos"]), default=0) or None
+    evento = message.get("evento")
+    return evento.get("id_evento") if isinstance(evento, dict) else None
+
+
+def _wants(client: _Client, dispositivos: Set[int], tipos: Set[str]) -> bool:
+    """Si el mensaje pasa los filtros del cliente (igual que _subscribers)."""
+    if dispositivos and client.dispositivos is not None and client.dispositivos.isdisjoint(dispositivos):
+        return False
+    return client.tipos is None or not client.tipos.isdisjoint(tipos)
+
+
+def _message_devices(message: dict) -> Set[int]:
+    """Dispositivos a los que se refiere un mensaje (vacío = no se sabe / todos)."""
+    if "eventos" in message:
+        # lote: {"tipo": "lote", "eventos": [{"tipo": ..., "evento": {...}}, ...]}
+        return {item["evento"]["id_dispositivo"] for item in message["eventos"]}
+    evento = message.get("evento") or {}
+    id_dispositivo = message.get("id_dispositivo", evento.get("id_dispositivo"))
+    return {id_dispositivo} if id_dispositivo is not None else set()
+
+
+def _message_tipos(message: dict) -> Set[str]:
+    if "eventos" in message:
+        return {item["tipo"] for item in message["eventos"]}
+    return {message.get("tipo")}
+
+
+def _coalesce_key(message: dict):
+    if "eventos" in message:
+        # un lote nunca reemplaza a otro
+        return None
+    evento = message.get("evento") or {}
+    return (message.get("tipo"), message.get("id_dispositivo", evento.get("id_dispositivo")))
+
+
+async def _close_quietly(websocket: WebSocket, code: int = 1013):
+    try:
+        await websocket.close(code=code)
+    except Exception:
+        pass
+
 
 manager = ConnectionManager()
+
+metrics.registry.register(metrics.Gauge("ws_monitor_connections", "Conexiones activas en /ws/monitor", func=lambda: len(manager.active_connections)))
+metrics.registry.register(metrics.Gauge("ws_device_connections", "Carros conectados por /ws/device",
+                                        func=lambda: sum(len(c) for c in manager.device_channels.values())))
+metrics.registry.register(metrics.Gauge("ws_max_idle_seconds", "Mayor tiempo sin recibir nada de una conexión abierta",
+                                        func=manager.max_idle_seconds))
+metrics.registry.register(metrics.Gauge("ws_oldest_connection_seconds", "Antigüedad de la conexión abierta más antigua",
+                                        func=manager.oldest_connection_seconds))
+metrics.registry.register(metrics.Gauge("ws_queued_frames", "Frames pendientes en las colas de salida", func=manager.queued_frames))
+metrics.registry.register(metrics.Gauge("event_bus_dropped_total", "Mensajes del bus entre procesos descartados",
+                                        func=lambda: getattr(manager.bus, "dropped", 0)))